@@ -1,21 +1,23 @@
 import datetime
+import time
 import traceback
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
 
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives
 from django.db.models import Q
-from django.http import QueryDict
 from django.template import loader
 from django.utils.timezone import now
 
 from cl.alerts.models import Alert, RealTimeQueue
-from cl.lib import search_utils
+from cl.alerts.percolator import make_rt_index
+from cl.alerts.utils import add_cut_off_date, cache_alert_params
 from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.scorched_utils import ExtraSolrInterface
 from cl.lib.search_utils import regroup_snippets
-from cl.search.forms import SearchForm
 from cl.search.models import SEARCH_TYPES
 from cl.stats.utils import tally_stat
 
@@ -23,6 +25,12 @@ from cl.stats.utils import tally_stat
 # handled in the next run of this script.
 MAX_RT_ITEM_QUERY = 1000
 
+SOLR_URLS = {
+    SEARCH_TYPES.OPINION: settings.SOLR_OPINION_URL,
+    SEARCH_TYPES.ORAL_ARGUMENT: settings.SOLR_AUDIO_URL,
+    SEARCH_TYPES.RECAP: settings.SOLR_RECAP_URL,
+}
+
 
 class InvalidDateError(Exception):
     pass
@@ -79,23 +87,9 @@ class Command(VerboseCommand):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.sis = {
-            SEARCH_TYPES.OPINION: ExtraSolrInterface(
-                settings.SOLR_OPINION_URL, mode="r"
-            ),
-            SEARCH_TYPES.ORAL_ARGUMENT: ExtraSolrInterface(
-                settings.SOLR_AUDIO_URL, mode="r"
-            ),
-            SEARCH_TYPES.RECAP: ExtraSolrInterface(
-                settings.SOLR_RECAP_URL, mode="r"
-            ),
-        }
         self.options = {}
         self.valid_ids = {}
-
-    def __del__(self):
-        for si in self.sis.values():
-            si.conn.http_connection.close()
+        self.rt_indexes = {}
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -105,6 +99,19 @@ class Command(VerboseCommand):
             help="The rate to send emails (%s)"
             % ", ".join(Alert.ALL_FREQUENCIES),
         )
+        parser.add_argument(
+            "--max-parallel-queries",
+            type=int,
+            default=settings.ALERTS_MAX_PARALLEL_QUERIES,
+            help="How many alert queries to run against Solr at once.",
+        )
+        parser.add_argument(
+            "--no-percolate",
+            action="store_true",
+            default=False,
+            help="Run every real time alert against all the new items in "
+            "Solr, instead of first checking which of them it might match.",
+        )
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
@@ -112,86 +119,134 @@ class Command(VerboseCommand):
         if options["rate"] == Alert.REAL_TIME:
             self.remove_stale_rt_items()
             self.valid_ids = self.get_new_ids()
+            if not options["no_percolate"]:
+                self.rt_indexes = {
+                    item_type: make_rt_index(item_type, ids)
+                    for item_type, ids in self.valid_ids.items()
+                    if ids
+                }
 
         self.send_emails(options["rate"])
         if options["rate"] == Alert.REAL_TIME:
             self.clean_rt_queue()
 
-    def run_query(self, alert, rate):
-        results = []
-        cd = {}
-        logger.info("Now running the query: %s\n" % alert.query)
-
-        # Make a dict from the query string.
-        qd = QueryDict(alert.query.encode(), mutable=True)
-        try:
-            del qd["filed_before"]
-        except KeyError:
-            pass
-        qd["order_by"] = "score desc"
-        cut_off_date = get_cut_off_date(rate)
-        # Default to 'o', if not available, according to the front end.
-        query_type = qd.get("type", SEARCH_TYPES.OPINION)
-        if query_type in [SEARCH_TYPES.OPINION, SEARCH_TYPES.RECAP]:
-            qd["filed_after"] = cut_off_date
-        elif query_type == SEARCH_TYPES.ORAL_ARGUMENT:
-            qd["argued_after"] = cut_off_date
-        logger.info("Data sent to SearchForm is: %s\n" % qd)
-        search_form = SearchForm(qd)
-        if search_form.is_valid():
-            cd = search_form.cleaned_data
-
-            if (
-                rate == Alert.REAL_TIME
-                and len(self.valid_ids[query_type]) == 0
-            ):
-                # Bail out. No results will be found if no valid_ids.
-                return query_type, results
-
-            main_params = search_utils.build_main_query(cd, facet=False)
-            main_params.update(
-                {
-                    "rows": "20",
-                    "start": "0",
-                    "hl.tag.pre": "<em><strong>",
-                    "hl.tag.post": "</strong></em>",
-                    "caller": "cl_send_alerts:%s" % query_type,
-                }
-            )
+    def get_rt_ids(self, params, query_type):
+        """Get the IDs of the new items a real time alert might match.
 
-            if rate == Alert.REAL_TIME:
-                main_params["fq"].append(
-                    "id:(%s)"
-                    % " OR ".join([str(i) for i in self.valid_ids[query_type]])
-                )
+        :param params: The Solr params of the alert
+        :param query_type: The search type of the alert
+        :return: A sorted list of IDs, which is empty if the alert can't match
+        any of the new items.
+        """
+        index = self.rt_indexes.get(query_type)
+        if index is None:
+            return sorted(self.valid_ids.get(query_type, []))
+        return sorted(index.match(params["q"]))
+
+    def run_query(self, params, query_type, ids=None):
+        """Run the Solr params of an alert.
+
+        This is called from several threads at once. Interfaces are cheap to
+        make, and each thread gets its own pooled Solr session, so each query
+        makes its own interface.
+
+        :param params: The Solr params to run
+        :param query_type: The search type of the alert
+        :param ids: For real time alerts, the IDs of the only items that can
+        be returned.
+        """
+        logger.info("Now running the query: %s\n" % params["q"])
+        if ids is not None:
+            params["fq"].append("id:(%s)" % " OR ".join(map(str, ids)))
+
+        si = ExtraSolrInterface(SOLR_URLS[query_type], mode="r")
+        # Ignore warnings from this bit of code. Otherwise, it complains
+        # about the query URL being too long and having to POST it instead
+        # of being able to GET it.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            results = si.query().add_extra(**params).execute()
+        regroup_snippets(results)
+        logger.info("There were %s results." % len(results))
+        return results
 
-            # Ignore warnings from this bit of code. Otherwise, it complains
-            # about the query URL being too long and having to POST it instead
-            # of being able to GET it.
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                results = (
-                    self.sis[query_type]
-                    .query()
-                    .add_extra(**main_params)
-                    .execute()
-                )
-            regroup_snippets(results)
+    def run_alerts(self, alerts, rate):
+        """Run the queries of many alerts at once.
 
-        logger.info("There were %s results." % len(results))
-        return qd, results
+        The params of each query are compiled when its alert is saved, so all
+        that's left here is adding the cut-off date. Alerts are grouped by
+        search type and cut-off date, and alerts with the same query share a
+        single Solr query.
+
+        Real time alerts are only run against the new items they might
+        match, and not at all if there aren't any.
+
+        :param alerts: The alerts to run
+        :param rate: The rate the alerts are being run at
+        :return: A tuple of a dict mapping alert query strings to a tuple of
+        their search type, the query string that was run, and the results,
+        and the number of Solr queries that were run. Invalid and failed
+        queries are left out of the dict.
+        """
+        cut_off_date = get_cut_off_date(rate)
+        groups = defaultdict(dict)
+        for alert in alerts:
+            compiled = cache_alert_params(alert.query)
+            if compiled is None:
+                logger.info("Alert has an invalid query: %s\n" % alert.query)
+                continue
+            groups[(compiled["type"], cut_off_date)][alert.query] = compiled
+
+        query_results = {}
+        futures = {}
+        with ThreadPoolExecutor(
+            max_workers=self.options.get(
+                "max_parallel_queries", settings.ALERTS_MAX_PARALLEL_QUERIES
+            )
+        ) as executor:
+            for (query_type, cut_off_date), queries in groups.items():
+                for query, compiled in queries.items():
+                    params, query_run = add_cut_off_date(
+                        compiled, cut_off_date
+                    )
+                    ids = None
+                    if rate == Alert.REAL_TIME:
+                        ids = self.get_rt_ids(params, query_type)
+                        if not ids:
+                            # No results will be found without new items.
+                            query_results[query] = (query_type, query_run, [])
+                            continue
+                    future = executor.submit(
+                        self.run_query, params, query_type, ids
+                    )
+                    futures[future] = (query, query_type, query_run)
+
+            for future in as_completed(futures):
+                query, query_type, query_run = futures[future]
+                try:
+                    results = future.result()
+                except:
+                    traceback.print_exc()
+                    logger.info("Search for this alert failed: %s\n" % query)
+                    continue
+                query_results[query] = (query_type, query_run, results)
+        return query_results, len(futures)
 
     def send_emails(self, rate):
         """Send out an email to every user whose alert has a new hit for a
         rate.
-        """
-        users = User.objects.filter(alerts__rate=rate).distinct()
-
-        alerts_sent_count = 0
-        for user in users:
-            alerts = user.alerts.filter(rate=rate)
-            logger.info("Running alerts for user '%s': %s" % (user, alerts))
 
+        All the alerts for the rate are run first, then the emails are made.
+        """
+        start = time.perf_counter()
+        user_alerts = []
+        alerts = (
+            Alert.objects.filter(rate=rate)
+            .select_related("user__profile")
+            .order_by("user_id", "pk")
+        )
+        for user, alerts in groupby(alerts, key=lambda a: a.user):
+            alerts = list(alerts)
             not_donated_enough = (
                 user.profile.total_donated_last_year
                 < settings.MIN_DONATION["rt_alerts"]
@@ -199,29 +254,30 @@ class Command(VerboseCommand):
             if not_donated_enough and rate == Alert.REAL_TIME:
                 logger.info(
                     "User: %s has not donated enough for their %s "
-                    "RT alerts to be sent.\n" % (user, alerts.count())
+                    "RT alerts to be sent.\n" % (user, len(alerts))
                 )
                 continue
+            user_alerts.append((user, alerts))
+
+        alerts_run = [alert for _, alerts in user_alerts for alert in alerts]
+        query_results, query_count = self.run_alerts(alerts_run, rate)
+        elapsed = time.perf_counter() - start
 
+        alerts_sent_count = 0
+        for user, alerts in user_alerts:
+            logger.info("Making alerts for user '%s': %s" % (user, alerts))
             hits = []
             for alert in alerts:
-                try:
-                    qd, results = self.run_query(alert, rate)
-                except:
-                    traceback.print_exc()
-                    logger.info(
-                        "Search for this alert failed: %s\n" % alert.query
-                    )
+                if alert.query not in query_results:
                     continue
+                query_type, query_run, results = query_results[alert.query]
 
                 # hits is a multi-dimensional array. It consists of alerts,
                 # paired with a list of document dicts, of the form:
                 # [[alert1, [{hit1}, {hit2}, {hit3}]], [alert2, ...]]
                 if len(results) > 0:
-                    hits.append(
-                        [alert, qd.get("type", SEARCH_TYPES.OPINION), results]
-                    )
-                    alert.query_run = qd.urlencode()
+                    hits.append([alert, query_type, results])
+                    alert.query_run = query_run
                     alert.date_last_hit = now()
                     alert.save()
 
@@ -229,7 +285,20 @@ class Command(VerboseCommand):
                 alerts_sent_count += 1
                 send_alert(user.profile, hits)
 
+        tally_stat("alerts.run.%s" % rate, inc=len(alerts_run))
+        tally_stat("alerts.queries.%s" % rate, inc=query_count)
+        tally_stat("alerts.query_seconds.%s" % rate, inc=round(elapsed))
         tally_stat("alerts.sent.%s" % rate, inc=alerts_sent_count)
+        logger.info(
+            "Ran %s %s alerts with %s queries in %.1fs (%.1f alerts/s)."
+            % (
+                len(alerts_run),
+                rate,
+                query_count,
+                elapsed,
+                len(alerts_run) / elapsed if elapsed else 0,
+            )
+        )
         logger.info("Sent %s %s email alerts." % (alerts_sent_count, rate))
 
     def clean_rt_queue(self):
@@ -268,7 +337,9 @@ class Command(VerboseCommand):
         """
         valid_ids = {}
         for item_type in SEARCH_TYPES.ALL_TYPES:
-            ids = RealTimeQueue.objects.filter(item_type=item_type)
+            ids = RealTimeQueue.objects.filter(item_type=item_type).order_by(
+                "pk"
+            )[:MAX_RT_ITEM_QUERY]
             if ids:
                 main_params = {
                     "q": "*",  # Vital!
@@ -279,12 +350,8 @@ class Command(VerboseCommand):
                         "id:(%s)" % " OR ".join([str(i.item_pk) for i in ids])
                     ],
                 }
-                results = (
-                    self.sis[item_type]
-                    .query()
-                    .add_extra(**main_params)
-                    .execute()
-                )
+                si = ExtraSolrInterface(SOLR_URLS[item_type], mode="r")
+                results = si.query().add_extra(**main_params).execute()
                 valid_ids[item_type] = [
                     int(r["id"]) for r in results.result.docs
                 ]
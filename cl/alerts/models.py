@@ -52,11 +52,17 @@ class Alert(AbstractDateTimeModel):
         ordering = ["rate", "query"]
 
     def save(self, *args, **kwargs):
-        """Ensure we get a token when we save the first time."""
+        """Ensure we get a token when we save the first time, and compile the
+        Solr params of the query so cl_send_alerts doesn't have to.
+        """
         if self.pk is None:
             self.secret_key = get_random_string(length=40)
         super(Alert, self).save(*args, **kwargs)
 
+        from cl.alerts.utils import cache_alert_params
+
+        cache_alert_params(self.query)
+
 
 class DocketAlert(models.Model):
     date_created = models.DateTimeField(
@@ -0,0 +1,271 @@
+"""Match real time alerts against new items without asking Solr.
+
+Real time alerts only ever match the handful of items that are in the
+RealTimeQueue, so instead of running every alert against the whole Solr
+index, the new items are put in a small in-process index and each alert's
+query is checked against that first. Alerts that can't match any of the new
+items are never sent to Solr, and the rest are sent with a filter for only
+the items they might match.
+
+The check is deliberately loose. Solr stems words, folds accents, drops
+stopwords and understands more syntax than is handled here, so the index
+never rules out an item that Solr could match:
+
+ - Terms match any word that shares a prefix of up to ROOT_LENGTH
+   characters with them, which covers the suffixes stemmers strip.
+ - Phrases match items that have all of their words, anywhere.
+ - Stopwords, negations, fielded queries, ranges, fuzzy terms and anything
+   else that isn't understood match every item.
+ - A group with an OR in it matches the items that any of its clauses match.
+
+Solr still decides what actually matches and makes the highlights, so the
+only cost of being loose is a query that comes back empty.
+"""
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from cl.audio.models import Audio
+from cl.search.models import SEARCH_TYPES, Opinion
+
+logger = logging.getLogger(__name__)
+
+# Words that share a prefix this long are assumed to have the same stem.
+ROOT_LENGTH = 3
+
+# Lucene's default English stopwords.
+STOPWORDS = set(
+    "a an and are as at be but by for if in into is it no not of on or such "
+    "that the their then there these they this to was will with".split()
+)
+
+LEXEME_RE = re.compile(
+    r"""
+    (?P<phrase>"[^"]*"?(?:~\d*)?(?:\^[\d.]+)?)
+    |(?P<range>[\[{][^\]}]*[\]}]?)
+    |(?P<lparen>\()
+    |(?P<rparen>\))
+    |(?P<op>&&|\|\||[+\-!])
+    |(?P<term>[^\s()"\[\]{}]+)
+    """,
+    re.VERBOSE,
+)
+WORD_RE = re.compile(r"\w+")
+
+# Stand-in for "every item", since it's cheaper than a set of them.
+ALL = None
+
+
+def fold(text: str) -> str:
+    """Lower-case text and strip its accents, as Solr does when indexing."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def get_words(text: str) -> List[str]:
+    return WORD_RE.findall(fold(text))
+
+
+def get_values(value: Any) -> Iterable[str]:
+    """Get the text of every value in a search dict, however it's nested."""
+    if value is None:
+        return
+    if isinstance(value, (list, tuple, set)):
+        for item in value:
+            yield from get_values(item)
+    else:
+        yield str(value)
+
+
+class QuerySyntaxError(Exception):
+    pass
+
+
+class RealTimeIndex(object):
+    """A throwaway index of the search dicts of some new items."""
+
+    def __init__(self, docs: Dict[int, Dict[str, Any]]) -> None:
+        """
+        :param docs: A dict of item IDs to the search dicts of the items. An
+        item whose search dict is None couldn't be indexed, and so matches
+        every query.
+        """
+        self.ids = set(docs)
+        self.unindexed = {pk for pk, doc in docs.items() if doc is None}
+        # Every prefix of every word, up to ROOT_LENGTH, and words shorter
+        # than that.
+        self.prefixes: Dict[str, Set[int]] = {}
+        self.short_words: Dict[str, Set[int]] = {}
+        for pk, doc in docs.items():
+            if doc is None:
+                continue
+            words = set()
+            for value in doc.values():
+                for text in get_values(value):
+                    words.update(get_words(text))
+            for word in words:
+                for i in range(1, min(len(word), ROOT_LENGTH) + 1):
+                    self.prefixes.setdefault(word[:i], set()).add(pk)
+                if len(word) < ROOT_LENGTH:
+                    self.short_words.setdefault(word, set()).add(pk)
+
+    def match(self, q: str) -> Set[int]:
+        """Find the items that a query might match.
+
+        :param q: The q param of a Solr query
+        :return: The IDs of the items the query might match.
+        """
+        try:
+            lexemes = [(m.lastgroup, m.group()) for m in LEXEME_RE.finditer(q)]
+            matched = self._parse_group(lexemes, 0, top_level=True)[0]
+        except QuerySyntaxError:
+            # Solr's edismax parser copes with broken queries, so we can't
+            # rule anything out.
+            matched = ALL
+        if matched is ALL:
+            return set(self.ids)
+        return matched | self.unindexed
+
+    def match_word(self, word: str) -> Optional[Set[int]]:
+        """Find the items with a word that might have the same stem."""
+        if word in STOPWORDS:
+            return ALL
+        matched = set(self.prefixes.get(word[:ROOT_LENGTH], ()))
+        for i in range(1, min(len(word), ROOT_LENGTH)):
+            matched |= self.short_words.get(word[:i], set())
+        return matched
+
+    def match_prefix(self, prefix: str) -> Optional[Set[int]]:
+        """Find the items with a word that starts with a prefix."""
+        words = get_words(prefix)
+        if not words or not fold(prefix).endswith(words[-1]):
+            return ALL
+        matched = self.match_all([self.match_word(w) for w in words[:-1]])
+        last = words[-1]
+        if len(last) <= ROOT_LENGTH:
+            last_matched = set(self.prefixes.get(last, ()))
+        else:
+            last_matched = self.match_word(last)
+        return self.match_all([matched, last_matched])
+
+    def match_text(self, text: str) -> Optional[Set[int]]:
+        """Find the items that have every word in some text."""
+        return self.match_all([self.match_word(w) for w in get_words(text)])
+
+    @staticmethod
+    def match_all(matches: List[Optional[Set[int]]]) -> Optional[Set[int]]:
+        matched = ALL
+        for m in matches:
+            if m is ALL:
+                continue
+            matched = m if matched is ALL else matched & m
+        return matched
+
+    @staticmethod
+    def match_any(matches: List[Optional[Set[int]]]) -> Optional[Set[int]]:
+        matched: Set[int] = set()
+        for m in matches:
+            if m is ALL:
+                return ALL
+            matched |= m
+        return matched
+
+    def _parse_group(self, lexemes, i, top_level=False):
+        """Match the clauses of a group, up to its closing paren.
+
+        :return: A tuple of the matched IDs, and the index of the lexeme
+        after the group.
+        """
+        clauses = []
+        has_or = False
+        while i < len(lexemes):
+            kind, text = lexemes[i]
+            if kind == "rparen":
+                if top_level:
+                    raise QuerySyntaxError("Unbalanced parentheses")
+                i += 1
+                break
+            if text in ("OR", "||"):
+                has_or = True
+                i += 1
+                continue
+            if text in ("AND", "&&", "+"):
+                i += 1
+                continue
+            negated = text in ("NOT", "!", "-")
+            if negated:
+                i += 1
+                if i == len(lexemes):
+                    break
+            matched, i = self._parse_clause(lexemes, i)
+            # Negations can only take items away, which is never safe here.
+            clauses.append(ALL if negated else matched)
+        else:
+            if not top_level:
+                raise QuerySyntaxError("Unbalanced parentheses")
+        if has_or:
+            return self.match_any(clauses), i
+        return self.match_all(clauses), i
+
+    def _parse_clause(self, lexemes, i):
+        """Match a single term, phrase, range or group.
+
+        :return: A tuple of the matched IDs, and the index of the lexeme
+        after the clause.
+        """
+        kind, text = lexemes[i]
+        i += 1
+        if kind == "lparen":
+            return self._parse_group(lexemes, i)
+        if kind == "rparen":
+            raise QuerySyntaxError("Unbalanced parentheses")
+        if kind == "phrase":
+            return self.match_text(text.split('"')[1]), i
+        if kind == "term" and ":" in text:
+            # A fielded query. Skip its value, which may be a phrase, a
+            # range or a group.
+            if text.endswith(":") and i < len(lexemes):
+                if lexemes[i][0] == "lparen":
+                    i = self._parse_group(lexemes, i + 1)[1]
+                else:
+                    i += 1
+            return ALL, i
+        if kind != "term":
+            # Ranges, and operators where a clause ought to be.
+            return ALL, i
+        text = re.sub(r"\^[\d.]+$", "", text)
+        if "~" in text:
+            return ALL, i
+        if "*" in text or "?" in text:
+            return self.match_prefix(re.split(r"[*?]", text)[0]), i
+        return self.match_text(text), i
+
+
+def load_search_dicts(item_type: str, ids: List[int]) -> Dict[int, Any]:
+    """Get the search dicts of the new items of a type.
+
+    :return: A dict of IDs to search dicts. Items that can't be made into
+    search dicts map to None.
+    """
+    if item_type == SEARCH_TYPES.OPINION:
+        items = Opinion.prefetch_for_search(Opinion.objects.filter(pk__in=ids))
+    elif item_type == SEARCH_TYPES.ORAL_ARGUMENT:
+        items = Audio.objects.filter(pk__in=ids).select_related("docket")
+    else:
+        return dict.fromkeys(ids)
+
+    docs: Dict[int, Any] = dict.fromkeys(ids)
+    for item in items:
+        try:
+            docs[item.pk] = item.as_search_dict()
+        except Exception:
+            logger.warning(
+                "Unable to make search dict for %s %s", item_type, item.pk
+            )
+    return docs
+
+
+def make_rt_index(item_type: str, ids: List[int]) -> RealTimeIndex:
+    """Make an index of the new items of a type."""
+    return RealTimeIndex(load_search_dicts(item_type, ids))
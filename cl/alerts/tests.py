@@ -1,8 +1,9 @@
-from datetime import timedelta
+from datetime import date, timedelta
 
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.test import Client, SimpleTestCase, TestCase
 from django.urls import reverse
 from django.utils.timezone import now
 from selenium.webdriver.common.by import By
@@ -12,8 +13,10 @@ from cl.alerts.management.commands.handle_old_docket_alerts import (
     build_user_report,
 )
 from cl.alerts.models import Alert, DocketAlert
+from cl.alerts.percolator import RealTimeIndex
 from cl.alerts.tasks import send_docket_alert
-from cl.search.models import Docket, DocketEntry, RECAPDocument
+from cl.alerts.utils import add_cut_off_date, make_alert_params_key
+from cl.search.models import SEARCH_TYPES, Docket, DocketEntry, RECAPDocument
 from cl.tests.base import SELENIUM_TIMEOUT, BaseSeleniumTest
 
 
@@ -77,6 +80,67 @@ class AlertTest(TestCase):
         self.alert.refresh_from_db()
         self.assertEqual(self.alert.rate, new_rate)
 
+    def test_alert_params_are_compiled_when_saved(self) -> None:
+        """Are an alert's Solr params cached when it's saved, and is the
+        cut-off date only added when it's run?
+        """
+        self.alert.query = "q=asdf&type=o&filed_after=01/01/2000"
+        self.alert.save()
+        compiled = cache.get(make_alert_params_key(self.alert.query))
+        self.assertEqual(compiled["type"], SEARCH_TYPES.OPINION)
+        self.assertFalse(
+            any("dateFiled" in fq for fq in compiled["params"]["fq"])
+        )
+        self.assertNotIn("filed_after", compiled["query"])
+
+        params, query_run = add_cut_off_date(compiled, date(2020, 1, 2))
+        self.assertIn("dateFiled:[2020-01-02T00:00:00Z TO *]", params["fq"])
+        self.assertIn("filed_after=2020-01-02", query_run)
+        self.assertNotIn(
+            "dateFiled:[2020-01-02T00:00:00Z TO *]",
+            compiled["params"]["fq"],
+            msg="Adding the cut-off date changed the cached params.",
+        )
+
+
+class RealTimeIndexTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.index = RealTimeIndex(
+            {
+                1: {
+                    "caseName": "Smith v. Jones",
+                    "text": "The contracts were breached by Müller.",
+                },
+                2: {"caseName": "Roe v. Doe", "text": "Immigration; he died"},
+                3: None,
+            }
+        )
+
+    def test_match(self) -> None:
+        """Do queries match every item that Solr might match, and rule out
+        the rest?
+        """
+        tests = (
+            ("contracting breach", {1, 3}),
+            ("muller", {1, 3}),
+            ("immigrant*", {2, 3}),
+            ("dies", {2, 3}),
+            ('"qualified immunity"', {3}),
+            ("zebra OR smith", {1, 3}),
+            ("zebra AND smith", {3}),
+            ("zebra^2", {3}),
+            # Nothing can be ruled out by these.
+            ("-contract", {1, 2, 3}),
+            ("court_id:ca9", {1, 2, 3}),
+            ("caseName:(zebra giraffe)", {1, 2, 3}),
+            ("zebr~", {1, 2, 3}),
+            ("(unbalanced", {1, 2, 3}),
+            ("*", {1, 2, 3}),
+        )
+        for q, expected in tests:
+            with self.subTest(q=q):
+                self.assertEqual(self.index.match(q), expected)
+
 
 class DocketAlertTest(TestCase):
     """Do docket alerts work properly?"""
@@ -0,0 +1,108 @@
+import datetime
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from django.core.cache import cache
+from django.http import QueryDict
+
+from cl.lib.search_utils import build_main_query, make_date_query
+from cl.search.forms import SearchForm
+from cl.search.models import SEARCH_TYPES
+
+# Bump this whenever the way alerts are compiled changes, so that params
+# compiled by older code aren't used.
+ALERT_PARAMS_VERSION = 1
+ALERT_PARAMS_TIMEOUT = 60 * 60 * 24 * 30
+
+# The form field and Solr field that an alert's cut-off date goes in, by
+# search type. Other types of alerts have no cut-off date.
+CUT_OFF_FIELDS = {
+    SEARCH_TYPES.OPINION: ("filed_after", "dateFiled"),
+    SEARCH_TYPES.RECAP: ("filed_after", "dateFiled"),
+    SEARCH_TYPES.ORAL_ARGUMENT: ("argued_after", "dateArgued"),
+}
+
+
+def make_alert_params_key(query: str) -> str:
+    """Make the cache key for the compiled params of an alert query.
+
+    The key is based on the query rather than the alert, so alerts with the
+    same query share params, and an alert whose query changes gets new ones.
+    """
+    query_hash = hashlib.sha256(query.encode()).hexdigest()
+    return f"alert.params.v{ALERT_PARAMS_VERSION}:{query_hash}"
+
+
+def compile_alert_query(query: str) -> Optional[Dict]:
+    """Turn the query string of an alert into Solr params.
+
+    The params have no cut-off date, which depends on when the alert is run.
+    Add it with add_cut_off_date.
+
+    :param query: The query string of an alert, like "q=foo&type=o"
+    :return: None if the query isn't a valid search, else a dict with the
+    search type, the Solr params, and the query string that they came from.
+    """
+    qd = QueryDict(query.encode(), mutable=True)
+    # Default to 'o', if not available, according to the front end.
+    query_type = qd.get("type", SEARCH_TYPES.OPINION)
+    qd.pop("filed_before", None)
+    if query_type in CUT_OFF_FIELDS:
+        qd.pop(CUT_OFF_FIELDS[query_type][0], None)
+    qd["order_by"] = "score desc"
+    search_form = SearchForm(qd)
+    if not search_form.is_valid():
+        return None
+
+    params = build_main_query(search_form.cleaned_data, facet=False)
+    params.update(
+        {
+            "rows": "20",
+            "start": "0",
+            "hl.tag.pre": "<em><strong>",
+            "hl.tag.post": "</strong></em>",
+            "caller": "cl_send_alerts:%s" % query_type,
+        }
+    )
+    return {"type": query_type, "params": params, "query": qd.urlencode()}
+
+
+def cache_alert_params(query: str, force: bool = False) -> Optional[Dict]:
+    """Compile the params for an alert query and cache them.
+
+    :param query: The query string of an alert
+    :param force: Whether to compile the params even if they're cached.
+    :return: The compiled params, as returned by compile_alert_query.
+    """
+    key = make_alert_params_key(query)
+    if not force:
+        compiled = cache.get(key)
+        if compiled is not None:
+            return compiled or None
+    compiled = compile_alert_query(query)
+    # Invalid queries are cached too, as an empty dict, so they aren't parsed
+    # again on every run.
+    cache.set(key, compiled or {}, ALERT_PARAMS_TIMEOUT)
+    return compiled
+
+
+def add_cut_off_date(
+    compiled: Dict, cut_off_date: datetime.date
+) -> Tuple[Dict, str]:
+    """Add a cut-off date to params made by compile_alert_query.
+
+    :param compiled: The compiled params of an alert
+    :param cut_off_date: The date after which new results are hits
+    :return: A tuple of the Solr params to run, and the query string with the
+    cut-off date, which is what the alert's query_run is set to.
+    """
+    params = dict(compiled["params"])
+    params["fq"] = list(params["fq"])
+    qd = QueryDict(compiled["query"].encode(), mutable=True)
+    if compiled["type"] in CUT_OFF_FIELDS:
+        if isinstance(cut_off_date, datetime.datetime):
+            cut_off_date = cut_off_date.date()
+        form_field, solr_field = CUT_OFF_FIELDS[compiled["type"]]
+        params["fq"].append(make_date_query(solr_field, None, cut_off_date))
+        qd[form_field] = cut_off_date
+    return params, qd.urlencode()
@@ -0,0 +1,406 @@
+"""Columnar bulk data, for people who reload the whole corpus regularly.
+
+Each object type is exported as a series of snapshots. The first is a full
+export of the table. Each one after that is a delta, holding the rows that
+were modified since the one before and a `deleted.txt.gz` file with the ids of
+the rows that were deleted since then, one per line. Loading the full
+snapshot, and then for each delta in order upserting its rows on `id` and
+deleting its deleted ids, rebuilds the table. Within a snapshot, court-based
+types have one file per court, and the rest have a single file.
+
+Deletions are found by comparing the table against `ids.txt.gz`, the sorted
+list of ids written alongside the last snapshot.
+
+Every type has a `manifest.json` describing its columns and listing its
+snapshots. A new full snapshot is made whenever the format or the columns
+change, or when one is requested, and it replaces all the ones before it.
+
+CSV files are streamed straight out of Postgres with `COPY`, like the
+citations bulk file. Parquet files are built from a server-side cursor and
+need pyarrow, which is optional.
+"""
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime
+from os.path import join
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.db import connection
+from django.db.models import Count, F
+from django.utils.timezone import now
+
+from cl.api.utils import BulkJsonHistory
+from cl.lib.utils import mkdir_p
+from cl.people_db.models import Person, Position
+from cl.search.models import Docket, Opinion, OpinionCluster
+
+FORMATS = ("csv", "parquet")
+
+COLUMNAR_TYPES: Dict[str, Dict[str, Any]] = {
+    "clusters": {
+        "obj_class": OpinionCluster,
+        "court_lookup": "docket__court",
+        "exclude": ("filepath_json_harvard",),
+    },
+    "opinions": {
+        "obj_class": Opinion,
+        "court_lookup": "cluster__docket__court",
+        "exclude": (),
+    },
+    "dockets": {
+        "obj_class": Docket,
+        "court_lookup": "court",
+        "exclude": ("view_count", "filepath_local"),
+    },
+    "people": {
+        "obj_class": Person,
+        "court_lookup": None,
+        "exclude": (),
+    },
+    "positions": {
+        "obj_class": Position,
+        "court_lookup": None,
+        "exclude": (),
+    },
+}
+
+# Django field types, mapped to the types in the manifest. Anything that's
+# not listed is a string.
+COLUMN_TYPES = {
+    "AutoField": "int64",
+    "BigAutoField": "int64",
+    "BigIntegerField": "int64",
+    "IntegerField": "int64",
+    "PositiveIntegerField": "int64",
+    "PositiveSmallIntegerField": "int64",
+    "SmallIntegerField": "int64",
+    "BooleanField": "bool",
+    "NullBooleanField": "bool",
+    "FloatField": "float64",
+    "DecimalField": "float64",
+    "DateField": "date",
+    "DateTimeField": "timestamp",
+}
+
+
+def get_columns(obj_class: Any, exclude: Tuple[str, ...]) -> List[Dict]:
+    """Get the name and type of each column we export for a model.
+
+    Foreign keys are exported as the ID of the object they point to.
+    """
+    columns = []
+    for field in obj_class._meta.concrete_fields:
+        if field.name in exclude:
+            continue
+        target = field
+        while target.is_relation:
+            target = target.target_field
+        columns.append(
+            {
+                "name": field.attname,
+                "type": COLUMN_TYPES.get(target.get_internal_type(), "string"),
+            }
+        )
+    return columns
+
+
+def get_partitions(
+    obj_class: Any, court_lookup: Optional[str], since: Optional[datetime]
+) -> Dict[str, int]:
+    """Count the rows that go in each partition of a snapshot.
+
+    :return: A dict of partition names to row counts, leaving out empty
+    partitions.
+    """
+    qs = obj_class.objects.all()
+    if since is not None:
+        qs = qs.filter(date_modified__gte=since)
+    if court_lookup is None:
+        count = qs.count()
+        return {"all": count} if count else {}
+    return {
+        row["partition"]: row["count"]
+        for row in qs.annotate(partition=F(court_lookup))
+        .values("partition")
+        .annotate(count=Count("pk"))
+        .order_by("partition")
+    }
+
+
+def get_partition_queryset(
+    obj_class: Any,
+    columns: List[Dict],
+    court_lookup: Optional[str],
+    partition: str,
+    since: Optional[datetime],
+):
+    """Make a values_list queryset for the rows of one partition."""
+    qs = obj_class.objects.all()
+    if since is not None:
+        qs = qs.filter(date_modified__gte=since)
+    if court_lookup is not None:
+        qs = qs.filter(**{court_lookup: partition})
+    return qs.order_by("pk").values_list(*[c["name"] for c in columns])
+
+
+def write_csv_partition(qs, path: str) -> None:
+    """Stream the rows of a queryset into a gzipped CSV with COPY."""
+    sql, params = qs.query.sql_with_params()
+    with connection.cursor() as cursor:
+        query = cursor.mogrify(sql, params).decode()
+        with gzip.open(path, "wb", compresslevel=6) as f:
+            cursor.copy_expert(
+                "COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)" % query, f
+            )
+
+
+def write_parquet_partition(
+    qs, columns: List[Dict], path: str, batch_size: int = 10000
+) -> None:
+    """Stream the rows of a queryset into a Parquet file.
+
+    Rows are read from a server-side cursor and written a batch at a time, so
+    even the largest partitions don't have to fit in memory.
+    """
+    # pyarrow is only needed for Parquet, so it's an optional dependency.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {
+        "int64": pa.int64(),
+        "bool": pa.bool_(),
+        "float64": pa.float64(),
+        "date": pa.date32(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+        "string": pa.string(),
+    }
+    schema = pa.schema(
+        [pa.field(c["name"], arrow_types[c["type"]]) for c in columns]
+    )
+    float_columns = [
+        i for i, c in enumerate(columns) if c["type"] == "float64"
+    ]
+
+    def write_batch(rows: List[tuple]) -> None:
+        values = [list(column) for column in zip(*rows)]
+        for i in float_columns:
+            # Decimals have to be floats before arrow will take them.
+            values[i] = [None if v is None else float(v) for v in values[i]]
+        arrays = [
+            pa.array(column, type=field.type)
+            for column, field in zip(values, schema)
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+        rows = []
+        for row in qs.iterator(chunk_size=batch_size):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                write_batch(rows)
+                rows = []
+        if rows:
+            write_batch(rows)
+
+
+def read_ids(path: str) -> Iterator[int]:
+    """Read the ids in an ids file, in order."""
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield int(line)
+
+
+def write_ids(
+    obj_class: Any,
+    path: str,
+    old_path: Optional[str] = None,
+    deleted_path: Optional[str] = None,
+) -> int:
+    """Write the id of every row of a table to a gzipped file, in order.
+
+    If there's an older ids file, the ids in it that aren't in the table any
+    more are written to another file. Both lists are sorted, so they're
+    compared a line at a time instead of in memory.
+
+    :param obj_class: The model of the table.
+    :param path: Where to write the ids.
+    :param old_path: The ids file from the last snapshot, if any.
+    :param deleted_path: Where to write the deleted ids. Required if old_path
+    is given.
+    :return: The number of deleted ids.
+    """
+    old_ids = read_ids(old_path) if old_path else iter(())
+    old_id = next(old_ids, None)
+    deleted = 0
+    deleted_f = gzip.open(deleted_path, "wt") if old_path else None
+    try:
+        with gzip.open(path, "wt", compresslevel=6) as f:
+            for pk in (
+                obj_class.objects.order_by("pk")
+                .values_list("pk", flat=True)
+                .iterator(chunk_size=10000)
+            ):
+                while old_id is not None and old_id < pk:
+                    deleted_f.write("%s\n" % old_id)
+                    deleted += 1
+                    old_id = next(old_ids, None)
+                if old_id == pk:
+                    old_id = next(old_ids, None)
+                f.write("%s\n" % pk)
+        while old_id is not None:
+            deleted_f.write("%s\n" % old_id)
+            deleted += 1
+            old_id = next(old_ids, None)
+    finally:
+        if deleted_f is not None:
+            deleted_f.close()
+    return deleted
+
+
+class ColumnarManifest(object):
+    """The manifest.json that describes the snapshots of a type."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            with open(path) as f:
+                self.json = json.load(f)
+        except (IOError, ValueError):
+            self.json = {}
+
+    def is_compatible(self, file_format: str, columns: List[Dict]) -> bool:
+        """Can a delta with this format and these columns be added?"""
+        return (
+            bool(self.json.get("snapshots"))
+            and self.json.get("format") == file_format
+            and self.json.get("columns") == columns
+        )
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.json, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def make_columnar_bulk_data(
+    obj_type_str: str,
+    bulk_dir: str,
+    file_format: str = "csv",
+    full: bool = False,
+) -> int:
+    """Add a snapshot to the columnar bulk data for an object type.
+
+    :param obj_type_str: The type of data, like "opinions". See
+    COLUMNAR_TYPES.
+    :param bulk_dir: The directory for columnar data. Each type gets its own
+    directory inside it.
+    :param file_format: "csv" or "parquet".
+    :param full: Whether to make a full snapshot even if a delta would do.
+    :return: The number of rows written.
+    """
+    config = COLUMNAR_TYPES[obj_type_str]
+    obj_class = config["obj_class"]
+    court_lookup = config["court_lookup"]
+    columns = get_columns(obj_class, config["exclude"])
+
+    type_dir = join(bulk_dir, obj_type_str)
+    mkdir_p(type_dir)
+    manifest = ColumnarManifest(join(type_dir, "manifest.json"))
+    ids_path = join(type_dir, "ids.txt.gz")
+    history = BulkJsonHistory(obj_type_str, bulk_dir)
+    since = history.get_last_good_date()
+    if (
+        full
+        or since is None
+        or not manifest.is_compatible(file_format, columns)
+        or not os.path.exists(ids_path)
+    ):
+        print("   - Making a full %s snapshot..." % obj_type_str)
+        since = None
+    else:
+        print("   - Making a %s delta since %s..." % (obj_type_str, since))
+    history.add_current_attempt_and_save()
+    started = now()
+
+    kind = "delta" if since is not None else "full"
+    snapshot = "%s-%s" % (kind, started.strftime("%Y%m%dT%H%M%S%f"))
+    tmp_dir = join(type_dir, snapshot + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    mkdir_p(tmp_dir)
+
+    partitions = get_partitions(obj_class, court_lookup, since)
+    extension = "csv.gz" if file_format == "csv" else "parquet"
+    for partition in partitions:
+        qs = get_partition_queryset(
+            obj_class, columns, court_lookup, partition, since
+        )
+        path = join(tmp_dir, "%s.%s" % (partition, extension))
+        if file_format == "csv":
+            write_csv_partition(qs, path)
+        else:
+            write_parquet_partition(qs, columns, path)
+
+    # List the ids once the rows are written, so that rows deleted while they
+    # were being written are in these deletions.
+    deleted_count = None
+    if kind == "full":
+        write_ids(obj_class, ids_path + ".tmp")
+    else:
+        deleted_count = write_ids(
+            obj_class,
+            ids_path + ".tmp",
+            ids_path,
+            join(tmp_dir, "deleted.txt.gz"),
+        )
+        if not partitions and not deleted_count:
+            print("   - No %s have changed. All done here." % obj_type_str)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.remove(ids_path + ".tmp")
+            history.mark_success_and_save()
+            return 0
+    os.rename(tmp_dir, join(type_dir, snapshot))
+
+    entry = {
+        "path": snapshot,
+        "kind": kind,
+        "modified_since": since.isoformat() if since else None,
+        "modified_before": started.isoformat(),
+        "row_count": sum(partitions.values()),
+        "deleted_count": deleted_count,
+        "partitions": {
+            "%s.%s" % (partition, extension): count
+            for partition, count in partitions.items()
+        },
+    }
+    if kind == "full":
+        old_snapshots = [s["path"] for s in manifest.json.get("snapshots", [])]
+        manifest.json = {
+            "type": obj_type_str,
+            "format": file_format,
+            "primary_key": "id",
+            "partitioned_by": "court" if court_lookup else None,
+            "columns": columns,
+            "snapshots": [entry],
+        }
+    else:
+        old_snapshots = []
+        manifest.json["snapshots"].append(entry)
+    manifest.save()
+    # If we die before this, the next delta will just list these deletions
+    # again.
+    os.replace(ids_path + ".tmp", ids_path)
+    # Only clean up once the manifest no longer points at the old snapshots.
+    for old_snapshot in old_snapshots:
+        shutil.rmtree(join(type_dir, old_snapshot), ignore_errors=True)
+
+    # Rows modified while we were working may not be in this snapshot, so
+    # the next delta starts from when this one did.
+    history.mark_success_and_save(good_as_of=started)
+    print(
+        "   - %s %s rows written to %s partitions."
+        % (entry["row_count"], obj_type_str, len(partitions))
+    )
+    return entry["row_count"]
@@ -4,7 +4,9 @@ from os.path import join
 from typing import Any, Dict, List
 
 from django.conf import settings
+from django.core.management import CommandError
 
+from cl.api.columnar import COLUMNAR_TYPES, FORMATS, make_columnar_bulk_data
 from cl.api.tasks import make_bulk_data_and_swap_it_in
 from cl.audio.api_serializers import AudioSerializer
 from cl.audio.models import Audio
@@ -38,8 +40,37 @@ from cl.search.models import Court, Docket, Opinion, OpinionCluster
 class Command(VerboseCommand):
     help = 'Create the bulk files for all jurisdictions and for "all".'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="How many worker processes to serialize objects with. "
+            "Defaults to the number of CPUs.",
+        )
+        parser.add_argument(
+            "--format",
+            choices=("json",) + FORMATS,
+            default="json",
+            help="Make JSON tarballs, or columnar files for %s. Columnar "
+            "files are kept in snapshots, and only rows that changed since "
+            "the last run are exported, along with the ids of the ones that "
+            "were deleted." % ", ".join(COLUMNAR_TYPES),
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            default=False,
+            help="For columnar formats, make a full snapshot even if a "
+            "snapshot of the changes would do.",
+        )
+
     def handle(self, *args: List[str], **options: Dict[str, Any]):
         super(Command, self).handle(*args, **options)
+        if options["format"] != "json":
+            self.make_columnar_data(options["format"], options["full"])
+            return
+
         courts = Court.objects.all()
 
         kwargs_list = [
@@ -48,18 +79,39 @@ class Command(VerboseCommand):
                 "obj_class": OpinionCluster,
                 "court_attr": "docket.court_id",
                 "serializer": OpinionClusterSerializer,
+                "prefetch_related": ("citations",),
+                "prefetch_only": {
+                    "panel": (),
+                    "non_participating_judges": (),
+                    "sub_opinions": (),
+                },
             },
             {
                 "obj_type_str": "opinions",
                 "obj_class": Opinion,
                 "court_attr": "cluster.docket.court_id",
                 "serializer": OpinionSerializer,
+                "prefetch_only": {
+                    "cluster": ("slug",),
+                    "opinions_cited": (),
+                    "joined_by": (),
+                },
             },
             {
                 "obj_type_str": "dockets",
                 "obj_class": Docket,
                 "court_attr": "court_id",
                 "serializer": DocketSerializer,
+                "select_related": (
+                    "originating_court_information",
+                    "idb_data",
+                ),
+                "prefetch_only": {
+                    "clusters": (),
+                    "audio_files": (),
+                    "tags": (),
+                    "panel": (),
+                },
             },
             {
                 "obj_type_str": "courts",
@@ -72,12 +124,21 @@ class Command(VerboseCommand):
                 "obj_class": Audio,
                 "court_attr": "docket.court_id",
                 "serializer": AudioSerializer,
+                "prefetch_only": {"docket": ("slug",), "panel": ()},
             },
             {
                 "obj_type_str": "people",
                 "obj_class": Person,
                 "court_attr": None,
                 "serializer": PersonSerializer,
+                "prefetch_related": (
+                    "race",
+                    "sources",
+                    "aba_ratings",
+                    "educations__school",
+                    "political_affiliations",
+                ),
+                "prefetch_only": {"positions": ()},
             },
             {
                 "obj_type_str": "schools",
@@ -90,6 +151,22 @@ class Command(VerboseCommand):
                 "obj_class": Position,
                 "court_attr": None,
                 "serializer": PositionSerializer,
+                "select_related": (
+                    "person",
+                    "supervisor",
+                    "predecessor",
+                    "school",
+                    "court",
+                ),
+                "prefetch_related": (
+                    "retention_events",
+                    "person__race",
+                    "person__sources",
+                    "person__aba_ratings",
+                    "person__educations__school",
+                    "person__positions",
+                    "person__political_affiliations",
+                ),
             },
             {
                 "obj_type_str": "retention-events",
@@ -102,6 +179,7 @@ class Command(VerboseCommand):
                 "obj_class": Education,
                 "court_attr": None,
                 "serializer": EducationSerializer,
+                "select_related": ("school",),
             },
             {
                 "obj_type_str": "politicial-affiliations",
@@ -112,12 +190,12 @@ class Command(VerboseCommand):
         ]
 
         logger.info(
-            "Starting bulk file creation with %s celery tasks..."
-            % len(kwargs_list)
+            "Starting bulk file creation of %s types with %s processes..."
+            % (len(kwargs_list), options["processes"])
         )
         for kwargs in kwargs_list:
             make_bulk_data_and_swap_it_in(
-                courts, settings.BULK_DATA_DIR, kwargs
+                courts, settings.BULK_DATA_DIR, kwargs, options["processes"]
             )
 
         # Make the citation bulk data
@@ -136,6 +214,23 @@ class Command(VerboseCommand):
 
         logger.info("Done.\n")
 
+    @staticmethod
+    def make_columnar_data(file_format: str, full: bool) -> None:
+        if file_format == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise CommandError("Parquet files need pyarrow installed.")
+        bulk_dir = join(settings.BULK_DATA_DIR, "columnar")
+        for obj_type_str in COLUMNAR_TYPES:
+            logger.info(
+                " - Creating columnar %s data for %s...",
+                file_format,
+                obj_type_str,
+            )
+            make_columnar_bulk_data(obj_type_str, bulk_dir, file_format, full)
+        logger.info("Done.\n")
+
     @staticmethod
     def make_citation_data(tmp_destination: str) -> None:
         """Because citations are paginated and because as of this moment there
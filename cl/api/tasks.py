@@ -1,11 +1,18 @@
 import glob
+import gzip
+import multiprocessing
 import os
 import shutil
 import tarfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from os.path import join
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from django.db.models import QuerySet
+from django.db import connection, connections
+from django.db.models import F, Max, Min, Prefetch, QuerySet
 from django.test import RequestFactory
 from rest_framework.renderers import JSONRenderer
 from rest_framework.versioning import URLPathVersioning
@@ -16,30 +23,448 @@ from cl.lib.db_tools import queryset_generator
 from cl.lib.timer import print_timing
 from cl.lib.utils import deepgetattr, mkdir_p
 
+# Tar archives end with two empty blocks. The parts we write leave them off so
+# that they can be concatenated, and the marker is added when they are.
+TAR_END_OF_ARCHIVE = b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+class CachedURLPathVersioning(URLPathVersioning):
+    """URL path versioning that remembers the shape of each detail URL.
+
+    Reversing a URL is slow, and serializers reverse several of them for every
+    object. Detail URLs only differ by their pk, so we reverse each view once
+    with a placeholder pk and fill in the real pk after that.
+    """
+
+    placeholder = "31415926535897932384"
+
+    def __init__(self) -> None:
+        self.templates: Dict[str, str] = {}
+
+    def reverse(
+        self,
+        viewname,
+        args=None,
+        kwargs=None,
+        request=None,
+        format=None,
+        **extra,
+    ):
+        if args or format or extra or not kwargs or list(kwargs) != ["pk"]:
+            return super(CachedURLPathVersioning, self).reverse(
+                viewname, args, kwargs, request, format, **extra
+            )
+        template = self.templates.get(viewname)
+        if template is None:
+            template = super(CachedURLPathVersioning, self).reverse(
+                viewname, kwargs={"pk": self.placeholder}, request=request
+            )
+            self.templates[viewname] = template
+        head, _, tail = template.rpartition(self.placeholder)
+        return "%s%s%s" % (head, kwargs["pk"], tail)
+
+
+def make_serializer_context() -> Dict[str, Any]:
+    """Make a serializer context that renders production URLs."""
+    r = RequestFactory().request()
+    r.META["SERVER_NAME"] = "www.courtlistener.com"  # Else, it's testserver
+    r.META["SERVER_PORT"] = "443"  # Else, it's 80
+    r.META["wsgi.url_scheme"] = "https"  # Else, it's http.
+    r.version = "v3"
+    r.versioning_scheme = CachedURLPathVersioning()
+    return dict(request=r)
+
+
+def get_bulk_queryset(
+    obj_class: Any,
+    select_related: Iterable[str] = (),
+    prefetch_related: Iterable[str] = (),
+    prefetch_only: Optional[Dict[str, Tuple[str, ...]]] = None,
+) -> QuerySet:
+    """Make a queryset that fetches everything a serializer needs up front.
+
+    :param obj_class: The model to query.
+    :param select_related: Relations to join in.
+    :param prefetch_related: Relations to prefetch in full, usually because
+    they're serialized in full.
+    :param prefetch_only: Relations to prefetch with only a few of their
+    fields, usually because they're serialized as hyperlinks that only need
+    the pk. Maps relation names to the fields to load besides the pk.
+    :return: A queryset of obj_class.
+    """
+    qs = obj_class.objects.all()
+    if select_related:
+        qs = qs.select_related(*select_related)
+    if prefetch_related:
+        qs = qs.prefetch_related(*prefetch_related)
+    for name, fields in (prefetch_only or {}).items():
+        field = obj_class._meta.get_field(name)
+        fields = ("pk",) + tuple(fields)
+        if field.one_to_many:
+            # Reverse foreign keys are matched up using their foreign key.
+            fields += (field.field.attname,)
+        qs = qs.prefetch_related(
+            Prefetch(name, queryset=field.related_model.objects.only(*fields))
+        )
+    return qs
+
+
+def get_court_lookup(court_attr: str) -> str:
+    """Turn a court attribute, like docket.court_id, into a lookup."""
+    lookup = court_attr.replace(".", "__")
+    if lookup.endswith("_id"):
+        lookup = lookup[: -len("_id")]
+    return lookup
+
+
+def make_tar_member(name: str, data: bytes, mtime: float) -> bytes:
+    """Make the header, data and padding for a file in a tar archive."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    remainder = len(data) % tarfile.BLOCKSIZE
+    padding = b"\0" * (tarfile.BLOCKSIZE - remainder) if remainder else b""
+    return info.tobuf(tarfile.DEFAULT_FORMAT) + data + padding
+
+
+class TarPartWriter(object):
+    """Write files into gzipped tar parts, one per archive, for a pk range.
+
+    Parts don't end with the end-of-archive marker, so they can be joined
+    into a complete archive later by concatenating them. Only a limited
+    number of parts are kept open at once. When a part is reopened, it's
+    appended to as a new gzip member, which gzip readers handle fine.
+    """
+
+    max_open_files = 64
+
+    def __init__(
+        self, part_dir: str, range_start: Any, compresslevel: int = 3
+    ) -> None:
+        self.part_dir = part_dir
+        self.part_name = "%s.tar.gz" % range_start
+        self.compresslevel = compresslevel
+        self.files: "OrderedDict[str, gzip.GzipFile]" = OrderedDict()
+
+    def get_file(self, archive: str) -> gzip.GzipFile:
+        f = self.files.pop(archive, None)
+        if f is None:
+            if len(self.files) >= self.max_open_files:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            path = join(self.part_dir, archive)
+            mkdir_p(path)
+            f = gzip.open(
+                join(path, self.part_name),
+                "ab",
+                compresslevel=self.compresslevel,
+            )
+        self.files[archive] = f
+        return f
+
+    def add(self, archive: str, name: str, data: bytes, mtime: float) -> None:
+        self.get_file(archive).write(make_tar_member(name, data, mtime))
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def write_bulk_data_range(
+    obj_class: Any,
+    court_attr: Optional[str],
+    serializer: HyperlinkedModelSerializerWithId,
+    query_kwargs: Dict[str, Any],
+    last_good_date: Optional[datetime],
+    part_dir: str,
+    start: Any,
+    end: Any,
+    chunk_size: int = 1000,
+) -> int:
+    """Serialize a range of objects into tar parts, one per court.
+
+    This runs in the worker processes of the bulk data pool, so it only takes
+    arguments that are cheap to pickle.
+
+    :param obj_class: The model to serialize.
+    :param court_attr: How to get the court ID from an object, or None if the
+    objects aren't split up by court.
+    :param serializer: The DRF serializer to use.
+    :param query_kwargs: Arguments for get_bulk_queryset.
+    :param last_good_date: If set, only serialize objects modified since then.
+    :param part_dir: Where to write the parts.
+    :param start: The first pk in the range, or None to start at the start.
+    :param end: The pk after the last one in the range, or None to go to the
+    end.
+    :param chunk_size: How many objects to pull from the DB at a time.
+    :return: The number of objects written.
+    """
+    qs = get_bulk_queryset(obj_class, **query_kwargs).order_by("pk")
+    if last_good_date is not None:
+        qs = qs.filter(date_modified__gte=last_good_date)
+    if start is not None:
+        qs = qs.filter(pk__gte=start)
+    if end is not None:
+        qs = qs.filter(pk__lt=end)
+    if court_attr is not None:
+        qs = qs.annotate(bulk_court_id=F(get_court_lookup(court_attr)))
+
+    renderer = JSONRenderer()
+    context = make_serializer_context()
+    writer = TarPartWriter(part_dir, start if start is not None else 0)
+    mtime = int(time.time())
+    count = 0
+    last_pk = None
+    try:
+        while True:
+            chunk_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+            items = list(chunk_qs[:chunk_size])
+            if not items:
+                break
+            for item in items:
+                json_str = renderer.render(
+                    serializer(item, context=context).data,
+                    accepted_media_type="application/json; indent=2",
+                )
+                archive = (
+                    item.bulk_court_id if court_attr is not None else "all"
+                )
+                writer.add(archive, "%s.json" % item.pk, json_str, mtime)
+            count += len(items)
+            last_pk = items[-1].pk
+    finally:
+        writer.close()
+    return count
+
+
+def make_pk_ranges(qs: QuerySet, range_count: int) -> List[Tuple[Any, Any]]:
+    """Split the pks of a queryset into about range_count ranges.
+
+    Models without integer pks get one range that covers everything.
+    """
+    bounds = qs.aggregate(lowest=Min("pk"), highest=Max("pk"))
+    lowest, highest = bounds["lowest"], bounds["highest"]
+    if not isinstance(lowest, int):
+        return [(None, None)]
+    step = max((highest - lowest) // max(range_count, 1) + 1, 1000)
+    return [
+        (range_start, range_start + step)
+        for range_start in range(lowest, highest + 1, step)
+    ]
+
+
+def get_member_names(paths: Iterable[str]) -> set:
+    """Get the names of the files in some gzipped tar parts or archives."""
+    names = set()
+    for path in paths:
+        with tarfile.open(path, "r:gz") as tar:
+            names.update(member.name for member in tar)
+    return names
+
+
+def assemble_archive(
+    dest: str, part_paths: List[str], previous: Optional[str] = None
+) -> None:
+    """Join the parts of an archive into a complete tar.gz file.
+
+    Parts are concatenated as they are, without recompressing them.
+
+    :param dest: Where to write the archive.
+    :param part_paths: The parts to join, in order.
+    :param previous: A previous version of the archive. Any files in it that
+    aren't in the parts are carried over into the new archive.
+    """
+    with open(dest, "wb") as out:
+        if previous is not None and os.path.exists(previous):
+            replaced = get_member_names(part_paths)
+            with gzip.GzipFile(
+                fileobj=out, mode="wb", compresslevel=3
+            ) as gz, tarfile.open(previous, "r:gz") as tar:
+                for member in tar:
+                    if not member.isfile() or member.name in replaced:
+                        continue
+                    data = tar.extractfile(member).read()
+                    gz.write(make_tar_member(member.name, data, member.mtime))
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, out)
+        out.write(gzip.compress(TAR_END_OF_ARCHIVE, compresslevel=3))
+
+
+def write_bulk_data_archives(
+    courts: QuerySet,
+    obj_type_str: str,
+    obj_class: Any,
+    court_attr: Optional[str],
+    serializer: HyperlinkedModelSerializerWithId,
+    bulk_dir: str,
+    tmp_bulk_dir: str,
+    processes: int = 1,
+    select_related: Iterable[str] = (),
+    prefetch_related: Iterable[str] = (),
+    prefetch_only: Optional[Dict[str, Tuple[str, ...]]] = None,
+) -> int:
+    """Stream serialized objects straight into tar.gz archives.
+
+    A pool of worker processes each serialize a range of pks into gzipped tar
+    parts, one per court. When they're done, the parts for each court are
+    concatenated into that court's archive. This avoids writing a JSON file
+    for every object and then reading them all back in again.
+
+    If we've made bulk files before, only the objects that were modified
+    since the last good run are serialized. They're merged with the files
+    in the previous archives, and the archives of courts that didn't change
+    are left alone.
+
+    :param courts: Court objects that you expect to make data for.
+    :param obj_type_str: A string to use for the directory name of a type of
+    data. For example, for clusters, it's 'clusters'.
+    :param obj_class: The actual class to make a bulk data for.
+    :param court_attr: A string that can be used to find the court attribute
+    on an object. For example, on clusters, this is currently docket.court_id.
+    :param serializer: A DRF serializer to use to generate the data.
+    :param bulk_dir: The directory with the current archives.
+    :param tmp_bulk_dir: A directory to build the new archives in.
+    :param processes: How many worker processes to use.
+    :param select_related: Relations the serializer needs, to join in.
+    :param prefetch_related: Relations the serializer needs, to prefetch.
+    :param prefetch_only: Relations the serializer needs a few fields of, to
+    prefetch. See get_bulk_queryset.
+
+    :returns int: The number of items generated
+    """
+    history = BulkJsonHistory(obj_type_str, tmp_bulk_dir)
+    last_good_date = history.get_last_good_date()
+    history.add_current_attempt_and_save()
+
+    root_path = join(tmp_bulk_dir, obj_type_str)
+    final_path = join(bulk_dir, obj_type_str)
+    part_dir = join(root_path, "parts")
+    shutil.rmtree(part_dir, ignore_errors=True)
+    mkdir_p(root_path)
+
+    qs = obj_class.objects.all()
+    if last_good_date is not None:
+        print(
+            "   - Incremental data found. Assuming it's good and using it..."
+        )
+        qs = qs.filter(date_modified__gte=last_good_date)
+    else:
+        print("   - Incremental data not found. Working from scratch...")
+
+    if not qs.exists():
+        print(
+            "   - No %s-type items in the DB or none that have changed. All "
+            "done here." % obj_type_str
+        )
+        history.mark_success_and_save()
+        return 0
+
+    query_kwargs = {
+        "select_related": tuple(select_related),
+        "prefetch_related": tuple(prefetch_related),
+        "prefetch_only": prefetch_only,
+    }
+    ranges = make_pk_ranges(qs, processes * 4)
+    range_args = [
+        (
+            obj_class,
+            court_attr,
+            serializer,
+            query_kwargs,
+            last_good_date,
+            part_dir,
+            range_start,
+            range_end,
+        )
+        for range_start, range_end in ranges
+    ]
+    # Workers use their own DB connections, so they can't see anything in an
+    # uncommitted transaction, like the ones tests run in.
+    if processes > 1 and len(ranges) > 1 and not connection.in_atomic_block:
+        # Don't share the parent's connections with the workers.
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("fork"),
+        ) as executor:
+            counts = []
+            for count in executor.map(
+                write_bulk_data_range, *zip(*range_args)
+            ):
+                counts.append(count)
+                print(
+                    "Completed %s of %s ranges, with %s items so far."
+                    % (len(counts), len(ranges), sum(counts))
+                )
+    else:
+        counts = [write_bulk_data_range(*args) for args in range_args]
+    num_written = sum(counts)
+
+    print("   - Joining the %s parts into archives..." % obj_type_str)
+    if court_attr is not None:
+        archives = [court.pk for court in courts]
+    else:
+        # Non-jurisdictional-centric object type (like an ABA Rating)
+        archives = ["all"]
+    for archive in archives:
+        part_paths = sorted(
+            glob.glob(join(part_dir, archive, "*.tar.gz")),
+            key=lambda p: int(os.path.basename(p).split(".")[0]),
+        )
+        previous = join(final_path, "%s.tar.gz" % archive)
+        if last_good_date is not None and os.path.exists(previous):
+            if not part_paths:
+                # Nothing changed, so the current archive is still good.
+                continue
+        else:
+            previous = None
+        assemble_archive(
+            join(root_path, "%s.tar.gz" % archive), part_paths, previous
+        )
+    shutil.rmtree(part_dir, ignore_errors=True)
+
+    if court_attr is not None:
+        # Make the all.tar file by tarring up the court archives, using the
+        # current one for any court that didn't change.
+        with tarfile.open(join(root_path, "all.tar"), "w") as tar:
+            for archive in archives:
+                name = "%s.tar.gz" % archive
+                path = join(root_path, name)
+                if not os.path.exists(path):
+                    path = join(final_path, name)
+                if os.path.exists(path):
+                    tar.add(path, arcname=name)
+
+    print("   - %s %s items written." % (num_written, obj_type_str))
+    history.mark_success_and_save()
+    return num_written
+
 
 @app.task
 @print_timing
 def make_bulk_data_and_swap_it_in(
     courts: QuerySet,
     bulk_dir: str,
-    kwargs: Dict[str, str],
+    kwargs: Dict[str, Any],
+    processes: int = 1,
 ) -> None:
     """We can't wrap the handle() function, but we can wrap this one."""
     # Create a directory where we'll put temporary files
     tmp_bulk_dir = join(bulk_dir, "tmp")
 
     print(" - Creating bulk %s files..." % kwargs["obj_type_str"])
-    num_written = write_json_to_disk(courts, bulk_dir=tmp_bulk_dir, **kwargs)
+    num_written = write_bulk_data_archives(
+        courts,
+        bulk_dir=bulk_dir,
+        tmp_bulk_dir=tmp_bulk_dir,
+        processes=processes,
+        **kwargs,
+    )
 
     if num_written > 0:
-        print(
-            "   - Tarring and compressing all %s files..."
-            % kwargs["obj_type_str"]
-        )
-        targz_json_files(
-            courts, tmp_bulk_dir, kwargs["obj_type_str"], kwargs["court_attr"]
-        )
-
         print(
             "   - Swapping in the new %s archives..." % kwargs["obj_type_str"]
         )
@@ -71,40 +496,6 @@ def swap_archives(
             raise
 
 
-def targz_json_files(
-    courts: QuerySet,
-    bulk_dir: str,
-    obj_type_str: str,
-    court_attr: str,
-) -> None:
-    """Create gz-compressed archives using the JSON on disk."""
-
-    root_path = join(bulk_dir, obj_type_str)
-    if court_attr is not None:
-        for court in courts:
-            tar_path = join(root_path, "%s.tar.gz" % court.pk)
-            tar = tarfile.open(tar_path, "w:gz", compresslevel=3)
-            for name in glob.glob(join(root_path, court.pk, "*.json")):
-                tar.add(name, arcname=os.path.basename(name))
-            tar.close()
-    else:
-        # Non-jurisdictional-centric object type (like an ABA Rating)
-        tar_path = join(root_path, "all.tar.gz")
-        tar = tarfile.open(tar_path, "w:gz", compresslevel=3)
-        for name in glob.glob(join(root_path, "*.json")):
-            tar.add(name, arcname=os.path.basename(name))
-        tar.close()
-
-    if court_attr is not None:
-        # Make the all.tar file by tarring up the other files.
-        # Non-court-centric objects already did this.
-        tar = tarfile.open(join(root_path, "all.tar"), "w")
-        for court in courts:
-            targz = join(root_path, "%s.tar.gz" % court.pk)
-            tar.add(targz, arcname=os.path.basename(targz))
-        tar.close()
-
-
 def write_json_to_disk(
     courts: QuerySet,
     obj_type_str: str,
@@ -176,15 +567,7 @@ def write_json_to_disk(
 
         i = 0
         renderer = JSONRenderer()
-        r = RequestFactory().request()
-        r.META[
-            "SERVER_NAME"
-        ] = "www.courtlistener.com"  # Else, it's testserver
-        r.META["SERVER_PORT"] = "443"  # Else, it's 80
-        r.META["wsgi.url_scheme"] = "https"  # Else, it's http.
-        r.version = "v3"
-        r.versioning_scheme = URLPathVersioning()
-        context = dict(request=r)
+        context = make_serializer_context()
         for item in item_list:
             if i % 1000 == 0:
                 print("Completed %s items so far." % i)
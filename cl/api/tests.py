@@ -1,5 +1,9 @@
+import csv
+import gzip
 import json
+import os
 import shutil
+import tarfile
 from datetime import date, timedelta
 from pathlib import Path
 from typing import Any, Dict
@@ -22,7 +26,7 @@ from django.urls import ResolverMatch, reverse
 from django.utils.timezone import now
 from rest_framework.status import HTTP_200_OK, HTTP_403_FORBIDDEN
 
-from cl.api.utils import BulkJsonHistory
+from cl.api.utils import BulkJsonHistory, KeysetPagination
 from cl.api.views import coverage_data
 from cl.audio.api_views import AudioViewSet
 from cl.audio.models import Audio
@@ -305,6 +309,28 @@ class DRFOrderingTests(TestCase):
             r.data["results"][-1]["resource_uri"],
         )
 
+    @mock.patch.object(KeysetPagination, "page_size", 2)
+    def test_keyset_pagination(self):
+        """Does keyset pagination walk every item in order, without counts?"""
+        path = reverse("opinion-list", kwargs={"version": "v3"})
+        for ordering in ("date_modified", "-date_modified", "-id"):
+            r = self.client.get(path, {"order_by": ordering, "cursor": ""})
+            self.assertNotIn("count", r.data)
+            ids = []
+            while True:
+                ids.extend(result["id"] for result in r.data["results"])
+                if not r.data["next"]:
+                    break
+                r = self.client.get(r.data["next"])
+            direction = "-" if ordering.startswith("-") else ""
+            expected = Opinion.objects.order_by(
+                ordering, direction + "pk"
+            ).values_list("pk", flat=True)
+            self.assertEqual(ids, list(expected))
+
+        r = self.client.get(path, {"cursor": "garbage"})
+        self.assertEqual(r.status_code, 404)
+
 
 class FilteringCountTestCase(object):
     """Mixin for adding an additional test assertion."""
@@ -966,6 +992,87 @@ class BulkDataTest(TestCase):
         """Can we successfully generate all bulk files?"""
         call_command("cl_make_bulk_data")
 
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_bulk_archives_are_merged_incrementally(self) -> None:
+        """Do the archives hold every item, and do incremental runs keep the
+        items that didn't change?
+        """
+        call_command("cl_make_bulk_data")
+        path = os.path.join(self.tmp_data_dir, "opinions", "test.tar.gz")
+        expected = {
+            "%s.json" % pk
+            for pk in Opinion.objects.filter(
+                cluster__docket__court_id="test"
+            ).values_list("pk", flat=True)
+        }
+        with tarfile.open(path) as tar:
+            self.assertEqual(set(tar.getnames()), expected)
+
+        opinion = Opinion.objects.filter(cluster=self.doc_cluster).first()
+        Opinion.objects.filter(pk=opinion.pk).update(
+            plain_text="updated", date_modified=now()
+        )
+        call_command("cl_make_bulk_data")
+        with tarfile.open(path) as tar:
+            self.assertEqual(set(tar.getnames()), expected)
+            data = json.load(tar.extractfile("%s.json" % opinion.pk))
+        self.assertEqual(data["plain_text"], "updated")
+        self.assertTrue(
+            data["resource_uri"].endswith("/opinions/%s/" % opinion.pk)
+        )
+
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_make_columnar_bulk_files(self) -> None:
+        """Can we make CSV snapshots, and are later runs deltas?"""
+        call_command("cl_make_bulk_data", format="csv")
+        opinions_dir = os.path.join(self.tmp_data_dir, "columnar", "opinions")
+        with open(os.path.join(opinions_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["format"], "csv")
+        self.assertIn(
+            {"name": "cluster_id", "type": "int64"}, manifest["columns"]
+        )
+        snapshot = manifest["snapshots"][0]
+        self.assertEqual(snapshot["kind"], "full")
+        with gzip.open(
+            os.path.join(opinions_dir, snapshot["path"], "test.csv.gz"), "rt"
+        ) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            {int(row["id"]) for row in rows},
+            set(
+                Opinion.objects.filter(
+                    cluster__docket__court_id="test"
+                ).values_list("pk", flat=True)
+            ),
+        )
+
+        opinion = Opinion.objects.filter(cluster=self.doc_cluster).first()
+        Opinion.objects.filter(pk=opinion.pk).update(date_modified=now())
+        call_command("cl_make_bulk_data", format="csv")
+        with open(os.path.join(opinions_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(
+            [s["kind"] for s in manifest["snapshots"]], ["full", "delta"]
+        )
+        self.assertEqual(manifest["snapshots"][1]["row_count"], 1)
+        self.assertEqual(manifest["snapshots"][1]["deleted_count"], 0)
+
+        # Deletions are listed in the next delta.
+        deleted = Opinion.objects.exclude(pk=opinion.pk).first()
+        deleted_pk = deleted.pk
+        deleted.delete()
+        call_command("cl_make_bulk_data", format="csv")
+        with open(os.path.join(opinions_dir, "manifest.json")) as f:
+            snapshot = json.load(f)["snapshots"][2]
+        self.assertEqual(snapshot["kind"], "delta")
+        self.assertEqual(snapshot["deleted_count"], 1)
+        with gzip.open(
+            os.path.join(opinions_dir, snapshot["path"], "deleted.txt.gz"),
+            "rt",
+        ) as f:
+            self.assertEqual(f.read(), "%s\n" % deleted_pk)
+
     def test_database_has_objects_for_bulk_export(self) -> None:
         # This is a very weird test. It's essentially just testing the
         # setUp function, which...OK?
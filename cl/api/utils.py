@@ -1,17 +1,22 @@
+import base64
 import json
 import logging
 import os
 from collections import OrderedDict, defaultdict
 from datetime import date, datetime
-from typing import Dict, List, Set, Union
+from decimal import Decimal
+from typing import Any, Dict, List, Set, Tuple, Union
 
 from dateutil import parser
 from dateutil.rrule import DAILY, rrule
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import intcomma, ordinal
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core.mail import send_mail
 from django.db import connections
+from django.db.models import Q
 from django.urls import resolve
 from django.utils.decorators import method_decorator
 from django.utils.encoding import force_str
@@ -19,11 +24,14 @@ from django.utils.timezone import now
 from django.views.decorators.cache import cache_page
 from django.views.decorators.vary import vary_on_headers
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.metadata import SimpleMetadata
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import BasePermission, DjangoModelPermissions
 from rest_framework.request import clone_request
+from rest_framework.response import Response
 from rest_framework.throttling import UserRateThrottle
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework_filters import RelatedFilter
 from rest_framework_filters.backends import RestFrameworkFilterBackend
 
@@ -376,12 +384,161 @@ class DisclosureAPIUsers(DjangoModelPermissions):
     }
 
 
-class MediumAdjustablePagination(PageNumberPagination):
+class KeysetPagination(PageNumberPagination):
+    """Page number pagination, with an opt-in keyset mode for deep crawls.
+
+    Page numbers are turned into an OFFSET and need a COUNT of the whole
+    result set, both of which get slow on big tables. If the request has a
+    cursor parameter, even an empty one, we instead page through the results
+    by the value of the ordering field and the ID of the last item on the
+    page, which can use an index no matter how deep we are. Keyset pages
+    don't have a count or a previous link.
+
+    Keyset pages only use the first ordering field, with the ID breaking
+    ties, so they work with whatever ordering_fields a view allows.
+    """
+
+    cursor_query_param = "cursor"
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super(KeysetPagination, self).paginate_queryset(
+                queryset, request, view
+            )
+
+        self.request = request
+        self.display_page_controls = False
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        field_name, descending = self.get_keyset_ordering(queryset)
+        direction = "-" if descending else ""
+        ordering = [direction + "pk"]
+        if field_name != "pk":
+            ordering.insert(0, direction + field_name)
+        queryset = queryset.order_by(*ordering)
+
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            queryset = queryset.filter(
+                self.decode_cursor(cursor, queryset, field_name, ordering)
+            )
+
+        results = list(queryset[: page_size + 1])
+        self.next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            last = results[-1]
+            value = None
+            if field_name != "pk":
+                value = getattr(last, field_name)
+                if isinstance(value, (date, datetime)):
+                    value = value.isoformat()
+                elif isinstance(value, Decimal):
+                    value = str(value)
+            self.next_cursor = self.encode_cursor(ordering, value, last.pk)
+        return results
+
+    @staticmethod
+    def get_keyset_ordering(queryset) -> Tuple[str, bool]:
+        """Get the field the queryset is ordered by, and whether it's in
+        descending order.
+        """
+        ordering = list(queryset.query.order_by) or list(
+            queryset.model._meta.ordering
+        )
+        if not ordering or not isinstance(ordering[0], str):
+            return "pk", True
+        field_name = ordering[0].lstrip("-")
+        descending = ordering[0].startswith("-")
+        if field_name in ("id", "pk", queryset.model._meta.pk.name):
+            field_name = "pk"
+        else:
+            try:
+                queryset.model._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                raise ValidationError(
+                    "Keyset pagination can't order by %s." % field_name
+                )
+        return field_name, descending
+
+    def encode_cursor(self, ordering: List[str], value: Any, pk: Any) -> str:
+        cursor = json.dumps({"o": ordering, "v": value, "id": pk})
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(
+        self, cursor: str, queryset, field_name: str, ordering: List[str]
+    ) -> Q:
+        """Turn a cursor into a filter for the items after it.
+
+        Postgres puts nulls last in ascending order and first in descending
+        order, so a nullable field needs some extra conditions.
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if data["o"] != ordering:
+                raise ValueError("The ordering has changed.")
+            pk = queryset.model._meta.pk.to_python(data["id"])
+            value = data["v"]
+            if field_name != "pk" and value is not None:
+                value = queryset.model._meta.get_field(field_name).to_python(
+                    value
+                )
+        except (ValueError, TypeError, KeyError, DjangoValidationError):
+            raise NotFound("Invalid cursor.")
+
+        descending = ordering[0].startswith("-")
+        after = "lt" if descending else "gt"
+        pk_after = Q(**{"pk__%s" % after: pk})
+        if field_name == "pk":
+            return pk_after
+        if value is None:
+            is_null = Q(**{"%s__isnull" % field_name: True})
+            if descending:
+                return (is_null & pk_after) | ~is_null
+            return is_null & pk_after
+        q = Q(**{"%s__%s" % (field_name, after): value}) | (
+            Q(**{field_name: value}) & pk_after
+        )
+        if not descending:
+            q |= Q(**{"%s__isnull" % field_name: True})
+        return q
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if self.next_cursor is None:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param
+        )
+        return replace_query_param(
+            url, self.cursor_query_param, self.next_cursor
+        )
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_paginated_response(data)
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", None),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+class MediumAdjustablePagination(KeysetPagination):
     page_size = 50
     page_size_query_param = "page_size"
 
 
-class BigPagination(PageNumberPagination):
+class BigPagination(KeysetPagination):
     page_size = 300
 
 
@@ -451,10 +608,14 @@ class BulkJsonHistory(object):
         self.json["last_attempt"] = now().isoformat()
         self.save_to_disk()
 
-    def mark_success_and_save(self):
-        """Note a successful run."""
+    def mark_success_and_save(self, good_as_of=None):
+        """Note a successful run.
+
+        :param good_as_of: When the data is good as of, if that's not now.
+        For example, when the run started.
+        """
         n = now()
-        self.json["last_good_date"] = n.isoformat()
+        self.json["last_good_date"] = (good_as_of or n).isoformat()
         try:
             duration = n - parser.parse(self.json["last_attempt"])
             self.json["duration"] = int(duration.total_seconds())
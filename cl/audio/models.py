@@ -2,17 +2,16 @@ import json
 from typing import Dict, List, Union
 
 from django.db import models
-from django.template import loader
 from django.urls import NoReverseMatch, reverse
 
 from cl.custom_filters.templatetags.text_filters import best_case_name
 from cl.lib.date_time import midnight_pst
 from cl.lib.model_helpers import make_upload_path
 from cl.lib.models import AbstractDateTimeModel, s3_warning_note
+from cl.lib.search_index_text import render_index_text
 from cl.lib.search_index_utils import (
     InvalidDocumentError,
     normalize_search_dicts,
-    null_map,
 )
 from cl.lib.storage import IncrementingAWSMediaStorage
 from cl.lib.utils import deepgetattr
@@ -254,7 +253,8 @@ class Audio(AbstractDateTimeModel):
                 % self.pk
             )
 
-        text_template = loader.get_template("indexes/audio_text.txt")
-        out["text"] = text_template.render({"item": self}).translate(null_map)
+        out["text"] = render_index_text(
+            "indexes/audio_text.txt", {"item": self}
+        )
 
         return normalize_search_dicts(out)
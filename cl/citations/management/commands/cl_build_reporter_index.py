@@ -0,0 +1,45 @@
+from django.conf import settings
+
+from cl.citations.reporter_index import build_reporter_index
+from cl.lib.command_utils import VerboseCommand, logger
+
+
+class Command(VerboseCommand):
+    help = (
+        "Build or refresh the local index of reporter citations that citation "
+        "matching uses before it falls back to Solr. By default this only "
+        "picks up citations and clusters that changed since the last run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=settings.REPORTER_CITATION_INDEX_PATH,
+            help="Where the index should be kept.",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            default=False,
+            help="Build the index from scratch instead of refreshing it. Do "
+            "this occasionally to drop deleted citations.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="The number of citations or clusters to handle at a time.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        count = build_reporter_index(
+            options["path"],
+            rebuild=options["rebuild"],
+            chunk_size=options["chunk_size"],
+        )
+        logger.info(
+            "Wrote %s rows to the citation index at %s.",
+            count,
+            options["path"],
+        )
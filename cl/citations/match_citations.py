@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
 from datetime import date, datetime
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from django.conf import settings
 from eyecite import resolve_citations
@@ -15,8 +17,9 @@ from eyecite.models import (
 from eyecite.test_factories import case_citation
 from eyecite.utils import strip_punct
 
+from cl.citations.reporter_index import ReporterCitationIndex
 from cl.custom_filters.templatetags.text_filters import best_case_name
-from cl.lib.scorched_utils import ExtraSolrInterface, ExtraSolrSearch
+from cl.lib.scorched_utils import ExtraSolrInterface
 from cl.lib.types import SearchParam, SupportedCitationType
 from cl.search.models import Opinion
 
@@ -24,6 +27,14 @@ DEBUG = True
 
 QUERY_LENGTH = 10
 
+# How many candidates to pull back when looking up a citation. More than a
+# handful means the citation is ambiguous anyway.
+CITATION_QUERY_ROWS = 50
+
+SolrDoc = Dict[str, Any]
+# (base citation, start year, end year, court)
+CitationLookupKey = Tuple[str, int, int, Optional[str]]
+
 NO_MATCH_RESOURCE = Resource(
     case_citation(0, source_text="UNMATCHED_CITATION")
 )
@@ -49,9 +60,9 @@ def make_name_param(defendant: str, plaintiff: str = None) -> Tuple[str, int]:
 
 def reverse_match(
     conn: ExtraSolrInterface,
-    results: List[ExtraSolrSearch],
+    results: List[SolrDoc],
     citing_opinion: Opinion,
-) -> List[ExtraSolrSearch]:
+) -> List[SolrDoc]:
     """Uses the case name of the found document to verify that it is a match on
     the original.
     """
@@ -74,27 +85,38 @@ def reverse_match(
 
 def case_name_query(
     conn: ExtraSolrInterface,
-    params: SearchParam,
+    candidates: List[SolrDoc],
     citation: SupportedCitationType,
     citing_opinion: Opinion,
-) -> List[ExtraSolrSearch]:
+) -> List[SolrDoc]:
+    """Narrow down candidate matches using the case name in the citation.
+
+    This used to query Solr with a minimum match, starting by requiring every
+    word of the case name and dropping one word at a time until something
+    matched. Since every candidate is already in hand, we do the same thing
+    on the client: count how many of the words each candidate's case name
+    has, and keep the ones with the most. Those are the results the first
+    successful minimum match query would have returned.
+    """
     query, length = make_name_param(citation.defendant, citation.plaintiff)
-    params["q"] = "caseName:(%s)" % query
-    params["caller"] = "match_citations"
-    results = []
-    # Use Solr minimum match search, starting with requiring all words to
-    # match and decreasing by one word each time until a match is found
-    for num_words in range(length, 0, -1):
-        params["mm"] = num_words
-        new_results = conn.query().add_extra(**params).execute()
-        if len(new_results) >= 1:
-            # For 1 result, make sure case name of match actually appears in
-            # citing doc. For multiple results, use same technique to
-            # potentially narrow down
-            return reverse_match(conn, new_results, citing_opinion)
-            # Else, try again
-        results = new_results
-    return results
+    words = {w.lower() for w in query.split()}
+    best_count = 0
+    best = []
+    for candidate in candidates:
+        name_words = {
+            strip_punct(w).lower() for w in candidate["caseName"].split()
+        }
+        count = len(words & name_words)
+        if count > best_count:
+            best_count, best = count, [candidate]
+        elif count == best_count and count > 0:
+            best.append(candidate)
+    if not best:
+        return []
+    # For 1 result, make sure case name of match actually appears in citing
+    # doc. For multiple results, use same technique to potentially narrow
+    # down
+    return reverse_match(conn, best, citing_opinion)
 
 
 def get_years_from_reporter(
@@ -113,29 +135,106 @@ def get_years_from_reporter(
     return start_year, end_year
 
 
+class CitationResolutionSession(object):
+    """Shared state for resolving the citations in a batch of opinions.
+
+    The same reporter citations come up again and again across opinions, so
+    this holds one Solr connection for the whole batch and remembers the
+    result of each citation lookup, keyed on the citation, the year range and
+    the court.
+
+    If the local reporter citation index has been built, lookups go to it
+    first, and only go to Solr when it doesn't find exactly one match.
+    """
+
+    def __init__(
+        self,
+        max_cache_size: int = 10000,
+        index_path: Optional[str] = None,
+    ) -> None:
+        self.si = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode="r")
+        self.index = ReporterCitationIndex.open(
+            index_path or settings.REPORTER_CITATION_INDEX_PATH
+        )
+        self.max_cache_size = max_cache_size
+        self.cache: "OrderedDict[CitationLookupKey, List[SolrDoc]]" = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+        self.index_hits = 0
+
+    def lookup_citation(self, key: CitationLookupKey) -> List[SolrDoc]:
+        """Find the precedential opinions that have a citation.
+
+        :param key: A tuple of the base citation, the first and last years the
+        opinion could have been filed in, and the court, if known.
+        :return: A list of Solr documents with the ID, case name, URL and
+        filing date of every match.
+        """
+        try:
+            results = self.cache[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return results
+
+        base_citation, start_year, end_year, court = key
+        if self.index is not None:
+            # A single match from the index is as good as Solr's. Multiple
+            # matches need Solr to sort them out, and no match could just
+            # mean the opinion was added since the index was last refreshed.
+            results = self.index.lookup(*key)
+            if len(results) == 1:
+                self.index_hits += 1
+                self._cache_results(key, results)
+                return results
+
+        params: SearchParam = {
+            "q": "*",
+            "fq": [
+                "status:Precedential",  # Non-precedential docs aren't cited
+                "dateFiled:%s" % build_date_range(start_year, end_year),
+                'citation:("%s")' % base_citation,
+            ],
+            "fl": "id,caseName,absolute_url,dateFiled",
+            "rows": CITATION_QUERY_ROWS,
+            "caller": "citation.match_citations.match_citation",
+        }
+        if court:
+            params["fq"].append("court_exact:%s" % court)
+        results = list(self.si.query().add_extra(**params).execute())
+        self._cache_results(key, results)
+        return results
+
+    def _cache_results(
+        self, key: CitationLookupKey, results: List[SolrDoc]
+    ) -> None:
+        self.cache[key] = results
+        if len(self.cache) > self.max_cache_size:
+            self.cache.popitem(last=False)
+
+
 def search_db_for_fullcitation(
     full_citation: FullCaseCitation,
-) -> List[ExtraSolrSearch]:
+    session: Optional[CitationResolutionSession] = None,
+) -> List[SolrDoc]:
     """For a citation object, try to match it to an item in the database using
     a variety of heuristics.
-    Returns:
-      - a Solr Result object with the results, or an empty list if no hits
+
+    :param full_citation: The citation to match.
+    :param session: A session to share a connection and cached lookups with
+    other citations in the same batch. If None, a new one is made.
+    :return: A list of Solr documents with the ID, case name, URL and filing
+    date of each hit, or an empty list if there are none.
     """
     if not hasattr(full_citation, "citing_opinion"):
         full_citation.citing_opinion = None
+    if session is None:
+        session = CitationResolutionSession()
 
-    # TODO: Create shared solr connection for all queries
-    si = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode="r")
-    main_params: SearchParam = {
-        "q": "*",
-        "fq": [
-            "status:Precedential",  # Non-precedential documents aren't cited
-        ],
-        "caller": "citation.match_citations.match_citation",
-    }
-    if full_citation.citing_opinion is not None:
-        # Eliminate self-cites.
-        main_params["fq"].append("-id:%s" % full_citation.citing_opinion.pk)
     # Set up filter parameters
     if full_citation.year:
         start_year = end_year = full_citation.year
@@ -148,17 +247,24 @@ def search_db_for_fullcitation(
             end_year = min(
                 end_year, full_citation.citing_opinion.cluster.date_filed.year
             )
-    main_params["fq"].append(
-        "dateFiled:%s" % build_date_range(start_year, end_year)
-    )
-
-    if full_citation.court:
-        main_params["fq"].append("court_exact:%s" % full_citation.court)
 
     # Take 1: Use a phrase query to search the citation field.
-    main_params["fq"].append('citation:("%s")' % full_citation.base_citation())
-    results = si.query().add_extra(**main_params).execute()
-    si.conn.http_connection.close()
+    results = session.lookup_citation(
+        (
+            full_citation.base_citation(),
+            start_year,
+            end_year,
+            full_citation.court or None,
+        )
+    )
+    if full_citation.citing_opinion is not None:
+        # Eliminate self-cites. This is done here rather than in the query so
+        # that lookups can be shared between citing opinions.
+        results = [
+            r
+            for r in results
+            if int(r["id"]) != full_citation.citing_opinion.pk
+        ]
     if len(results) == 1:
         return results
     if len(results) > 1:
@@ -167,7 +273,10 @@ def search_db_for_fullcitation(
             and full_citation.defendant
         ):  # Refine using defendant, if there is one
             results = case_name_query(
-                si, main_params, full_citation, full_citation.citing_opinion
+                session.si,
+                results,
+                full_citation,
+                full_citation.citing_opinion,
             )
             return results
 
@@ -196,9 +305,10 @@ def filter_by_matching_antecedent(
 
 def resolve_fullcase_citation(
     full_citation: FullCaseCitation,
+    session: Optional[CitationResolutionSession] = None,
 ) -> Union[Opinion, Resource]:
-    db_search_results: List[ExtraSolrSearch] = search_db_for_fullcitation(
-        full_citation
+    db_search_results: List[SolrDoc] = search_db_for_fullcitation(
+        full_citation, session
     )
 
     # If there is one search result, try to return it
@@ -250,8 +360,23 @@ def resolve_supra_citation(
 
 
 def do_resolve_citations(
-    citations: List[CitationBase], citing_opinion: Opinion
+    citations: List[CitationBase],
+    citing_opinion: Opinion,
+    session: Optional[CitationResolutionSession] = None,
 ) -> Dict[Union[Opinion, Resource], List[SupportedCitationType]]:
+    """Resolve the citations in an opinion to the opinions they refer to.
+
+    :param citations: The citations found in the opinion.
+    :param citing_opinion: The opinion the citations were found in.
+    :param session: A session to share with the other opinions in a batch,
+    so that repeated citations don't cost repeated Solr queries. If None, a
+    new one is made.
+    :return: A dict mapping resolved opinions (or NO_MATCH_RESOURCE) to the
+    citations that refer to them.
+    """
+    if session is None:
+        session = CitationResolutionSession()
+
     # Set the citing opinion on FullCaseCitation objects for later matching
     for c in citations:
         if type(c) is FullCaseCitation:
@@ -260,7 +385,9 @@ def do_resolve_citations(
     # Call and return eyecite's resolve_citations() function
     return resolve_citations(
         citations=citations,
-        resolve_fullcase_citation=resolve_fullcase_citation,
+        resolve_fullcase_citation=partial(
+            resolve_fullcase_citation, session=session
+        ),
         resolve_shortcase_citation=resolve_shortcase_citation,
         resolve_supra_citation=resolve_supra_citation,
     )
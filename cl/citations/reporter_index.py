@@ -0,0 +1,270 @@
+"""A local index of reporter citations, so they can be resolved without Solr.
+
+Every row in the index maps a normalized "volume reporter page" string to one
+opinion in the cluster that has that citation, along with the handful of
+fields that citation matching filters and displays on: the filing year, the
+court, whether the cluster is precedential, the case name and the URL.
+
+The index is a plain sqlite file. It's built by walking the `Citation` table in
+pk order and is refreshed incrementally by re-indexing the clusters of any
+citations newer than the last one it saw, plus any clusters that were modified
+since the last refresh. Citations that are deleted without their cluster being
+saved stay in the index until it is rebuilt, so it's a good idea to rebuild it
+every now and then.
+"""
+import logging
+import os
+import sqlite3
+from datetime import date
+from typing import Iterable, List, Optional, Set
+
+from django.db.models import Prefetch
+from django.utils.timezone import now
+
+from cl.custom_filters.templatetags.text_filters import best_case_name
+from cl.lib.date_time import midnight_pst
+from cl.search.models import Citation, Opinion, OpinionCluster
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS citations (
+        citation TEXT NOT NULL,
+        cluster_id INTEGER NOT NULL,
+        opinion_id INTEGER NOT NULL,
+        year INTEGER,
+        date_filed TEXT,
+        court_id TEXT,
+        precedential INTEGER NOT NULL,
+        case_name TEXT,
+        absolute_url TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS citations_citation ON citations (citation)",
+    "CREATE INDEX IF NOT EXISTS citations_cluster ON citations (cluster_id)",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+)
+
+
+def normalize_citation(citation: str) -> str:
+    """Collapse the whitespace in a "volume reporter page" string."""
+    return " ".join(citation.split())
+
+
+def make_index_rows(cluster_ids: Iterable[int]) -> List[tuple]:
+    """Get the index rows for a group of clusters.
+
+    A cluster with several opinions gets one row per opinion and citation, as
+    it does in Solr, where each opinion is its own document.
+    """
+    clusters = (
+        OpinionCluster.objects.filter(pk__in=cluster_ids)
+        .select_related("docket")
+        .prefetch_related(
+            "citations",
+            Prefetch(
+                "sub_opinions",
+                queryset=Opinion.objects.only("pk", "cluster_id"),
+            ),
+        )
+    )
+    rows = []
+    for cluster in clusters:
+        case_name = best_case_name(cluster)
+        absolute_url = cluster.get_absolute_url()
+        precedential = cluster.precedential_status == "Published"
+        date_filed = (
+            cluster.date_filed.isoformat() if cluster.date_filed else None
+        )
+        year = cluster.date_filed.year if cluster.date_filed else None
+        for citation in cluster.citations.all():
+            for opinion in cluster.sub_opinions.all():
+                rows.append(
+                    (
+                        normalize_citation(str(citation)),
+                        cluster.pk,
+                        opinion.pk,
+                        year,
+                        date_filed,
+                        cluster.docket.court_id,
+                        precedential,
+                        case_name,
+                        absolute_url,
+                    )
+                )
+    return rows
+
+
+class ReporterCitationIndex(object):
+    """A sqlite-backed lookup from reporter citations to opinions."""
+
+    def __init__(self, path: str, read_only: bool = True) -> None:
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    @classmethod
+    def open(cls, path: Optional[str]) -> Optional["ReporterCitationIndex"]:
+        """Open an index for reading, or return None if there isn't one."""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except sqlite3.Error:
+            logger.warning("Unable to open citation index at %s", path)
+            return None
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+    def lookup(
+        self,
+        citation: str,
+        start_year: int,
+        end_year: int,
+        court: Optional[str] = None,
+    ) -> List[dict]:
+        """Find the precedential opinions that have a citation.
+
+        :param citation: The citation, like "1 U.S. 1".
+        :param start_year: The first year the opinion could have been filed.
+        :param end_year: The last year the opinion could have been filed.
+        :param court: The court the opinion is from, if known.
+        :return: A list of dicts shaped like the Solr documents that citation
+        matching uses, with the ID, case name, URL and filing date of every
+        match.
+        """
+        query = (
+            "SELECT opinion_id, case_name, absolute_url, date_filed "
+            "FROM citations WHERE citation = ? AND precedential = 1 "
+            "AND year BETWEEN ? AND ?"
+        )
+        params = [normalize_citation(citation), start_year, end_year]
+        if court:
+            query += " AND court_id = ?"
+            params.append(court)
+        return [
+            {
+                "id": opinion_id,
+                "caseName": case_name,
+                "absolute_url": absolute_url,
+                "dateFiled": midnight_pst(date.fromisoformat(date_filed)),
+            }
+            for opinion_id, case_name, absolute_url, date_filed in (
+                self.conn.execute(query, params)
+            )
+        ]
+
+    def index_clusters(self, cluster_ids: Set[int]) -> int:
+        """Replace the rows for a group of clusters with fresh ones.
+
+        :return: The number of rows that were written.
+        """
+        if not cluster_ids:
+            return 0
+        rows = make_index_rows(cluster_ids)
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM citations WHERE cluster_id = ?",
+                [(pk,) for pk in cluster_ids],
+            )
+            self.conn.executemany(
+                "INSERT INTO citations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def refresh(self, chunk_size: int = 10000) -> int:
+        """Bring the index up to date with the database.
+
+        :param chunk_size: How many citations or clusters to handle at once.
+        :return: The number of rows that were written.
+        """
+        started = now()
+        last_pk = int(self._get_meta("last_citation_pk") or 0)
+        last_refresh = self._get_meta("last_refresh")
+        count = 0
+
+        # New citations, walking the primary key so each chunk is a range
+        # scan.
+        while True:
+            cites = list(
+                Citation.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", "cluster_id")[:chunk_size]
+            )
+            if not cites:
+                break
+            count += self.index_clusters({c[1] for c in cites})
+            last_pk = cites[-1][0]
+            with self.conn:
+                self._set_meta("last_citation_pk", str(last_pk))
+            logger.info("Indexed citations up to pk %s.", last_pk)
+
+        # Clusters that changed since the last refresh, which may have new
+        # names, dates or statuses.
+        if last_refresh is not None:
+            cluster_ids = (
+                OpinionCluster.objects.filter(
+                    date_modified__gte=last_refresh, citations__isnull=False
+                )
+                .order_by()
+                .values_list("pk", flat=True)
+                .distinct()
+                .iterator()
+            )
+            chunk: Set[int] = set()
+            for cluster_id in cluster_ids:
+                chunk.add(cluster_id)
+                if len(chunk) >= chunk_size:
+                    count += self.index_clusters(chunk)
+                    chunk = set()
+            count += self.index_clusters(chunk)
+
+        with self.conn:
+            self._set_meta("last_refresh", started.isoformat())
+        return count
+
+
+def build_reporter_index(
+    path: str, rebuild: bool = False, chunk_size: int = 10000
+) -> int:
+    """Create or refresh the reporter citation index at path.
+
+    A rebuild is written beside the old index and moved into place when it's
+    complete, so lookups never see a partial index.
+
+    :return: The number of rows that were written.
+    """
+    dest_dir = os.path.dirname(path)
+    if dest_dir:
+        os.makedirs(dest_dir, exist_ok=True)
+    build_path = path + ".tmp" if rebuild else path
+    if rebuild and os.path.exists(build_path):
+        os.remove(build_path)
+    index = ReporterCitationIndex(build_path, read_only=False)
+    try:
+        count = index.refresh(chunk_size=chunk_size)
+    finally:
+        index.close()
+    if rebuild:
+        os.replace(build_path, path)
+    return count
@@ -1,8 +1,10 @@
+from collections import Counter, defaultdict
 from http.client import ResponseNotReady
 from typing import Dict, List, Set, Tuple
 
 from django.db import transaction
 from django.db.models import F
+from django.utils.timezone import now
 from eyecite import get_citations
 from eyecite.models import CitationBase
 
@@ -11,7 +13,10 @@ from cl.citations.annotate_citations import (
     create_cited_html,
     get_and_clean_opinion_text,
 )
-from cl.citations.match_citations import do_resolve_citations
+from cl.citations.match_citations import (
+    CitationResolutionSession,
+    do_resolve_citations,
+)
 from cl.lib.types import SupportedCitationType
 from cl.search.models import Opinion, OpinionCluster, OpinionsCited
 from cl.search.tasks import add_items_to_solr
@@ -60,6 +65,27 @@ def identify_parallel_citations(
     return parallel_citations
 
 
+def update_citation_counts(cluster_deltas: Counter) -> None:
+    """Add to the citation counts of many clusters at once.
+
+    Clusters that get the same increment share one UPDATE, so a chunk of
+    opinions usually needs only a handful of statements. Rows are updated in
+    pk order so that concurrent chunks lock hot clusters in the same order
+    instead of deadlocking.
+
+    :param cluster_deltas: A Counter mapping cluster IDs to how much their
+    citation counts should go up.
+    :return: None
+    """
+    clusters_by_delta: Dict[int, List[int]] = defaultdict(list)
+    for cluster_id, delta in sorted(cluster_deltas.items()):
+        clusters_by_delta[delta].append(cluster_id)
+    for delta, cluster_ids in sorted(clusters_by_delta.items()):
+        OpinionCluster.objects.filter(pk__in=cluster_ids).update(
+            citation_count=F("citation_count") + delta
+        )
+
+
 @app.task(bind=True, max_retries=5, ignore_result=True)
 def find_citations_for_opinion_by_pks(
     self,
@@ -68,11 +94,30 @@ def find_citations_for_opinion_by_pks(
 ) -> None:
     """Find citations for search.Opinion objects.
 
+    Citations are resolved for every opinion in the chunk before anything is
+    written, and then the whole chunk is saved in one transaction: one delete
+    and one bulk insert of OpinionsCited rows, aggregated citation count
+    updates and a bulk update of the citing opinions. Solr gets one update for
+    the cited clusters and one for the citing opinions.
+
     :param opinion_pks: An iterable of search.Opinion PKs
     :param index: Whether to add the item to Solr
     :return: None
     """
     opinions: List[Opinion] = Opinion.objects.filter(pk__in=opinion_pks)
+    # Share a Solr connection and cached lookups across the whole chunk.
+    session = CitationResolutionSession()
+
+    # Look up what every opinion in the chunk cited before, all at once.
+    previously_cited: Dict[int, Set[int]] = defaultdict(set)
+    for citing_id, cited_id in OpinionsCited.objects.filter(
+        citing_opinion_id__in=opinion_pks
+    ).values_list("citing_opinion_id", "cited_opinion_id"):
+        previously_cited[citing_id].add(cited_id)
+
+    opinions_to_save: List[Opinion] = []
+    new_citations: List[OpinionsCited] = []
+    cluster_deltas: Counter = Counter()
     for opinion in opinions:
         # Memoize parsed versions of the opinion's text
         get_and_clean_opinion_text(opinion)
@@ -89,7 +134,7 @@ def find_citations_for_opinion_by_pks(
         try:
             citation_resolutions: Dict[
                 Opinion, List[SupportedCitationType]
-            ] = do_resolve_citations(citations, opinion)
+            ] = do_resolve_citations(citations, opinion, session)
         except ResponseNotReady as e:
             # Threading problem in httplib, which is used in the Solr query.
             raise self.retry(exc=e, countdown=2)
@@ -98,54 +143,60 @@ def find_citations_for_opinion_by_pks(
         opinion.html_with_citations = create_cited_html(
             opinion, citation_resolutions
         )
+        opinions_to_save.append(opinion)
 
         # Increase the citation count for the cluster of each matched opinion
-        # if that cluster has not already been cited by this opinion. First,
-        # calculate a list of the IDs of every opinion whose cluster will need
-        # updating.
-        all_cited_opinions = opinion.opinions_cited.all().values_list(
-            "pk", flat=True
+        # if that cluster has not already been cited by this opinion.
+        # Unmatched citations are linked in the HTML, but aren't stored.
+        cited_opinions = {
+            _opinion: _citations
+            for _opinion, _citations in citation_resolutions.items()
+            if isinstance(_opinion, Opinion)
+        }
+        cluster_deltas.update(
+            {
+                _opinion.cluster_id
+                for _opinion in cited_opinions.keys()
+                if _opinion.pk not in previously_cited[opinion.pk]
+            }
         )
-        opinion_ids_to_update = set()
-        for _opinion in citation_resolutions.keys():
-            if _opinion.pk not in all_cited_opinions:
-                opinion_ids_to_update.add(_opinion.pk)
-
-        # Finally, commit these changes to the database in a single
-        # transcation block. Trigger a single Solr update as well, if
-        # required.
-        with transaction.atomic():
-            opinion_clusters_to_update = OpinionCluster.objects.filter(
-                sub_opinions__pk__in=opinion_ids_to_update
-            )
-            opinion_clusters_to_update.update(
-                citation_count=F("citation_count") + 1
-            )
-            if index:
-                add_items_to_solr.delay(
-                    opinion_clusters_to_update.values_list("pk", flat=True),
-                    "search.OpinionCluster",
-                )
-
-            # Nuke existing citations
-            OpinionsCited.objects.filter(citing_opinion_id=opinion.pk).delete()
-
-            # Create the new ones.
-            OpinionsCited.objects.bulk_create(
-                [
-                    OpinionsCited(
-                        citing_opinion_id=opinion.pk,
-                        cited_opinion_id=_opinion.pk,
-                        depth=len(_citations),
-                    )
-                    for _opinion, _citations in citation_resolutions.items()
-                ]
+        new_citations.extend(
+            OpinionsCited(
+                citing_opinion_id=opinion.pk,
+                cited_opinion_id=_opinion.pk,
+                depth=len(_citations),
             )
+            for _opinion, _citations in cited_opinions.items()
+        )
 
-            # Save all the changes to the citing opinion (send to solr later)
-            opinion.save(index=False)
+    if opinions_to_save:
+        # Finally, commit these changes to the database in a single transaction
+        # block.
+        with transaction.atomic():
+            update_citation_counts(cluster_deltas)
+
+            # Nuke existing citations and create the new ones.
+            OpinionsCited.objects.filter(
+                citing_opinion_id__in=[o.pk for o in opinions_to_save]
+            ).delete()
+            OpinionsCited.objects.bulk_create(new_citations, batch_size=1000)
+
+            # Save all the changes to the citing opinions (send to solr later).
+            # bulk_update doesn't touch auto_now fields, so do that by hand.
+            modified = now()
+            for opinion in opinions_to_save:
+                opinion.date_modified = modified
+            Opinion.objects.bulk_update(
+                opinions_to_save,
+                ["html_with_citations", "date_modified"],
+                batch_size=100,
+            )
 
-    # If a Solr update was requested, do a single one at the end with all the
-    # pks of the passed opinions
+    # If a Solr update was requested, do a single one for the cited clusters
+    # and one at the end with all the pks of the passed opinions
     if index:
+        if cluster_deltas:
+            add_items_to_solr.delay(
+                sorted(cluster_deltas.keys()), "search.OpinionCluster"
+            )
         add_items_to_solr.delay(opinion_pks, "search.Opinion")
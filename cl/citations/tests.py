@@ -1,3 +1,5 @@
+import os
+import tempfile
 from unittest.mock import Mock
 
 from django.core.management import call_command
@@ -22,9 +24,14 @@ from cl.citations.management.commands.cl_add_parallel_citations import (
 )
 from cl.citations.match_citations import (
     NO_MATCH_RESOURCE,
+    CitationResolutionSession,
     do_resolve_citations,
     resolve_fullcase_citation,
 )
+from cl.citations.reporter_index import (
+    ReporterCitationIndex,
+    build_reporter_index,
+)
 from cl.citations.tasks import find_citations_for_opinion_by_pks
 from cl.lib.test_helpers import IndexedSolrTestCase
 from cl.search.models import Opinion, OpinionCluster, OpinionsCited
@@ -501,6 +508,56 @@ class MatchingTest(IndexedSolrTestCase):
         results = resolve_fullcase_citation(citation)
         self.assertEqual(NO_MATCH_RESOURCE, results)
 
+    def test_citation_resolution_with_reporter_index(self) -> None:
+        """Do citations resolve the same way from the local index as they do
+        from Solr?
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "index.sqlite3")
+            build_reporter_index(path, rebuild=True)
+            session = CitationResolutionSession(index_path=path)
+            for citation_str, expected in (
+                ("Foo v. Bar, 1 U.S. 1 (2000)", Opinion.objects.get(pk=7)),
+                (
+                    "Lorem v. Ipsum, 1 U.S. 50 (2000)",
+                    Opinion.objects.get(pk=9),
+                ),
+                ("1 F. 9 (1795)", NO_MATCH_RESOURCE),
+                ("Foo v. Bar, 1 U.S. 1 (1990)", NO_MATCH_RESOURCE),
+            ):
+                with self.subTest(citation_str=citation_str):
+                    citation = get_citations(citation_str)[0]
+                    self.assertEqual(
+                        resolve_fullcase_citation(citation, session),
+                        expected,
+                    )
+            # The citations with no match in the index went to Solr.
+            self.assertEqual(session.index_hits, 2)
+            session.index.close()
+
+    def test_citation_missing_from_reporter_index_goes_to_solr(self) -> None:
+        """If an opinion was added since the index was refreshed, do we still
+        find it in Solr?
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "index.sqlite3")
+            build_reporter_index(path, rebuild=True)
+            index = ReporterCitationIndex(path, read_only=False)
+            index.conn.execute("DELETE FROM citations WHERE opinion_id = 7")
+            index.conn.commit()
+            index.close()
+
+            session = CitationResolutionSession(index_path=path)
+            citation = get_citations("Foo v. Bar, 1 U.S. 1 (2000)")[0]
+            self.assertEqual(
+                resolve_fullcase_citation(citation, session),
+                Opinion.objects.get(pk=7),
+            )
+            self.assertEqual(session.index_hits, 0)
+            # The answer from Solr is what gets cached.
+            self.assertEqual(len(list(session.cache.values())[0]), 1)
+            session.index.close()
+
 
 class UpdateTest(IndexedSolrTestCase):
     """Tests whether the update task performs correctly, i.e., whether it
@@ -532,6 +589,24 @@ class UpdateTest(IndexedSolrTestCase):
             % (cited.cluster.citation_count, expected_count),
         )
 
+    def test_citation_count_not_incremented_twice(self) -> None:
+        """Re-running the finder on an opinion shouldn't count its citations
+        again, even when it's batched with other opinions.
+        """
+        remove_citations_from_imported_fixtures()
+
+        find_citations_for_opinion_by_pks.delay([3])
+        find_citations_for_opinion_by_pks.delay([1, 2, 3])
+
+        cited = Opinion.objects.get(pk=2)
+        self.assertEqual(cited.cluster.citation_count, 1)
+        self.assertEqual(
+            OpinionsCited.objects.filter(
+                citing_opinion_id=3, cited_opinion_id=2
+            ).count(),
+            1,
+        )
+
     def test_opinionscited_creation(self) -> None:
         """Make sure that found citations are stored in the database as
         OpinionsCited objects with the appropriate references and depth.
@@ -1,6 +1,7 @@
 import os
 import pickle
 import re
+from functools import lru_cache
 from math import ceil
 
 from django.conf import settings
@@ -700,6 +701,36 @@ international_pairs = (
 # fmt: on
 
 
+# The pairs to check for each kind of court, in the order they're checked.
+# Generally, we test these from most specific regex to least specific, and
+# district courts go last because they've got some broad ones. The order
+# should not be changed.
+COURT_PAIRS = (
+    ("international", international_pairs),
+    ("state", state_pairs),
+    ("state_ag", state_ag_pairs),
+    ("federal_appeals", ca_pairs),
+    ("bankruptcy", fb_pairs),
+    ("federal_district", fd_pairs),
+)
+
+# The bound search methods of the pairs, so that they aren't looked up for
+# every string.
+COURT_SEARCHES = {
+    kind: tuple((regex.search, value) for regex, value in pairs)
+    for kind, pairs in COURT_PAIRS
+}
+
+
+@lru_cache(maxsize=50000)
+def _match_court_string(court_str, kinds):
+    for kind in kinds:
+        for search, value in COURT_SEARCHES[kind]:
+            if search(court_str):
+                return value
+    return None
+
+
 def match_court_string(
     court_str,
     federal_appeals=False,
@@ -714,6 +745,9 @@ def match_court_string(
     Note you cannot use bankruptcy and federal_district together due to
     collisions between their regular expressions.
 
+    Results are memoized, since importers look up the same few thousand
+    court strings over and over.
+
     :param court_str: The court string to look up.
     :param federal_appeals: Whether the string might be a federal appeals
     court.
@@ -730,35 +764,18 @@ def match_court_string(
         federal_district and bankruptcy
     ), "federal_district and bankruptcy cannot be used in conjunction"
 
-    # Generally, we test these from most specific regex to least specific. The
-    # order of the tests below should not be changed.
-    matches = []
-    if international:
-        for regex, value in international_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-    if state:
-        for regex, value in state_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-    if state_ag:
-        for regex, value in state_ag_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-    if federal_appeals:
-        for regex, value in ca_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-    if bankruptcy:
-        for regex, value in fb_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-    # District go last because they've got some broad ones.
-    if federal_district:
-        for regex, value in fd_pairs:
-            if re.search(regex, court_str):
-                matches.append(value)
-
-    # Safety check. If we have more than one match, that's a problem
-    assert len(matches) >= 1, "Too many matches for %s" % court_str
-    return matches[0] if matches else None
+    selected = {
+        "international": international,
+        "state": state,
+        "state_ag": state_ag,
+        "federal_appeals": federal_appeals,
+        "bankruptcy": bankruptcy,
+        "federal_district": federal_district,
+    }
+    kinds = tuple(kind for kind, _ in COURT_PAIRS if selected[kind])
+    # The first pair to match wins, so there's no need to check the rest.
+    match = _match_court_string(court_str, kinds)
+
+    # Safety check. If we have no match, that's a problem
+    assert match is not None, "Too many matches for %s" % court_str
+    return match
@@ -0,0 +1,138 @@
+import glob
+import json
+import os
+import re
+import time
+
+from django.conf import settings
+
+from cl.corpus_importer.court_regexes import (
+    COURT_PAIRS,
+    _match_court_string,
+    match_court_string,
+)
+from cl.lib.command_utils import VerboseCommand, logger
+
+# The kinds of courts that the importers look for.
+IMPORTER_KINDS = (
+    ("harvard_opinions", ("state", "federal_appeals", "federal_district")),
+    ("fjc_judges", ("federal_district",)),
+    ("fjc_bankruptcy", ("bankruptcy",)),
+)
+
+
+def get_fixture_court_strings():
+    """Get the court names in the corpus importer's test fixtures."""
+    root = os.path.join(settings.INSTALL_ROOT, "cl/corpus_importer")
+    court_strs = []
+    for path in sorted(glob.glob(os.path.join(root, "test_assets/*.json"))):
+        with open(path) as f:
+            court = json.load(f).get("court") or {}
+        if court.get("name"):
+            court_strs.append(court["name"])
+    for path in sorted(glob.glob(os.path.join(root, "fixtures/*.json"))):
+        with open(path) as f:
+            for obj in json.load(f):
+                full_name = obj["fields"].get("full_name")
+                if obj["model"] == "search.court" and full_name:
+                    court_strs.append(full_name)
+    return court_strs
+
+
+def match_court_string_serially(court_str, kinds):
+    """Match a court string the way match_court_string used to, running every
+    regex of every kind, to compare against.
+    """
+    matches = []
+    for kind, pairs in COURT_PAIRS:
+        if kind in kinds:
+            for regex, value in pairs:
+                if re.search(regex, court_str):
+                    matches.append(value)
+    return matches[0] if matches else None
+
+
+def match_or_none(court_str, kinds):
+    try:
+        return match_court_string(court_str, **dict.fromkeys(kinds, True))
+    except AssertionError:
+        return None
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time match_court_string against the old way of matching court "
+        "strings, and check they get the same answers. By default, the "
+        "court names in the corpus importer's test fixtures are used."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "court_strs",
+            nargs="*",
+            help="The court strings to match. Defaults to the court names "
+            "in the test fixtures.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=1000,
+            help="How many times to match each court string, as importers "
+            "do when they see the same court over and over.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        court_strs = options["court_strs"] or get_fixture_court_strings()
+        repeat = options["repeat"]
+        print(
+            "%-20s %7s %10s %10s %10s %8s"
+            % (
+                "importer",
+                "strings",
+                "old (s)",
+                "cold (s)",
+                "warm (s)",
+                "speedup",
+            )
+        )
+        for importer, kinds in IMPORTER_KINDS:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                expected = [
+                    match_court_string_serially(s, kinds) for s in court_strs
+                ]
+            old_time = time.perf_counter() - start
+
+            # Cold matches run every time, as when each string is new.
+            start = time.perf_counter()
+            for _ in range(repeat):
+                _match_court_string.cache_clear()
+                got = [match_or_none(s, kinds) for s in court_strs]
+            cold_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                got = [match_or_none(s, kinds) for s in court_strs]
+            warm_time = time.perf_counter() - start
+
+            for court_str, old, new in zip(court_strs, expected, got):
+                if old != new:
+                    logger.warning(
+                        "%s: %r matched %s, but used to match %s.",
+                        importer,
+                        court_str,
+                        new,
+                        old,
+                    )
+            print(
+                "%-20s %7s %10.3f %10.3f %10.3f %7.1fx"
+                % (
+                    importer,
+                    len(court_strs),
+                    old_time,
+                    cold_time,
+                    warm_time,
+                    old_time / warm_time if warm_time else 0,
+                )
+            )
@@ -281,6 +281,34 @@ class CourtMatchingTest(unittest.TestCase):
             got = match_court_string(test["q"], federal_district=True)
             self.assertEqual(test["a"], got)
 
+    def test_match_court_string_finds_first_matching_pair(self) -> None:
+        """Do we get the first matching court, whichever kinds we check?"""
+        pairs = (
+            {
+                "q": "Supreme Court of Alabama",
+                "kinds": {"state": True, "federal_district": True},
+                "a": "ala",
+            },
+            {
+                "q": "U.S. Court of Appeals for the Ninth Circuit",
+                "kinds": {"state": True, "federal_appeals": True},
+                "a": "ca9",
+            },
+            {
+                "q": "Middle District of Pennsylvania",
+                "kinds": {"state": True, "federal_district": True},
+                "a": "pamd",
+            },
+        )
+        for test in pairs:
+            # Twice, to check the memoized answer too.
+            for _ in range(2):
+                got = match_court_string(test["q"], **test["kinds"])
+                self.assertEqual(test["a"], got)
+
+        with self.assertRaises(AssertionError):
+            match_court_string("Court of Nowhere", state=True)
+
     def test_get_appellate_court_object_from_string(self) -> None:
         """Can we get the correct federal appellate courts?"""
 
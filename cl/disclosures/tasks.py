@@ -1,6 +1,9 @@
 import datetime
 import json
-from typing import Dict, List, Optional, Union
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import quote
 
 import requests
@@ -8,6 +11,8 @@ from dateutil.parser import ParserError, parse
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import transaction
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.utils import PdfReadError
 from redis import Redis
 from requests import ReadTimeout
 
@@ -29,11 +34,13 @@ from cl.lib.command_utils import logger
 from cl.lib.crypto import sha1
 from cl.lib.models import THUMBNAIL_STATUSES
 from cl.lib.redis_utils import create_redis_semaphore, make_redis_interface
+from cl.lib.utils import chunks
 from cl.people_db.models import Person
 from cl.scrapers.transformer_extractor_utils import (
     generate_thumbnail,
     get_page_count,
 )
+from cl.stats.utils import tally_stat
 
 
 def make_disclosure_key(data_id: str) -> str:
@@ -140,6 +147,224 @@ def extract_content(
     return extractor_response.json()
 
 
+def get_page_ranges(
+    page_count: int, pages_per_range: int
+) -> List[Tuple[int, int]]:
+    """Split the pages of a document into ranges.
+
+    :param page_count: The number of pages in the document
+    :param pages_per_range: The most pages to put in a range
+    :return: The first and last page of each range, counting from one.
+    """
+    return [
+        (first, min(first + pages_per_range - 1, page_count))
+        for first in range(1, page_count + 1, pages_per_range)
+    ]
+
+
+def split_pdf(reader: PdfFileReader, first: int, last: int) -> bytes:
+    """Make a PDF of a range of the pages of another PDF.
+
+    :param reader: A reader of the whole PDF
+    :param first: The first page of the range, counting from one
+    :param last: The last page of the range
+    :return: The bytes of the new PDF
+    """
+    writer = PdfFileWriter()
+    for i in range(first - 1, last):
+        writer.addPage(reader.getPage(i))
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def offset_page_numbers(extracted_data: dict, offset: int) -> None:
+    """Make the page numbers of the rows extracted from a range of pages
+    count from the start of the whole document.
+
+    :param extracted_data: The content extracted from the range
+    :param offset: The number of pages before the range
+    """
+    for section in extracted_data["sections"].values():
+        for row in section["rows"]:
+            for cell in row.values():
+                if "page_number" in cell:
+                    cell["page_number"] += offset
+
+
+def merge_extracted_data(parts: List[dict]) -> dict:
+    """Merge the content extracted from the page ranges of a document.
+
+    :param parts: The content of each range, in page order
+    :return: The content of the whole document
+    """
+    addendum = "Additional Information or Explanations"
+    merged = dict(parts[0])
+    merged["sections"] = {}
+    for part in parts:
+        for name, section in part["sections"].items():
+            merged["sections"].setdefault(name, dict(section, rows=[]))
+            merged["sections"][name]["rows"].extend(section["rows"])
+    merged[addendum] = {
+        "text": "\n\n".join(
+            part[addendum]["text"] for part in parts if part[addendum]["text"]
+        ),
+        "is_redacted": any(part[addendum]["is_redacted"] for part in parts),
+    }
+    # Which kind of report it is is only on the first page, and whether it's
+    # amended could be anywhere.
+    for flag in ["initial", "nomination", "annual", "final", "amended"]:
+        merged[flag] = any(part.get(flag) for part in parts)
+    merged["page_count"] = sum(part.get("page_count") or 0 for part in parts)
+    return merged
+
+
+def make_extraction_checkpoint_key(sha1_hash: str) -> str:
+    """Make the key of the page ranges extracted from a disclosure in redis
+
+    :param sha1_hash: The SHA1 of the disclosure's PDF
+    :return: Extraction checkpoint key
+    """
+    return f"disclosure.extracted:{sha1_hash}"
+
+
+def timed_extract_content(
+    pdf_bytes: bytes, disclosure_type: str
+) -> Tuple[Dict[str, Union[str, int]], float]:
+    """Extract the content of a PDF, timing how long it takes.
+
+    :return: The extracted content and the seconds it took
+    """
+    start = time.monotonic()
+    content = extract_content(pdf_bytes, disclosure_type)
+    return content, time.monotonic() - start
+
+
+def record_extraction_throughput(
+    first: int, last: int, seconds: float, success: bool
+) -> None:
+    """Log and tally how long it took to extract a range of pages.
+
+    :param first: The first page of the range
+    :param last: The last page of the range
+    :param seconds: How long the extraction took
+    :param success: Whether the extraction worked
+    """
+    pages = last - first + 1
+    logger.info(
+        f"{'Extracted' if success else 'Failed to extract'} pages "
+        f"{first}-{last} in {seconds:.1f}s ({seconds / pages:.2f}s per page)"
+    )
+    tally_stat("disclosures.extraction.pages", inc=pages)
+    tally_stat("disclosures.extraction.seconds", inc=round(seconds))
+    if not success:
+        tally_stat("disclosures.extraction.failed_pages", inc=pages)
+
+
+def extract_content_by_page_range(
+    pdf_bytes: bytes,
+    disclosure_type: str,
+    sha1_hash: str,
+    pages_per_range: int = settings.DISCLOSURE_PAGES_PER_RANGE,
+    workers: int = settings.DISCLOSURE_EXTRACTION_WORKERS,
+) -> Dict[str, Union[str, int]]:
+    """Extract the content of a PDF a range of pages at a time.
+
+    Big disclosures can take hours to extract whole, and a timeout near the
+    end loses all of that work. Instead, their page ranges are extracted at
+    the same time, and each range is kept in redis as soon as it's done, so
+    if the import fails, the next attempt only extracts the missing ranges.
+
+    Small documents, and documents that can't be split, are extracted whole.
+    So are documents whose ranges can't be extracted on their own at all.
+
+    :param pdf_bytes: The byte array of the PDF
+    :param disclosure_type: Type of disclosure
+    :param sha1_hash: The SHA1 of the PDF, to keep the ranges under
+    :param pages_per_range: The most pages to extract at a time
+    :param workers: How many ranges to extract at once
+    :return: The extracted content, or an empty dict if any range failed.
+    """
+    try:
+        reader = PdfFileReader(BytesIO(pdf_bytes), strict=False)
+        page_count = reader.getNumPages()
+    except (PdfReadError, ValueError, TypeError, KeyError):
+        logger.info("Unable to split PDF, extracting it whole.")
+        page_count = 0
+
+    if not pages_per_range or page_count <= pages_per_range:
+        content, seconds = timed_extract_content(pdf_bytes, disclosure_type)
+        if page_count:
+            record_extraction_throughput(1, page_count, seconds, bool(content))
+        return content
+
+    r = make_redis_interface("CACHE")
+    checkpoint_key = make_extraction_checkpoint_key(sha1_hash)
+    checkpoints = r.hgetall(checkpoint_key)
+    parts = {}
+    todo = []
+    for first, last in get_page_ranges(page_count, pages_per_range):
+        checkpoint = checkpoints.get(f"{first}-{last}")
+        if checkpoint:
+            parts[first] = json.loads(checkpoint)
+        else:
+            todo.append((first, last))
+    if parts:
+        logger.info(
+            f"Resuming extraction with {len(parts)} of "
+            f"{len(parts) + len(todo)} page ranges already extracted."
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                timed_extract_content,
+                split_pdf(reader, first, last),
+                disclosure_type,
+            ): (first, last)
+            for first, last in todo
+        }
+        failed = 0
+        for future in as_completed(futures):
+            first, last = futures[future]
+            try:
+                content, seconds = future.result()
+            except Exception as e:
+                # Connection errors, bad responses and the like. Keep going,
+                # so the ranges that did work are kept.
+                logger.info(f"Failed to extract pages {first}-{last}: {e}")
+                tally_stat(
+                    "disclosures.extraction.failed_pages", inc=last - first + 1
+                )
+                failed += 1
+                continue
+            record_extraction_throughput(first, last, seconds, bool(content))
+            if not content:
+                failed += 1
+                continue
+            offset_page_numbers(content, first - 1)
+            parts[first] = content
+            r.hset(checkpoint_key, f"{first}-{last}", json.dumps(content))
+            r.expire(
+                checkpoint_key, settings.DISCLOSURE_EXTRACTION_CHECKPOINT_TTL
+            )
+
+    if failed and not parts:
+        # Nothing worked, so maybe the extractor can't handle parts of this
+        # kind of document. Try it the old way.
+        logger.info("Unable to extract any page ranges, extracting it whole.")
+        content, seconds = timed_extract_content(pdf_bytes, disclosure_type)
+        record_extraction_throughput(1, page_count, seconds, bool(content))
+        return content
+    if failed:
+        logger.info(
+            f"Failed to extract {failed} page ranges. The rest are kept for "
+            f"the next attempt."
+        )
+        return {}
+    return merge_extracted_data([parts[first] for first in sorted(parts)])
+
+
 def get_report_type(extracted_data: dict) -> int:
     """Get report type if available
 
@@ -191,11 +416,42 @@ def get_date(text: str, year: int) -> Optional[datetime.date]:
         return None
 
 
-@transaction.atomic
+DISCLOSURE_ROW_MODELS = [
+    Investment,
+    Agreement,
+    Debt,
+    Position,
+    Gift,
+    Reimbursement,
+    NonInvestmentIncome,
+    SpouseIncome,
+]
+
+
+def bulk_create_in_batches(
+    model,
+    objs: Iterable,
+    batch_size: int = settings.DISCLOSURE_SAVE_BATCH_SIZE,
+) -> None:
+    """Insert rows a batch at a time, each batch in its own transaction.
+
+    :param model: The model of the rows
+    :param objs: The rows to insert. Can be a generator.
+    :param batch_size: The most rows to insert at a time
+    :return: None
+    """
+    for batch in chunks(objs, batch_size):
+        with transaction.atomic():
+            model.objects.bulk_create(list(batch))
+
+
 def save_disclosure(extracted_data: dict, disclosure) -> None:
     """Save financial data to system.
 
-    Wrapped in a transaction, we fail if anything fails.
+    The rows are inserted in batches, so a big disclosure doesn't hold a
+    transaction open for long. The disclosure is only marked as extracted
+    once every row is in, and rows left by an attempt that didn't get that
+    far are deleted first, so if we fail, it's safe to try again.
 
     :param disclosure: Financial disclosure
     :param extracted_data: disclosure
@@ -203,16 +459,14 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
     """
     addendum = "Additional Information or Explanations"
 
-    # Process and save our data into the system.
-    disclosure.has_been_extracted = True
-    disclosure.addendum_content_raw = extracted_data[addendum]["text"]
-    disclosure.addendum_redacted = extracted_data[addendum]["is_redacted"]
-    disclosure.is_amended = extracted_data.get("amended") or False
-    disclosure.report_type = get_report_type(extracted_data)
-    disclosure.save()
+    if not disclosure.has_been_extracted:
+        with transaction.atomic():
+            for model in DISCLOSURE_ROW_MODELS:
+                model.objects.filter(financial_disclosure=disclosure).delete()
 
-    Investment.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Investment,
+        (
             Investment(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in investment.values()),
@@ -235,11 +489,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
             for investment in extracted_data["sections"][
                 "Investments and Trusts"
             ]["rows"]
-        ]
+        ),
     )
 
-    Agreement.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Agreement,
+        (
             Agreement(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in agreement.values()),
@@ -247,11 +502,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
                 parties_and_terms=agreement["Parties and Terms"]["text"],
             )
             for agreement in extracted_data["sections"]["Agreements"]["rows"]
-        ]
+        ),
     )
 
-    Debt.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Debt,
+        (
             Debt(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in debt.values()),
@@ -260,11 +516,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
                 value_code=debt["Value Code"]["text"],
             )
             for debt in extracted_data["sections"]["Liabilities"]["rows"]
-        ]
+        ),
     )
 
-    Position.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Position,
+        (
             Position(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in position.values()),
@@ -272,11 +529,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
                 organization_name=position["Name of Organization"]["text"],
             )
             for position in extracted_data["sections"]["Positions"]["rows"]
-        ]
+        ),
     )
 
-    Gift.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Gift,
+        (
             Gift(
                 financial_disclosure=disclosure,
                 source=gift["Source"]["text"],
@@ -285,11 +543,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
                 redacted=any(v["is_redacted"] for v in gift.values()),
             )
             for gift in extracted_data["sections"]["Gifts"]["rows"]
-        ]
+        ),
     )
 
-    Reimbursement.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        Reimbursement,
+        (
             Reimbursement(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in reimbursement.values()),
@@ -304,11 +563,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
             for reimbursement in extracted_data["sections"]["Reimbursements"][
                 "rows"
             ]
-        ]
+        ),
     )
 
-    NonInvestmentIncome.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        NonInvestmentIncome,
+        (
             NonInvestmentIncome(
                 financial_disclosure=disclosure,
                 redacted=any(
@@ -321,11 +581,12 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
             for non_investment_income in extracted_data["sections"][
                 "Non-Investment Income"
             ]["rows"]
-        ]
+        ),
     )
 
-    SpouseIncome.objects.bulk_create(
-        [
+    bulk_create_in_batches(
+        SpouseIncome,
+        (
             SpouseIncome(
                 financial_disclosure=disclosure,
                 redacted=any(v["is_redacted"] for v in spouse_income.values()),
@@ -335,9 +596,17 @@ def save_disclosure(extracted_data: dict, disclosure) -> None:
             for spouse_income in extracted_data["sections"][
                 "Non Investment Income Spouse"
             ]["rows"]
-        ]
+        ),
     )
 
+    # Process and save our data into the system.
+    disclosure.has_been_extracted = True
+    disclosure.addendum_content_raw = extracted_data[addendum]["text"]
+    disclosure.addendum_redacted = extracted_data[addendum]["is_redacted"]
+    disclosure.is_amended = extracted_data.get("amended") or False
+    disclosure.report_type = get_report_type(extracted_data)
+    disclosure.save()
+
 
 def get_aws_url(data: Dict[str, Union[str, int, list]]) -> str:
     """Get URL saved to download filepath
@@ -480,8 +749,10 @@ def import_disclosure(self, data: Dict[str, Union[str, int, list]]) -> None:
             f"{disclosure.filepath}"
         )
     # Extract content from PDF
-    content = extract_content(
-        pdf_bytes=pdf_bytes, disclosure_type=data["disclosure_type"]
+    content = extract_content_by_page_range(
+        pdf_bytes=pdf_bytes,
+        disclosure_type=data["disclosure_type"],
+        sha1_hash=disclosure.sha1,
     )
     if not content:
         logger.info("Failed extraction!")
@@ -490,5 +761,8 @@ def import_disclosure(self, data: Dict[str, Union[str, int, list]]) -> None:
 
     # Save PDF content
     save_disclosure(extracted_data=content, disclosure=disclosure)
-    # Remove disclosure ID in redis for completed disclosure
-    interface.delete(disclosure_key)
+    # Remove disclosure ID and extracted pages in redis for completed
+    # disclosure
+    interface.delete(
+        disclosure_key, make_extraction_checkpoint_key(disclosure.sha1)
+    )
@@ -1,5 +1,6 @@
 import json
 import os
+from unittest import mock
 
 import requests
 from django.conf import settings
@@ -13,7 +14,13 @@ from cl.disclosures.models import (
     NonInvestmentIncome,
     Reimbursement,
 )
-from cl.disclosures.tasks import save_disclosure
+from cl.disclosures.tasks import (
+    extract_content_by_page_range,
+    make_extraction_checkpoint_key,
+    save_disclosure,
+)
+from cl.lib.redis_utils import make_redis_interface
+from cl.tests.fakes import FakeDisclosureExtractor
 
 
 class DisclosureIngestionTest(TestCase):
@@ -88,6 +95,77 @@ class DisclosureIngestionTest(TestCase):
             f"Should have 84 ingested investments",
         )
 
+    @mock.patch(
+        "cl.disclosures.tasks.extract_content",
+        side_effect=FakeDisclosureExtractor(),
+    )
+    def test_extraction_by_page_range(self, mock_extract) -> None:
+        """Can we extract a disclosure a few pages at a time, and save what
+        we get?
+        """
+        with open(self.jef_pdf, "rb") as f:
+            pdf_bytes = f.read()
+        r = make_redis_interface("CACHE")
+        checkpoint_key = make_extraction_checkpoint_key("asdf")
+        r.delete(checkpoint_key)
+
+        content = extract_content_by_page_range(
+            pdf_bytes, "jef", "asdf", pages_per_range=4, workers=2
+        )
+        self.assertEqual(sorted(mock_extract.side_effect.calls), [1, 4, 4])
+        rows = content["sections"]["Investments and Trusts"]["rows"]
+        self.assertEqual(
+            [row["A"]["page_number"] for row in rows], list(range(1, 10))
+        )
+        self.assertTrue(content["annual"])
+
+        test_disclosure = FinancialDisclosure.objects.get(pk=1)
+        save_disclosure(extracted_data=content, disclosure=test_disclosure)
+        self.assertEqual(
+            list(
+                Investment.objects.filter(financial_disclosure=test_disclosure)
+                .order_by("pk")
+                .values_list("page_number", flat=True)
+            ),
+            list(range(1, 10)),
+        )
+
+        # The ranges were kept, so a second attempt doesn't extract again.
+        mock_extract.reset_mock()
+        resumed = extract_content_by_page_range(
+            pdf_bytes, "jef", "asdf", pages_per_range=4, workers=2
+        )
+        mock_extract.assert_not_called()
+        self.assertEqual(resumed["sections"], content["sections"])
+        r.delete(checkpoint_key)
+
+    def test_extraction_keeps_ranges_when_one_raises(self) -> None:
+        """If extracting a range raises an error, do we keep the ranges that
+        worked for the next attempt?
+        """
+        with open(self.jef_pdf, "rb") as f:
+            pdf_bytes = f.read()
+        r = make_redis_interface("CACHE")
+        checkpoint_key = make_extraction_checkpoint_key("asdf")
+        r.delete(checkpoint_key)
+        extractor = FakeDisclosureExtractor()
+
+        def flaky_extractor(pdf_bytes, disclosure_type):
+            content = extractor(pdf_bytes, disclosure_type)
+            if content["page_count"] == 1:
+                raise requests.ConnectionError("Connection refused")
+            return content
+
+        with mock.patch(
+            "cl.disclosures.tasks.extract_content", side_effect=flaky_extractor
+        ):
+            content = extract_content_by_page_range(
+                pdf_bytes, "jef", "asdf", pages_per_range=4, workers=2
+            )
+        self.assertEqual(content, {})
+        self.assertEqual(sorted(r.hgetall(checkpoint_key)), ["1-4", "5-8"])
+        r.delete(checkpoint_key)
+
 
 class LoggedInDisclosureTestCase(TestCase):
     fixtures = [
@@ -1,18 +1,78 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
 from scorched import SolrInterface
 from scorched.exc import SolrError
 from scorched.search import Options, SolrSearch
 
+# How long a Solr schema is trusted before it's fetched again.
+SCHEMA_CACHE_TTL = 60 * 60
+# How many keep-alive connections to hold open per Solr host, per thread.
+POOL_MAXSIZE = 10
+
+_local = threading.local()
+_schema_cache: Dict[str, Tuple[float, dict]] = {}
+_schema_lock = threading.Lock()
+
+
+def get_solr_session() -> requests.Session:
+    """Get a keep-alive requests session for talking to Solr.
+
+    Sessions are kept per thread, and are thrown away when a process forks
+    (as Celery's prefork workers do), since sockets can't be shared with the
+    parent.
+    """
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+        _local.pid = pid
+    return _local.session
+
+
+def clear_schema_cache() -> None:
+    """Forget every cached Solr schema, such as after altering a core."""
+    with _schema_lock:
+        _schema_cache.clear()
+
 
 class ExtraSolrInterface(SolrInterface):
     """Extends the SolrInterface class so that it uses the ExtraSolrSearch
     class.
+
+    Unless it is given a connection of its own, it also shares a pooled
+    keep-alive session with every other interface in the thread, and it
+    caches the schema of each core so that making an interface doesn't cost
+    an HTTP request. Because the session is shared, don't close it when you're
+    done with the interface.
     """
 
     hl_fields = None
 
     def __init__(self, *args, **kwargs):
+        if len(args) < 2 and kwargs.get("http_connection") is None:
+            kwargs["http_connection"] = get_solr_session()
         super(ExtraSolrInterface, self).__init__(*args, **kwargs)
 
+    def init_schema(self):
+        url = self.conn.url
+        with _schema_lock:
+            cached = _schema_cache.get(url)
+        if cached is not None and time.time() - cached[0] < SCHEMA_CACHE_TTL:
+            return cached[1]
+        schema = super(ExtraSolrInterface, self).init_schema()
+        with _schema_lock:
+            _schema_cache[url] = (time.time(), schema)
+        return schema
+
     def query(self, *args, **kwargs):
         """
         :returns: SolrSearch -- A solrsearch.
@@ -153,3 +213,91 @@ class MoreLikeThisHighlightsSolrSearch(ExtraSolrSearch):
             ret = self.constructor(ret, constructor)
 
         return ret
+
+
+class SolrBatchWriter(object):
+    """Buffer documents per Solr core and send them in batches.
+
+    Documents are sent once a core's buffer reaches batch_size or once its
+    oldest document has waited max_wait seconds, whichever comes first. Use it
+    as a context manager so that anything left over is sent at the end:
+
+        with SolrBatchWriter() as writer:
+            for item in items:
+                writer.add(settings.SOLR_OPINION_URL, item.as_search_dict())
+
+    Errors from Solr are raised from whichever call triggered the flush.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        max_wait: float = 30,
+        commit: bool = False,
+    ) -> None:
+        """
+        :param batch_size: Send a core's documents once this many are waiting.
+        :param max_wait: Send a core's documents once the oldest of them has
+        waited this many seconds.
+        :param commit: Whether to send a commit to each core that was written
+        to when the writer is closed.
+        """
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.commit = commit
+        self.buffers: Dict[str, List[dict]] = defaultdict(list)
+        self.oldest: Dict[str, float] = {}
+        self.interfaces: Dict[str, ExtraSolrInterface] = {}
+        self.sent_count = 0
+
+    def __enter__(self) -> "SolrBatchWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+
+    def _get_interface(self, url: str) -> ExtraSolrInterface:
+        if url not in self.interfaces:
+            self.interfaces[url] = ExtraSolrInterface(url, mode="w")
+        return self.interfaces[url]
+
+    def add(self, url: str, docs: Iterable[dict]) -> None:
+        """Queue documents for the core at url, sending them if it's time.
+
+        :param url: The URL of the Solr core.
+        :param docs: An iterable of search dicts, or a single search dict.
+        """
+        if isinstance(docs, dict):
+            docs = [docs]
+        buffer = self.buffers[url]
+        for doc in docs:
+            if not buffer:
+                self.oldest[url] = time.monotonic()
+            buffer.append(doc)
+            if len(buffer) >= self.batch_size:
+                self.flush(url)
+        if buffer and time.monotonic() - self.oldest[url] >= self.max_wait:
+            self.flush(url)
+
+    def flush(self, url: Optional[str] = None) -> None:
+        """Send waiting documents to Solr.
+
+        :param url: The core to send documents for, or None for every core.
+        """
+        urls = [url] if url is not None else list(self.buffers.keys())
+        for u in urls:
+            docs = self.buffers.get(u)
+            if not docs:
+                continue
+            self._get_interface(u).add(docs)
+            self.sent_count += len(docs)
+            docs.clear()
+            self.oldest.pop(u, None)
+
+    def close(self) -> None:
+        """Send everything that's waiting, and commit if requested."""
+        self.flush()
+        if self.commit:
+            for si in self.interfaces.values():
+                si.commit()
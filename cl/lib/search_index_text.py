@@ -0,0 +1,280 @@
+"""Build the text fields of search documents without rendering templates.
+
+The text field of every search document used to be made by rendering one of
+the templates in cl/search/templates/indexes. Rendering a template is slow,
+and making search documents is most of the work of a reindex, so each
+template has a builder here that makes exactly the same text in plain
+Python, down to the whitespace, escaping and formatting of each value.
+
+The templates are still the reference. If you change one, change its
+builder too, and the tests will tell you if they disagree. Set
+INDEX_TEXT_USE_TEMPLATES to render the templates instead.
+"""
+from datetime import date
+from html import escape as html_escape
+from typing import Any, Callable, Dict
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.template import loader
+from django.template.defaultfilters import date as date_filter
+from django.template.defaultfilters import striptags
+from django.utils.dates import MONTHS
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.timezone import template_localtime
+
+from cl.lib.search_index_utils import null_map
+
+
+def _v(value: Any) -> str:
+    """Render a value as {{ value }} does."""
+    # Strings and None are most of what's rendered, so skip the formatting
+    # that can't change them.
+    if type(value) is str:
+        return html_escape(value)
+    if value is None:
+        return "None"
+    return conditional_escape(localize(template_localtime(value)))
+
+
+def _date(value: Any) -> str:
+    """Render a value as {{ value|date:"j F Y" }} does."""
+    if type(value) is date:
+        return "%d %s %d" % (
+            value.day,
+            html_escape(str(MONTHS[value.month])),
+            value.year,
+        )
+    return _v(date_filter(template_localtime(value), "j F Y"))
+
+
+def _lookup(obj: Any, *attrs: str) -> Any:
+    """Look up a chain of attributes as a template variable does, giving
+    an empty string if an object along the way is missing.
+    """
+    for attr in attrs:
+        try:
+            obj = getattr(obj, attr)
+        except (AttributeError, ObjectDoesNotExist):
+            return ""
+    return obj
+
+
+def _case_name(item: Any, indent: str) -> str:
+    """Render the case_name_full, case_name, case_name_short if block."""
+    if item.case_name_full:
+        name = item.case_name_full
+    elif item.case_name:
+        name = item.case_name
+    else:
+        name = item.case_name_short
+    return "\n%s    %s\n%s" % (indent, _v(name), indent)
+
+
+def build_opinion_text(item, citation_string) -> str:
+    """Build the text of indexes/opinion_text.txt."""
+    if item.html_columbia:
+        body = striptags(item.html_columbia)
+    elif item.html_lawbox:
+        body = striptags(item.html_lawbox)
+    elif item.html:
+        body = striptags(item.html)
+    else:
+        body = item.plain_text
+    cluster = item.cluster
+    docket = cluster.docket
+    court = docket.court
+    judges = "".join(
+        "\n    %s\n" % _v(judge.name_full) for judge in cluster.panel.all()
+    )
+    return "".join(
+        [
+            "\n",
+            "\n    %s\n" % _v(body),
+            "\n\n\n\n",
+            "%s\n" % _date(docket.date_argued),
+            "%s\n" % _date(docket.date_reargued),
+            "%s\n" % _date(docket.date_reargument_denied),
+            "%s\n" % _v(docket.docket_number),
+            "\n\n",
+            "%s\n" % _v(court.full_name),
+            "%s\n" % _v(court.pk),
+            "%s\n" % _v(court.citation_string),
+            "\n\n",
+            _case_name(cluster, ""),
+            "\n",
+            judges,
+            "\n",
+            "%s\n" % _v(cluster.judges),
+            "%s\n" % _date(cluster.date_filed),
+            "%s\n" % _v(citation_string),
+            "%s\n" % _v(cluster.procedural_history),
+            "%s\n" % _v(cluster.attorneys),
+            "%s\n" % _v(cluster.nature_of_suit),
+            "%s\n" % _v(cluster.posture),
+            "%s\n" % _v(cluster.syllabus),
+            "%s\n" % _v(cluster.precedential_status),
+            "\n\n",
+            "%s\n" % _v(item.sha1),
+            "\n\n",
+        ]
+    )
+
+
+def build_recap_text(item) -> str:
+    """Build the text of indexes/dockets_text.txt."""
+    entry = item.docket_entry
+    docket = entry.docket
+    court = docket.court
+    assigned_to = docket.assigned_to
+    referred_to = docket.referred_to
+    bankr_info = _lookup(docket, "bankruptcy_information")
+    chapter = _lookup(bankr_info, "chapter")
+    return "".join(
+        [
+            "\n",
+            "\n    %s" % entry.description,
+            "\n    %s\n" % _date(entry.date_filed),
+            "\n\n\n\n",
+            "%s\n" % _v(item.get_document_type_display()),
+            "%s\n" % _v(item.plain_text),
+            "\n\n\n",
+            "\n    ",
+            _case_name(docket, "    "),
+            "\n    %s" % _date(docket.date_argued),
+            "\n    %s" % _date(docket.date_filed),
+            "\n    %s" % _date(docket.date_terminated),
+            "\n    %s" % _v(docket.docket_number),
+            "\n    %s" % _v(docket.nature_of_suit),
+            "\n    %s\n" % _v(docket.jury_demand),
+            "\n\n\n\n",
+            "\n    %s" % _v(court.full_name),
+            "\n    %s" % _v(court.citation_string),
+            "\n    %s\n" % _v(court.pk),
+            "\n\n\n\n",
+            "\n    ",
+            "\n        %s\n    " % _v(assigned_to.name_full)
+            if assigned_to
+            else "",
+            "\n",
+            "\n",
+            "\n    ",
+            "\n        %s\n    " % _v(referred_to.name_full)
+            if referred_to
+            else "",
+            "\n",
+            "\n\n\n\n",
+            "\n    ",
+            "\n        Chapter: %s\n    " % _v(chapter) if chapter else "",
+            "\n    %s\n" % _v(_lookup(bankr_info, "trustee_str")),
+            "\n",
+        ]
+    )
+
+
+def build_audio_text(item) -> str:
+    """Build the text of indexes/audio_text.txt."""
+    docket = item.docket
+    court = docket.court
+    return "".join(
+        [
+            "\n",
+            _case_name(item, ""),
+            "\n\n\n\n",
+            "%s\n" % _date(docket.date_argued),
+            "%s\n" % _date(docket.date_reargued),
+            "%s\n" % _date(docket.date_reargument_denied),
+            "%s\n" % _v(docket.docket_number),
+            "\n\n",
+            "\n    %s\n" % _v(item.transcript) if item.stt_status == 1 else "",
+            "\n\n\n",
+            "%s\n" % _v(court.full_name),
+            "%s\n" % _v(court.citation_string),
+            "%s\n" % _v(court.pk),
+            "\n\n",
+            "%s\n" % _v(item.sha1),
+            "%s\n" % _v(item.judges),
+        ]
+    )
+
+
+def build_person_text(item) -> str:
+    """Build the text of indexes/person_text.txt."""
+    aliases = "".join(
+        "\n    %s\n" % _v(alias.name_full) for alias in item.aliases.all()
+    )
+    positions = "".join(
+        "".join(
+            [
+                "\n    %s" % _v(p.get_position_type_display()),
+                "\n    %s" % _v(p.get_nomination_process_display()),
+                "\n    %s" % _v(p.get_judicial_committee_action_display()),
+                "\n    %s" % _v(p.get_how_selected_display()),
+                "\n    %s" % _v(p.get_termination_reason_display()),
+                "\n    %s" % _v(_lookup(p, "court", "full_name")),
+                "\n    %s" % _v(_lookup(p, "court", "citation_string")),
+                "\n    %s" % _v(_lookup(p, "court", "pk")),
+                "\n    %s" % _v(p.organization_name),
+                "\n    %s\n" % _v(p.job_title),
+            ]
+        )
+        for p in item.positions.all()
+    )
+    parties = "".join(
+        "\n    %s\n" % _v(pa.get_political_party_display())
+        for pa in item.political_affiliations.all()
+    )
+    schools = "".join(
+        "\n    %s\n" % _v(_lookup(e, "school", "name"))
+        for e in item.educations.all()
+    )
+    ratings = "".join(
+        "\n    %s\n" % _v(aba.get_rating_display())
+        for aba in item.aba_ratings.all()
+    )
+    return "".join(
+        [
+            "\n",
+            "%s\n" % _v(item.name_full),
+            aliases,
+            "\n\n",
+            "%s\n" % _v(item.dob_city),
+            "%s\n" % _v(item.get_dob_state_display()),
+            positions,
+            "\n\n",
+            parties,
+            "\n\n",
+            schools,
+            "\n\n",
+            ratings,
+            "\n\n",
+            "%s\n" % _v(item.fjc_id),
+            "%s\n" % _v(item.cl_id),
+            "%s\n" % _v(item.get_gender_display()),
+            "%s\n" % _v(item.religion),
+        ]
+    )
+
+
+INDEX_TEXT_BUILDERS: Dict[str, Callable[..., str]] = {
+    "indexes/opinion_text.txt": build_opinion_text,
+    "indexes/dockets_text.txt": build_recap_text,
+    "indexes/audio_text.txt": build_audio_text,
+    "indexes/person_text.txt": build_person_text,
+}
+
+
+def render_index_text(template_name: str, context: Dict[str, Any]) -> str:
+    """Make the text field of a search document.
+
+    :param template_name: The template that the text is made from
+    :param context: The context to render the template with
+    :return: The text, with null and control characters removed.
+    """
+    builder = INDEX_TEXT_BUILDERS.get(template_name)
+    if builder is None or settings.INDEX_TEXT_USE_TEMPLATES:
+        text = loader.get_template(template_name).render(context)
+    else:
+        text = builder(**context)
+    return text.translate(null_map)
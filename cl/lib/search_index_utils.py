@@ -1,6 +1,11 @@
 from datetime import date
+from typing import Iterable, Set
 
 from cl.lib.date_time import midnight_pst
+from cl.lib.redis_utils import make_redis_interface
+
+# How long to remember unindexed docket changes before giving up on them.
+DOCKET_CHANGES_TTL = 60 * 60 * 24 * 30
 
 
 def solr_list(m2m_list, field):
@@ -52,3 +57,45 @@ def normalize_search_dicts(d):
         else:
             new_dict[k] = v
     return new_dict
+
+
+def make_docket_changes_key(docket_pk: int) -> str:
+    return "docket.search_changes:%s" % docket_pk
+
+
+def record_docket_changes(docket_pk: int, fields: Iterable[str]) -> None:
+    """Note that some of a docket's denormalized search fields have changed
+    since it was last indexed.
+
+    :param docket_pk: The PK of the docket that changed.
+    :param fields: The names of the fields that changed. These are Docket
+    field names or the pseudo-field "parties".
+    """
+    fields = list(fields)
+    if not fields:
+        return
+    r = make_redis_interface("CACHE")
+    key = make_docket_changes_key(docket_pk)
+    pipe = r.pipeline()
+    pipe.sadd(key, *fields)
+    pipe.expire(key, DOCKET_CHANGES_TTL)
+    pipe.execute()
+
+
+def get_docket_changes(docket_pk: int) -> Set[str]:
+    """Get the fields that changed on a docket since it was last indexed."""
+    r = make_redis_interface("CACHE")
+    return r.smembers(make_docket_changes_key(docket_pk))
+
+
+def clear_docket_changes(docket_pk: int, fields: Iterable[str]) -> None:
+    """Forget changes once they have been indexed.
+
+    Only the fields that were indexed are removed, so that changes recorded
+    while the indexer was running aren't lost.
+    """
+    fields = list(fields)
+    if not fields:
+        return
+    r = make_redis_interface("CACHE")
+    r.srem(make_docket_changes_key(docket_pk), *fields)
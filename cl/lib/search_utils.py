@@ -129,7 +129,7 @@ def get_query_citation(cd: CleanData) -> Optional[List[FullCaseCitation]]:
         matches = search_db_for_fullcitation(citations[0])
         if len(matches) == 1:
             # If more than one match, don't show the tip
-            return matches.result.docs[0]
+            return matches[0]
 
     return matches
 
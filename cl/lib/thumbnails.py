@@ -29,7 +29,8 @@ def make_png_thumbnail_for_instance(
         suffix=".pdf",
         buffering=0,  # Make sure it's on disk when we try to use it
     ) as tmp:
-        tmp.write(getattr(item, file_attr).read())
+        for chunk in getattr(item, file_attr).chunks():
+            tmp.write(chunk)
 
         command = [
             "pdftoppm",
@@ -1,5 +1,4 @@
 from django.db import models
-from django.template import loader
 from django.urls import reverse
 from django.utils.text import slugify
 from localflavor.us.models import (
@@ -23,11 +22,8 @@ from cl.lib.model_helpers import (
     validate_supervisor,
 )
 from cl.lib.models import AbstractDateTimeModel
-from cl.lib.search_index_utils import (
-    normalize_search_dicts,
-    null_map,
-    solr_list,
-)
+from cl.lib.search_index_text import render_index_text
+from cl.lib.search_index_utils import normalize_search_dicts, solr_list
 from cl.lib.string_utils import trunc
 from cl.search.models import Court
 
@@ -383,8 +379,9 @@ class Person(AbstractDateTimeModel):
             }
             out.update(p_out)
 
-        text_template = loader.get_template("indexes/person_text.txt")
-        out["text"] = text_template.render({"item": self}).translate(null_map)
+        out["text"] = render_index_text(
+            "indexes/person_text.txt", {"item": self}
+        )
 
         return normalize_search_dicts(out)
 
@@ -1,6 +1,7 @@
 # Code for merging PACER content into the DB
 import logging
 import re
+from collections import defaultdict
 from datetime import date, datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -24,6 +25,7 @@ from cl.lib.pacer import (
     normalize_attorney_contact,
     normalize_attorney_role,
 )
+from cl.lib.search_index_utils import record_docket_changes
 from cl.lib.string_utils import anonymize
 from cl.lib.utils import previous_and_next, remove_duplicate_dicts
 from cl.people_db.models import (
@@ -517,74 +519,431 @@ def merge_unnumbered_docket_entries(des):
     return winner
 
 
-def get_or_make_docket_entry(d, docket_entry):
-    """Lookup or create a docket entry to match the one that was scraped.
+def _normalize_date_filed(date_filed):
+    """Cast a scraped date_filed to a date.
 
-    :param d: The docket we expect to find it in.
-    :param docket_entry: The scraped dict from Juriscraper for the docket
-    entry.
-    :return Tuple of (de, de_created) or None, where:
-     - de is the DocketEntry object
-     - de_created is a boolean stating whether de was created or not
-     - None is returned when things fail.
+    For now we do dumb date conversion. This simply returns a date object with
+    the same year, month, and day, ignoring time and timezones. Once the DB is
+    upgraded to support timezones, we can do better.
     """
-    if docket_entry["document_number"]:
-        try:
-            de, de_created = DocketEntry.objects.get_or_create(
-                docket=d, entry_number=docket_entry["document_number"]
-            )
-        except DocketEntry.MultipleObjectsReturned:
-            logger.error(
-                "Multiple docket entries found for document "
-                "entry number '%s' while processing '%s'",
-                docket_entry["document_number"],
-                d,
+    if isinstance(date_filed, datetime):
+        return date_filed.date()
+    return date_filed
+
+
+class DocketEntryMerger(object):
+    """Merge scraped docket entries into a docket with a fixed number of
+    queries.
+
+    Everything the merge could match is loaded up front: the docket's
+    numbered entries with the numbers in the upload and its unnumbered
+    entries on the dates in the upload, along with their documents. Each
+    scraped entry is then matched in memory, using the same lookups that
+    were previously done one query at a time, and the results are written
+    back with bulk creates and updates.
+
+    The in-memory view is kept current as entries are merged, so that an
+    upload that mentions the same entry twice updates it twice, as it did
+    when every entry was written as soon as it was matched.
+    """
+
+    RD_FIELDS = (
+        "pk",
+        "docket_entry_id",
+        "document_type",
+        "document_number",
+        "attachment_number",
+        "pacer_doc_id",
+        "description",
+        "date_created",
+        "date_modified",
+    )
+
+    def __init__(self, d: Docket, docket_entries: List[Dict[str, Any]]):
+        self.d = d
+        # Docket entries by number, and unnumbered ones by date. Entries that
+        # have not been created yet live here too.
+        self.numbered: Dict[int, List[DocketEntry]] = defaultdict(list)
+        self.unnumbered: Dict[date, List[DocketEntry]] = defaultdict(list)
+        # RECAP documents and descriptions by the id() of their docket entry,
+        # since entries we're about to create have no pk yet.
+        self.rds: Dict[int, List[RECAPDocument]] = defaultdict(list)
+        self.rd_descriptions: Dict[int, set] = defaultdict(set)
+
+        self.des_to_create: List[DocketEntry] = []
+        self.des_to_update: Dict[int, DocketEntry] = {}
+        self.rds_to_create: List[RECAPDocument] = []
+        self.rds_to_update: Dict[int, RECAPDocument] = {}
+        self.deleted: set = set()
+        self.preload(docket_entries)
+
+    def preload(self, docket_entries: List[Dict[str, Any]]) -> None:
+        """Load every entry and document the upload could match."""
+        numbers = set()
+        dates = set()
+        for docket_entry in docket_entries:
+            if docket_entry["document_number"]:
+                numbers.add(int(docket_entry["document_number"]))
+            else:
+                dates.add(_normalize_date_filed(docket_entry["date_filed"]))
+        des = list(
+            DocketEntry.objects.filter(docket=self.d).filter(
+                Q(entry_number__in=numbers)
+                | Q(entry_number=None, date_filed__in=dates)
             )
-            return None
-    else:
+        )
+        des_by_pk = {}
+        for de in des:
+            des_by_pk[de.pk] = de
+            if de.entry_number is None:
+                self.unnumbered[de.date_filed].append(de)
+            else:
+                self.numbered[de.entry_number].append(de)
+        rds = RECAPDocument.objects.filter(docket_entry__in=des).only(
+            *self.RD_FIELDS
+        )
+        for rd in rds:
+            de = des_by_pk[rd.docket_entry_id]
+            self.rds[id(de)].append(rd)
+            self.rd_descriptions[id(de)].add(rd.description)
+
+    def get_or_make_docket_entry(
+        self, docket_entry: Dict[str, Any]
+    ) -> Optional[Tuple[DocketEntry, bool]]:
+        """Lookup or make a docket entry to match the one that was scraped.
+
+        :param docket_entry: The scraped dict from Juriscraper for the docket
+        entry.
+        :return Tuple of (de, de_created) or None, where:
+         - de is the DocketEntry object
+         - de_created is a boolean stating whether de was created or not
+         - None is returned when things fail.
+        """
+        if docket_entry["document_number"]:
+            entry_number = int(docket_entry["document_number"])
+            candidates = self.numbered[entry_number]
+            if len(candidates) > 1:
+                logger.error(
+                    "Multiple docket entries found for document "
+                    "entry number '%s' while processing '%s'",
+                    docket_entry["document_number"],
+                    self.d,
+                )
+                return None
+            if candidates:
+                return candidates[0], False
+            de = DocketEntry(docket=self.d, entry_number=entry_number)
+            candidates.append(de)
+            self.des_to_create.append(de)
+            return de, True
+
         # Unnumbered entry. The only thing we can be sure we have is a
         # date. Try to find it by date and description (short or long)
         normalize_long_description(docket_entry)
-        query = Q()
-        if docket_entry.get("description"):
-            query |= Q(description=docket_entry["description"])
-        if docket_entry.get("short_description"):
-            query |= Q(
-                recap_documents__description=docket_entry["short_description"]
+        description = docket_entry.get("description")
+        short_description = docket_entry.get("short_description")
+        date_filed = _normalize_date_filed(docket_entry["date_filed"])
+        candidates = self.unnumbered[date_filed]
+        if description or short_description:
+            matches = [
+                de
+                for de in candidates
+                if (description and de.description == description)
+                or (
+                    short_description
+                    and short_description in self.rd_descriptions[id(de)]
+                )
+            ]
+        else:
+            matches = list(candidates)
+
+        if len(matches) == 0:
+            de = DocketEntry(docket=self.d, entry_number=None)
+            # Set the date now so later entries can find this one
+            de.date_filed = date_filed
+            candidates.append(de)
+            self.des_to_create.append(de)
+            return de, True
+        elif len(matches) == 1:
+            return matches[0], False
+
+        logger.warning(
+            "Multiple docket entries returned for unnumbered docket "
+            "entry on date: %s while processing %s. Attempting merge",
+            docket_entry["date_filed"],
+            self.d,
+        )
+        # There's so little metadata with unnumbered des that if there's
+        # more than one match, we can just select the oldest as canonical.
+        # Entries we haven't created yet are newer than any that exist.
+        saved = [de for de in matches if de.pk is not None]
+        if saved:
+            winner = merge_unnumbered_docket_entries(
+                DocketEntry.objects.filter(pk__in=[de.pk for de in saved])
             )
-
-        des = DocketEntry.objects.filter(
-            query,
-            docket=d,
-            date_filed=docket_entry["date_filed"],
-            entry_number=docket_entry["document_number"],
+            winner = next(de for de in saved if de.pk == winner.pk)
+        else:
+            winner = matches[0]
+        for de in matches:
+            if de is winner:
+                continue
+            self.deleted.add(id(de))
+            candidates.remove(de)
+            self.des_to_update.pop(id(de), None)
+            if de in self.des_to_create:
+                self.des_to_create.remove(de)
+            # Their documents went with them.
+            self.rds_to_create = [
+                rd for rd in self.rds_to_create if rd.docket_entry is not de
+            ]
+            for rd in self.rds.pop(id(de), []):
+                self.rds_to_update.pop(id(rd), None)
+        return winner, False
+
+    def update_docket_entry(
+        self, de: DocketEntry, docket_entry: Dict[str, Any]
+    ) -> None:
+        """Apply the scraped values to a docket entry, and queue it for saving
+        if anything changed.
+        """
+        old_values = (
+            de.description,
+            de.date_filed,
+            de.pacer_sequence_number,
+            de.recap_sequence_number,
         )
-        count = des.count()
-        if count == 0:
-            de = DocketEntry(
-                docket=d, entry_number=docket_entry["document_number"]
+        de.description = docket_entry["description"] or de.description
+        date_filed = _normalize_date_filed(docket_entry["date_filed"])
+        de.date_filed = date_filed or de.date_filed
+        de.pacer_sequence_number = (
+            docket_entry.get("pacer_seq_no") or de.pacer_sequence_number
+        )
+        de.recap_sequence_number = docket_entry["recap_sequence_number"]
+        new_values = (
+            de.description,
+            de.date_filed,
+            de.pacer_sequence_number,
+            de.recap_sequence_number,
+        )
+        if de.pk is not None and new_values != old_values:
+            self.des_to_update[id(de)] = de
+
+    def get_or_make_recap_document(
+        self, de: DocketEntry, docket_entry: Dict[str, Any]
+    ) -> Optional[Tuple[RECAPDocument, bool]]:
+        """Find the RECAPDocument for a scraped docket entry, or make one.
+
+        :return Tuple of (rd, rd_created), or None if there's more than one
+        match or if a new document would violate RECAPDocument's constraints.
+        """
+        # Normalize to "" here. Unsure why, but RECAPDocuments have a char
+        # field for this field while DocketEntries have a integer field.
+        document_number = str(docket_entry["document_number"] or "")
+        description = None
+        if not docket_entry["document_number"] and docket_entry.get(
+            "short_description"
+        ):
+            description = docket_entry["short_description"]
+        attachment_number = None
+        if docket_entry.get("attachment_number"):
+            document_type = RECAPDocument.ATTACHMENT
+            attachment_number = int(docket_entry["attachment_number"])
+        else:
+            document_type = RECAPDocument.PACER_DOCUMENT
+
+        matches = [
+            rd
+            for rd in self.rds[id(de)]
+            if rd.document_number == document_number
+            and rd.document_type == document_type
+            and (
+                attachment_number is None
+                or rd.attachment_number == attachment_number
             )
-            de_created = True
-        elif count == 1:
-            de = des[0]
-            de_created = False
+            and (description is None or rd.description == description)
+        ]
+        if len(matches) > 1:
+            logger.info(
+                "Multiple recap documents found for document entry number'%s' "
+                "while processing '%s'"
+                % (docket_entry["document_number"], self.d)
+            )
+            return None
+        if matches:
+            return matches[0], False
+
+        rd = RECAPDocument(
+            docket_entry=de,
+            document_number=document_number,
+            document_type=document_type,
+            attachment_number=attachment_number,
+            description=description or "",
+            pacer_doc_id=docket_entry["pacer_doc_id"] or "",
+            is_available=False,
+        )
+        if not self.check_duplicates(de, rd):
+            return None
+        self.rds[id(de)].append(rd)
+        self.rds_to_create.append(rd)
+        return rd, True
+
+    def check_duplicates(self, de: DocketEntry, rd: RECAPDocument) -> bool:
+        """Do in memory what RECAPDocument.save does to avoid duplicates.
+
+        The DB can't enforce uniqueness when the attachment number is null, so
+        RECAPDocument.save looks for another document with the same numbers.
+        If there's one with the same pacer_doc_id, it's deleted in favor of
+        this one. Otherwise, the save fails.
+
+        :return: Whether the document can be saved.
+        """
+        if rd.attachment_number is not None:
+            return True
+        others = [
+            other
+            for other in self.rds[id(de)]
+            if other is not rd
+            and other.document_number == rd.document_number
+            and other.attachment_number is None
+        ]
+        if not others:
+            return True
+        if len(others) > 1 or others[0].pacer_doc_id != rd.pacer_doc_id:
+            # Happens from race conditions.
+            return False
+        other = others[0]
+        self.rds[id(de)].remove(other)
+        self.rds_to_update.pop(id(other), None)
+        if other.pk is None:
+            self.rds_to_create.remove(other)
         else:
-            logger.warning(
-                "Multiple docket entries returned for unnumbered docket "
-                "entry on date: %s while processing %s. Attempting merge",
-                docket_entry["date_filed"],
-                d,
+            other.delete()
+        return True
+
+    def update_recap_document(
+        self, de: DocketEntry, rd: RECAPDocument, docket_entry: Dict[str, Any]
+    ) -> bool:
+        """Apply the scraped values to a RECAPDocument, and queue it for
+        saving if anything changed.
+
+        :return: Whether the document can be saved.
+        """
+        old_values = (rd.pacer_doc_id, rd.description)
+        rd.pacer_doc_id = rd.pacer_doc_id or docket_entry["pacer_doc_id"] or ""
+        rd.description = (
+            docket_entry.get("short_description") or rd.description
+        )
+        self.rd_descriptions[id(de)].add(rd.description)
+        if rd.pk is None:
+            return True
+        if not self.check_duplicates(de, rd):
+            return False
+        if (rd.pacer_doc_id, rd.description) != old_values:
+            self.rds_to_update[id(rd)] = rd
+        return True
+
+    def save_docket_entries(self) -> None:
+        """Write the new and changed docket entries to the DB."""
+        DocketEntry.objects.bulk_create(self.des_to_create, batch_size=1000)
+        if self.des_to_update:
+            # bulk_update doesn't touch auto_now fields, so do that by hand.
+            modified = now()
+            for de in self.des_to_update.values():
+                de.date_modified = modified
+            DocketEntry.objects.bulk_update(
+                self.des_to_update.values(),
+                [
+                    "description",
+                    "date_filed",
+                    "pacer_sequence_number",
+                    "recap_sequence_number",
+                    "date_modified",
+                ],
+                batch_size=1000,
+            )
+
+    def drop_duplicates_created_since_preload(self) -> None:
+        """Do again for the DB what check_duplicates did for the preloaded
+        documents.
+
+        Main documents have no attachment number, so the DB can't keep
+        another process from creating the same one while this merge ran.
+        Look for those once more, and resolve them like RECAPDocument.save
+        does: delete the other one if it has the same pacer_doc_id, otherwise
+        don't create ours.
+        """
+        rds = [rd for rd in self.rds_to_create if rd.attachment_number is None]
+        if not rds:
+            return
+        others = defaultdict(list)
+        for other in RECAPDocument.objects.filter(
+            docket_entry_id__in={rd.docket_entry_id for rd in rds},
+            attachment_number=None,
+        ).only("pk", "docket_entry_id", "document_number", "pacer_doc_id"):
+            key = (other.docket_entry_id, other.document_number)
+            others[key].append(other)
+        pks_to_delete = []
+        for rd in rds:
+            dupes = others[(rd.docket_entry_id, rd.document_number)]
+            if not dupes:
+                continue
+            if len(dupes) > 1 or dupes[0].pacer_doc_id != rd.pacer_doc_id:
+                # Happens from race conditions.
+                self.rds_to_create.remove(rd)
+                continue
+            pks_to_delete.append(dupes[0].pk)
+        if pks_to_delete:
+            RECAPDocument.objects.filter(pk__in=pks_to_delete).delete()
+
+    def save_recap_documents(self) -> List[RECAPDocument]:
+        """Write the new and changed RECAP documents to the DB.
+
+        :return: The RECAPDocuments that were created.
+        """
+        try:
+            with transaction.atomic():
+                # Lock the docket so that other merges into it wait until
+                # these documents are in.
+                Docket.objects.select_for_update().only("pk").get(pk=self.d.pk)
+                self.drop_duplicates_created_since_preload()
+                RECAPDocument.objects.bulk_create(
+                    self.rds_to_create, batch_size=1000
+                )
+            rds_created = self.rds_to_create
+        except IntegrityError:
+            # Another process created some of these documents after we
+            # looked. Fall back to saving them one at a time so that
+            # RECAPDocument.save can sort out duplicates, as it would have
+            # if we'd done this all along.
+            rds_created = []
+            for rd in self.rds_to_create:
+                rd.pk = None
+                try:
+                    rd.save()
+                except ValidationError:
+                    # Happens from race conditions.
+                    continue
+                rds_created.append(rd)
+
+        if self.rds_to_update:
+            modified = now()
+            for rd in self.rds_to_update.values():
+                rd.date_modified = modified
+            RECAPDocument.objects.bulk_update(
+                self.rds_to_update.values(),
+                ["pacer_doc_id", "description", "date_modified"],
+                batch_size=1000,
             )
-            # There's so little metadata with unnumbered des that if there's
-            # more than one match, we can just select the oldest as canonical.
-            de = merge_unnumbered_docket_entries(des)
-            de_created = False
-    return de, de_created
+        return rds_created
 
 
 def add_docket_entries(d, docket_entries, tags=None):
     """Update or create the docket entries and documents.
 
+    This matches everything in memory against the docket's existing entries
+    and then writes the changes in bulk, so the number of queries doesn't grow
+    with the size of the upload. See DocketEntryMerger for details.
+
     :param d: The docket object to add things to and use for lookups.
     :param docket_entries: A list of dicts containing docket entry data.
     :param tags: A list of tag objects to apply to the recap documents and
@@ -594,92 +953,46 @@ def add_docket_entries(d, docket_entries, tags=None):
     """
     # Remove items without a date filed value.
     docket_entries = [de for de in docket_entries if de.get("date_filed")]
+    if not docket_entries:
+        return [], False
 
-    rds_created = []
-    content_updated = False
     calculate_recap_sequence_numbers(docket_entries)
+    merger = DocketEntryMerger(d, docket_entries)
+
+    # First, match or make every docket entry, and save them so that the
+    # new ones get pks for their documents to point to.
+    matched = []
     for docket_entry in docket_entries:
-        response = get_or_make_docket_entry(d, docket_entry)
+        response = merger.get_or_make_docket_entry(docket_entry)
         if response is None:
             continue
-        else:
-            de, de_created = response[0], response[1]
-
-        de.description = docket_entry["description"] or de.description
-        date_filed = docket_entry["date_filed"]
-        if isinstance(date_filed, datetime):
-            # For now we do dumb date conversion. This simply returns a date
-            # object with the same year, month, and day, ignoring time and
-            # timezones. Once the DB is upgraded to support timezones, we can
-            # do better.
-            date_filed = date_filed.date()
-
-        de.date_filed = date_filed or de.date_filed
-        de.pacer_sequence_number = (
-            docket_entry.get("pacer_seq_no") or de.pacer_sequence_number
-        )
-        de.recap_sequence_number = docket_entry["recap_sequence_number"]
-        de.save()
-        if tags:
-            for tag in tags:
-                tag.tag_object(de)
-
-        if de_created:
-            content_updated = True
-
-        # Then make the RECAPDocument object. Try to find it. If we do, update
-        # the pacer_doc_id field if it's blank. If we can't find it, create it
-        # or throw an error.
-        params = {
-            "docket_entry": de,
-            # Normalize to "" here. Unsure why, but RECAPDocuments have a
-            # char field for this field while DocketEntries have a integer
-            # field.
-            "document_number": docket_entry["document_number"] or "",
-        }
-        if not docket_entry["document_number"] and docket_entry.get(
-            "short_description"
-        ):
-            params["description"] = docket_entry["short_description"]
-
-        if docket_entry.get("attachment_number"):
-            params["document_type"] = RECAPDocument.ATTACHMENT
-            params["attachment_number"] = docket_entry["attachment_number"]
-        else:
-            params["document_type"] = RECAPDocument.PACER_DOCUMENT
-
-        try:
-            rd = RECAPDocument.objects.get(**params)
-        except RECAPDocument.DoesNotExist:
-            try:
-                rd = RECAPDocument.objects.create(
-                    pacer_doc_id=docket_entry["pacer_doc_id"],
-                    is_available=False,
-                    **params
-                )
-            except ValidationError:
-                # Happens from race conditions.
-                continue
-            rds_created.append(rd)
-        except RECAPDocument.MultipleObjectsReturned:
-            logger.info(
-                "Multiple recap documents found for document entry number'%s' "
-                "while processing '%s'" % (docket_entry["document_number"], d)
-            )
+        de = response[0]
+        merger.update_docket_entry(de, docket_entry)
+        matched.append((docket_entry, de))
+    matched = [(e, de) for e, de in matched if id(de) not in merger.deleted]
+    content_updated = bool(merger.des_to_create)
+    merger.save_docket_entries()
+
+    # Then make the RECAPDocument objects. Try to find each one. If we do,
+    # update the pacer_doc_id field if it's blank. If we can't find it,
+    # create it or skip it.
+    des_to_tag = {}
+    rds_to_tag = {}
+    for docket_entry, de in matched:
+        des_to_tag[id(de)] = de
+        response = merger.get_or_make_recap_document(de, docket_entry)
+        if response is None:
             continue
+        rd = response[0]
+        if merger.update_recap_document(de, rd, docket_entry):
+            rds_to_tag[id(rd)] = rd
+    rds_created = merger.save_recap_documents()
 
-        rd.pacer_doc_id = rd.pacer_doc_id or docket_entry["pacer_doc_id"]
-        rd.description = (
-            docket_entry.get("short_description") or rd.description
-        )
-        try:
-            rd.save()
-        except ValidationError:
-            # Happens from race conditions.
-            continue
-        if tags:
-            for tag in tags:
-                tag.tag_object(rd)
+    if tags:
+        rds_to_tag = [rd for rd in rds_to_tag.values() if rd.pk is not None]
+        for tag in tags:
+            tag.tag_objects(des_to_tag.values())
+            tag.tag_objects(rds_to_tag)
 
     return rds_created, content_updated
 
@@ -868,110 +1181,375 @@ def disassociate_extraneous_entities(
     ).delete()
 
 
-@transaction.atomic
-# Retry on transaction deadlocks; see #814.
-@retry(OperationalError, tries=2, delay=1, backoff=1, logger=logger)
-def add_parties_and_attorneys(d, parties):
-    """Add parties and attorneys from the docket data to the docket.
+def get_party_search_signature(d: Docket) -> Tuple[set, set, set]:
+    """Get the IDs of the parties, attorneys and firms on a docket, as they
+    appear in the search index.
 
-    :param d: The docket to update
-    :param parties: The parties to update the docket with, with their
-    associated attorney objects. This is typically the
-    docket_data['parties'] field.
-    :return: None
+    Comparing this before and after a merge tells us whether the docket's
+    search documents need their party fields updated.
+    """
+    return (
+        set(PartyType.objects.filter(docket=d).values_list("party_id")),
+        set(Role.objects.filter(docket=d).values_list("attorney_id")),
+        set(
+            AttorneyOrganizationAssociation.objects.filter(
+                docket=d
+            ).values_list("attorney_organization_id")
+        ),
+    )
 
+
+class PartyMerger(object):
+    """Merge scraped parties and attorneys into a docket in bulk.
+
+    Everything on the docket is loaded up front in a few queries: the parties
+    and their party types, and the attorneys and their roles. Each scraped
+    party and attorney is then matched in memory, using the same rules as
+    add_attorney, and the inserts, updates and deletes that result are
+    written back in bulk, in pk order, at the end. This keeps the
+    transaction short no matter how many parties a docket has, and makes
+    concurrent merges lock rows in the same order.
+
+    Objects that haven't been created yet have no pk, so the plan is keyed on
+    their id() until they're saved.
     """
-    if not parties:
-        # Exit early if no parties. Some dockets don't have any due to user
-        # preference, and if we don't bail early, we risk deleting everything
-        # we have.
-        return
 
-    normalize_attorney_roles(parties)
+    PARTY_TYPE_FIELDS = [
+        "extra_info",
+        "date_terminated",
+        "highest_offense_level_opening",
+        "highest_offense_level_terminated",
+    ]
+    ATTORNEY_CONTACT_FIELDS = ["contact_raw", "email", "phone", "fax"]
+
+    def __init__(self, d: Docket):
+        self.d = d
+
+        self.parties_by_name: Dict[str, Party] = {}
+        for p in Party.objects.filter(party_types__docket=d).distinct():
+            other = self.parties_by_name.get(p.name)
+            if other is None or p.date_created < other.date_created:
+                self.parties_by_name[p.name] = p
+        self.party_types: Dict[Tuple[int, str], PartyType] = {
+            (pt.party_id, pt.name): pt
+            for pt in PartyType.objects.filter(docket=d)
+        }
 
-    updated_parties = set()
-    updated_attorneys = set()
-    for party in parties:
-        ps = Party.objects.filter(
-            name=party["name"], party_types__docket=d
-        ).distinct()
-        count = ps.count()
-        if count == 0:
-            try:
-                p = Party.objects.create(name=party["name"])
-            except IntegrityError:
-                # Race condition. Object was created after our get and before
-                # our create. Try to get it again.
-                ps = Party.objects.filter(
-                    name=party["name"], party_types__docket=d
-                ).distinct()
-                count = ps.count()
-        if count == 1:
-            p = ps[0]
-        elif count >= 2:
-            p = ps.earliest("date_created")
-        updated_parties.add(p.pk)
+        self.attorneys_by_name: Dict[str, Attorney] = {}
+        for a in Attorney.objects.filter(roles__docket=d).distinct():
+            other = self.attorneys_by_name.get(a.name)
+            if other is None:
+                self.attorneys_by_name[a.name] = a
+            else:
+                logger.info(
+                    "Got too many results for atty: '%s'. Picking earliest."
+                    % a.name
+                )
+                if a.date_created < other.date_created:
+                    self.attorneys_by_name[a.name] = a
+        self.roles: Dict[Tuple[int, int], List[Role]] = defaultdict(list)
+        for r in Role.objects.filter(docket=d):
+            self.roles[(r.party_id, r.attorney_id)].append(r)
+
+        # The plan, filled in by add_party and add_attorney.
+        self.parties: Dict[int, Party] = {}
+        self.attorneys: Dict[int, Attorney] = {}
+        self.attorneys_to_update: Dict[int, Attorney] = {}
+        # (party, type name) -> (party, type name, values to set)
+        self.party_type_updates: Dict[tuple, tuple] = {}
+        # (party, type name) -> criminal counts or complaints
+        self.criminal_counts: Dict[tuple, list] = {}
+        self.criminal_complaints: Dict[tuple, list] = {}
+        # (party, attorney) -> (party, attorney, role dicts)
+        self.role_updates: Dict[tuple, tuple] = {}
+        # (attorney, org lookup key) -> (attorney, org info)
+        self.org_associations: Dict[tuple, tuple] = {}
+
+    def add_party(self, party: Dict[str, Any]) -> None:
+        """Plan the changes for a scraped party and its attorneys."""
+        p = self.parties_by_name.get(party["name"])
+        if p is None:
+            p = Party(name=party["name"])
+            self.parties_by_name[party["name"]] = p
+        self.parties[id(p)] = p
 
-        # If the party type doesn't exist, make a new one.
-        pts = p.party_types.filter(docket=d, name=party["type"])
         criminal_data = party.get("criminal_data")
-        update_dict = {
+        values = {
             "extra_info": party.get("extra_info", ""),
             "date_terminated": party.get("date_terminated"),
         }
         if criminal_data:
-            update_dict["highest_offense_level_opening"] = criminal_data[
+            values["highest_offense_level_opening"] = criminal_data[
                 "highest_offense_level_opening"
             ]
-            update_dict["highest_offense_level_terminated"] = criminal_data[
+            values["highest_offense_level_terminated"] = criminal_data[
                 "highest_offense_level_terminated"
             ]
-        if pts.exists():
-            pts.update(**update_dict)
-            pt = pts[0]
-        else:
-            pt = PartyType.objects.create(
-                docket=d, party=p, name=party["type"], **update_dict
-            )
+        key = (id(p), party["type"])
+        old_values = self.party_type_updates.get(key, (p, party["type"], {}))
+        self.party_type_updates[key] = (
+            p,
+            party["type"],
+            {**old_values[2], **values},
+        )
 
         # Criminal counts and complaints
         if criminal_data and criminal_data["counts"]:
-            CriminalCount.objects.filter(party_type=pt).delete()
-            CriminalCount.objects.bulk_create(
-                [
-                    CriminalCount(
-                        party_type=pt,
-                        name=criminal_count["name"],
-                        disposition=criminal_count["disposition"],
-                        status=CriminalCount.normalize_status(
-                            criminal_count["status"]
-                        ),
-                    )
-                    for criminal_count in criminal_data["counts"]
+            self.criminal_counts[key] = criminal_data["counts"]
+        if criminal_data and criminal_data["complaints"]:
+            self.criminal_complaints[key] = criminal_data["complaints"]
+
+        # Attorneys
+        for atty in party.get("attorneys", []):
+            self.add_attorney(atty, p)
+
+    def add_attorney(self, atty: Dict[str, Any], p: Party) -> None:
+        """Plan the changes for a scraped attorney. See add_attorney."""
+        atty_org_info, atty_info = normalize_attorney_contact(
+            atty["contact"], fallback_name=atty["name"]
+        )
+
+        # Try lookup by atty name in the docket.
+        a = self.attorneys_by_name.get(atty["name"])
+        if a is None:
+            # Couldn't find the attorney. Make one.
+            a = Attorney(name=atty["name"], contact_raw=atty["contact"])
+            self.attorneys_by_name[atty["name"]] = a
+        self.attorneys[id(a)] = a
+
+        # Associate the attorney with an org and update their contact info.
+        if atty["contact"]:
+            if atty_org_info:
+                self.org_associations[(id(a), atty_org_info["lookup_key"])] = (
+                    a,
+                    atty_org_info,
+                )
+
+            if atty_info:
+                old_values = [
+                    getattr(a, f) for f in self.ATTORNEY_CONTACT_FIELDS
+                ]
+                a.contact_raw = atty["contact"]
+                a.email = atty_info["email"]
+                a.phone = atty_info["phone"]
+                a.fax = atty_info["fax"]
+                new_values = [
+                    getattr(a, f) for f in self.ATTORNEY_CONTACT_FIELDS
                 ]
+                if a.pk is not None and new_values != old_values:
+                    self.attorneys_to_update[a.pk] = a
+
+        # Do roles
+        roles = atty["roles"]
+        if len(roles) == 0:
+            roles = [{"role": Role.UNKNOWN, "date_action": None}]
+        # Replace any earlier roles for the attorney and party.
+        self.role_updates[(id(p), id(a))] = (p, a, roles)
+
+    def save_parties_and_attorneys(self) -> None:
+        """Create and update the parties and attorneys themselves."""
+        Party.objects.bulk_create(
+            [p for p in self.parties.values() if p.pk is None]
+        )
+        Attorney.objects.bulk_create(
+            [a for a in self.attorneys.values() if a.pk is None]
+        )
+        if self.attorneys_to_update:
+            # bulk_update doesn't touch auto_now fields, so do that by hand.
+            modified = now()
+            attorneys = sorted(self.attorneys_to_update.items())
+            for _, a in attorneys:
+                a.date_modified = modified
+            Attorney.objects.bulk_update(
+                [a for _, a in attorneys],
+                self.ATTORNEY_CONTACT_FIELDS + ["date_modified"],
             )
 
-        if criminal_data and criminal_data["complaints"]:
-            CriminalComplaint.objects.filter(party_type=pt).delete()
-            CriminalComplaint.objects.bulk_create(
+    def save_party_types(self) -> None:
+        """Create and update the party types and their criminal data."""
+        to_create = []
+        to_update = {}
+        party_types = {}
+        for key, (p, name, values) in self.party_type_updates.items():
+            pt = self.party_types.get((p.pk, name))
+            if pt is None:
+                # If the party type doesn't exist, make a new one.
+                pt = PartyType(docket=self.d, party=p, name=name, **values)
+                to_create.append(pt)
+            elif any(getattr(pt, f) != v for f, v in values.items()):
+                for f, v in values.items():
+                    setattr(pt, f, v)
+                to_update[pt.pk] = pt
+            party_types[key] = pt
+        PartyType.objects.bulk_create(to_create)
+        if to_update:
+            PartyType.objects.bulk_update(
+                [pt for _, pt in sorted(to_update.items())],
+                self.PARTY_TYPE_FIELDS,
+            )
+
+        for model, data in (
+            (CriminalCount, self.criminal_counts),
+            (CriminalComplaint, self.criminal_complaints),
+        ):
+            if not data:
+                continue
+            model.objects.filter(
+                party_type__in=[party_types[key] for key in data.keys()]
+            ).delete()
+            model.objects.bulk_create(
                 [
-                    CriminalComplaint(
-                        party_type=pt,
-                        name=complaint["name"],
-                        disposition=complaint["disposition"],
-                    )
-                    for complaint in criminal_data["complaints"]
+                    self.make_criminal_item(model, party_types[key], item)
+                    for key, items in data.items()
+                    for item in items
                 ]
             )
 
-        # Attorneys
-        for atty in party.get("attorneys", []):
-            updated_attorneys.add(add_attorney(atty, p, d))
+    @staticmethod
+    def make_criminal_item(model, pt: PartyType, item: Dict[str, Any]):
+        """Make an unsaved criminal count or complaint for a party type."""
+        if model == CriminalCount:
+            return CriminalCount(
+                party_type=pt,
+                name=item["name"],
+                disposition=item["disposition"],
+                status=CriminalCount.normalize_status(item["status"]),
+            )
+        return CriminalComplaint(
+            party_type=pt,
+            name=item["name"],
+            disposition=item["disposition"],
+        )
+
+    def save_organizations(self) -> None:
+        """Add the attorneys to their organizations, making any
+        organizations that don't exist yet.
+        """
+        if not self.org_associations:
+            return
+        org_infos = {
+            info["lookup_key"]: info
+            for _, info in self.org_associations.values()
+        }
+        orgs = AttorneyOrganization.objects.filter(
+            lookup_key__in=org_infos.keys()
+        ).in_bulk(field_name="lookup_key")
+        missing = [
+            AttorneyOrganization(**info)
+            for key, info in sorted(org_infos.items())
+            if key not in orgs
+        ]
+        if missing:
+            # Other processes may be making the same organizations. Let the
+            # DB skip those and look everything up again.
+            AttorneyOrganization.objects.bulk_create(
+                missing, ignore_conflicts=True
+            )
+            orgs = AttorneyOrganization.objects.filter(
+                lookup_key__in=org_infos.keys()
+            ).in_bulk(field_name="lookup_key")
+
+        AttorneyOrganizationAssociation.objects.bulk_create(
+            [
+                AttorneyOrganizationAssociation(
+                    attorney=a,
+                    attorney_organization=orgs[info["lookup_key"]],
+                    docket=self.d,
+                )
+                for a, info in self.org_associations.values()
+                if info["lookup_key"] in orgs
+            ],
+            ignore_conflicts=True,
+        )
+
+    def save_roles(self) -> None:
+        """Replace the roles of every attorney and party we saw, leaving
+        alone the ones that didn't change.
+        """
+        to_delete = []
+        to_create = []
+        for p, a, roles in self.role_updates.values():
+            existing = {
+                (r.role, r.date_action, r.role_raw): r
+                for r in self.roles.get((p.pk, a.pk), [])
+            }
+            wanted = {}
+            for atty_role in roles:
+                role = Role(attorney=a, party=p, docket=self.d, **atty_role)
+                # Roles are unique on everything but their raw value.
+                wanted.setdefault((role.role, role.date_action), role)
+            wanted_keys = {
+                (r.role, r.date_action, r.role_raw) for r in wanted.values()
+            }
+            to_delete.extend(
+                r.pk for key, r in existing.items() if key not in wanted_keys
+            )
+            to_create.extend(
+                r
+                for r in wanted.values()
+                if (r.role, r.date_action, r.role_raw) not in existing
+            )
+        if to_delete:
+            Role.objects.filter(pk__in=sorted(to_delete)).delete()
+        Role.objects.bulk_create(to_create)
+
+    def save(self) -> Tuple[set, set]:
+        """Write the plan to the DB.
+
+        :return: A tuple of the IDs of the parties and attorneys that were
+        created or updated.
+        """
+        self.save_parties_and_attorneys()
+        self.save_party_types()
+        self.save_organizations()
+        self.save_roles()
+        return (
+            {p.pk for p in self.parties.values()},
+            {a.pk for a in self.attorneys.values()},
+        )
+
+
+@transaction.atomic
+# Retry on transaction deadlocks; see #814.
+@retry(OperationalError, tries=2, delay=1, backoff=1, logger=logger)
+def add_parties_and_attorneys(d, parties):
+    """Add parties and attorneys from the docket data to the docket.
+
+    Everything is matched in memory and written in bulk by PartyMerger, so
+    the number of queries, and the time spent holding locks, doesn't grow with
+    the number of parties.
+
+    :param d: The docket to update
+    :param parties: The parties to update the docket with, with their
+    associated attorney objects. This is typically the
+    docket_data['parties'] field.
+    :return: None
+
+    """
+    if not parties:
+        # Exit early if no parties. Some dockets don't have any due to user
+        # preference, and if we don't bail early, we risk deleting everything
+        # we have.
+        return
+
+    normalize_attorney_roles(parties)
+
+    if d.date_last_index is not None:
+        signature = get_party_search_signature(d)
+
+    merger = PartyMerger(d)
+    for party in parties:
+        merger.add_party(party)
+    updated_parties, updated_attorneys = merger.save()
 
     disassociate_extraneous_entities(
         d, parties, updated_parties, updated_attorneys
     )
 
+    if d.date_last_index is not None:
+        if get_party_search_signature(d) != signature:
+            record_docket_changes(d.pk, ["parties"])
+
 
 @transaction.atomic
 def add_bankruptcy_data_to_docket(d: Docket, metadata: Dict[str, str]) -> None:
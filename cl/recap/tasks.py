@@ -1,13 +1,14 @@
+import hashlib
 import logging
 from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple
+from typing import IO, List, Optional, Tuple
 from zipfile import ZipFile
 
 import requests
 from celery import Task
 from celery.canvas import chain
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import IntegrityError, transaction
 from django.utils.timezone import now
@@ -33,7 +34,6 @@ from cl.corpus_importer.tasks import (
 )
 from cl.corpus_importer.utils import mark_ia_upload_needed
 from cl.custom_filters.templatetags.text_filters import oxford_join
-from cl.lib.crypto import sha1
 from cl.lib.filesizes import convert_size_to_bytes
 from cl.lib.pacer import map_cl_to_pacer_id
 from cl.lib.pacer_session import get_pacer_cookie_from_cache
@@ -62,6 +62,7 @@ from cl.recap.models import (
     PacerHtmlFiles,
     ProcessingQueue,
 )
+from cl.recap.utils import RecapUploadCache, get_upload_fingerprint
 from cl.scrapers.tasks import extract_recap_pdf, get_page_count
 from cl.search.models import Docket, DocketEntry, RECAPDocument
 from cl.search.tasks import add_items_to_solr, add_or_update_recap_docket
@@ -69,6 +70,10 @@ from cl.search.tasks import add_items_to_solr, add_or_update_recap_docket
 logger = logging.getLogger(__name__)
 cnt = CaseNameTweaker()
 
+UNCHANGED_UPLOAD_MESSAGE = (
+    "Successful upload! Nothing has changed since this page was last uploaded."
+)
+
 
 def process_recap_upload(pq: ProcessingQueue) -> None:
     """Process an item uploaded from an extension or API user.
@@ -131,7 +136,7 @@ def do_pacer_fetch(fq):
     return result
 
 
-def mark_pq_successful(pq, d_id=None, de_id=None, rd_id=None):
+def mark_pq_successful(pq, d_id=None, de_id=None, rd_id=None, msg=None):
     """Mark the processing queue item as successfully completed.
 
     :param pq: The ProcessingQueue object to manipulate
@@ -141,10 +146,13 @@ def mark_pq_successful(pq, d_id=None, de_id=None, rd_id=None):
     to document uploads, which are associated with docket entries.
     :param rd_id: The RECAPDocument PK to associate with this upload. Only
     applies to document uploads (obviously).
+    :param msg: A message to save instead of the usual one.
     """
     # Ditch the original file
     pq.filepath_local.delete(save=False)
-    if pq.debug:
+    if msg:
+        pq.error_message = msg
+    elif pq.debug:
         pq.error_message = "Successful debugging upload! Nice work."
     else:
         pq.error_message = "Successful upload! Nice work."
@@ -156,6 +164,43 @@ def mark_pq_successful(pq, d_id=None, de_id=None, rd_id=None):
     return pq.status, pq.error_message
 
 
+def find_unchanged_upload(
+    pq: ProcessingQueue, fingerprint: str
+) -> Optional[int]:
+    """Find the docket that the last upload of a case was merged into, if
+    that upload was the same as this one.
+
+    :param pq: The ProcessingQueue object of the upload
+    :param fingerprint: The fingerprint of the uploaded HTML
+    :return: The PK of the docket, or None if the upload has to be merged.
+    """
+    if pq.debug or not pq.pacer_case_id:
+        return None
+    d_pk = RecapUploadCache().get_docket_pk(
+        pq.court_id, pq.pacer_case_id, pq.upload_type, fingerprint
+    )
+    if d_pk is None:
+        return None
+    # The docket could have been deleted or merged away since.
+    if not Docket.objects.filter(pk=d_pk, court_id=pq.court_id).exists():
+        return None
+    return d_pk
+
+
+def remember_upload(pq: ProcessingQueue, fingerprint: str, d_pk: int) -> None:
+    """Remember that an upload was merged into a docket, so that the same
+    upload can be skipped next time.
+
+    :param pq: The ProcessingQueue object of the upload
+    :param fingerprint: The fingerprint of the uploaded HTML
+    :param d_pk: The PK of the docket the upload was merged into
+    """
+    if pq.pacer_case_id:
+        RecapUploadCache().set_docket_pk(
+            pq.court_id, pq.pacer_case_id, pq.upload_type, fingerprint, d_pk
+        )
+
+
 def mark_pq_status(pq, msg, status):
     """Mark the processing queue item as some process, and log the message.
 
@@ -171,6 +216,25 @@ def mark_pq_status(pq, msg, status):
     return pq.status, pq.error_message
 
 
+def spool_file(f: File, tmp: IO[bytes]) -> Tuple[str, int]:
+    """Copy a file to a local temporary file in chunks, hashing it on the way.
+
+    :param f: The file to copy, such as the file of a processing queue item
+    :param tmp: An open temporary file to copy it to
+    :return: The SHA1 hexdigest of the file and its size in bytes.
+    """
+    sha1sum = hashlib.sha1()
+    size = 0
+    for chunk in f.chunks():
+        sha1sum.update(chunk)
+        tmp.write(chunk)
+        size += len(chunk)
+    # Make sure it's on disk for anything that reads it by name.
+    tmp.flush()
+    tmp.seek(0)
+    return sha1sum.hexdigest(), size
+
+
 @app.task(
     bind=True, max_retries=2, interval_start=5 * 60, interval_step=10 * 60
 )
@@ -272,54 +336,49 @@ def process_recap_pdf(self, pk):
     rd.document_number = pq.document_number
     rd.attachment_number = pq.attachment_number
 
-    # Do the file, finally.
-    try:
-        content = pq.filepath_local.read()
-    except IOError as exc:
-        msg = "Internal processing error (%s: %s)." % (exc.errno, exc.strerror)
-        if (self.request.retries == self.max_retries) or pq.debug:
-            mark_pq_status(pq, msg, PROCESSING_STATUS.FAILED)
-            return None
-        else:
-            mark_pq_status(pq, msg, PROCESSING_STATUS.QUEUED_FOR_RETRY)
-            raise self.retry(exc=exc)
+    # Do the file, finally. It's spooled to local disk once and hashed on
+    # the way, and that copy is used for the page count and moved to storage.
+    with NamedTemporaryFile(prefix="recap_pdf_", suffix=".pdf") as tmp:
+        try:
+            new_sha1, file_size = spool_file(pq.filepath_local, tmp)
+        except IOError as exc:
+            msg = "Internal processing error (%s: %s)." % (
+                exc.errno,
+                exc.strerror,
+            )
+            if (self.request.retries == self.max_retries) or pq.debug:
+                mark_pq_status(pq, msg, PROCESSING_STATUS.FAILED)
+                return None
+            else:
+                mark_pq_status(pq, msg, PROCESSING_STATUS.QUEUED_FOR_RETRY)
+                raise self.retry(exc=exc)
 
-    new_sha1 = sha1(content)
-    existing_document = all(
-        [
-            rd.sha1 == new_sha1,
-            rd.is_available,
-            rd.filepath_local,
-        ]
-    )
-    if not existing_document:
-        # Different sha1, it wasn't available, or it's missing from disk. Move
-        # the new file over from the processing queue storage.
-        cf = ContentFile(content)
-        file_name = get_document_filename(
-            rd.docket_entry.docket.court_id,
-            rd.docket_entry.docket.pacer_case_id,
-            rd.document_number,
-            rd.attachment_number,
+        existing_document = all(
+            [
+                rd.sha1 == new_sha1,
+                rd.is_available,
+                rd.filepath_local,
+            ]
         )
-        if not pq.debug:
-            rd.filepath_local.save(file_name, cf, save=False)
-
-            # Do page count and extraction
-            extension = rd.filepath_local.name.split(".")[-1]
-            with NamedTemporaryFile(
-                prefix="rd_page_count_",
-                suffix=f".{extension}",
-                buffering=0,
-            ) as tmp:
-                tmp.write(content)
+        if not existing_document:
+            # Different sha1, it wasn't available, or it's missing from disk.
+            # Move the new file over from the processing queue storage.
+            file_name = get_document_filename(
+                rd.docket_entry.docket.court_id,
+                rd.docket_entry.docket.pacer_case_id,
+                rd.document_number,
+                rd.attachment_number,
+            )
+            if not pq.debug:
+                rd.filepath_local.save(file_name, File(tmp), save=False)
+                extension = rd.filepath_local.name.split(".")[-1]
                 rd.page_count = get_page_count(tmp.name, extension)
-                rd.file_size = rd.filepath_local.size
+                rd.file_size = file_size
 
-        rd.ocr_status = None
-        rd.is_available = True
-        rd.sha1 = new_sha1
-        rd.date_upload = now()
+            rd.ocr_status = None
+            rd.is_available = True
+            rd.sha1 = new_sha1
+            rd.date_upload = now()
 
     if not pq.debug:
         try:
@@ -331,8 +390,12 @@ def process_recap_pdf(self, pk):
             return None
 
     if not existing_document and not pq.debug:
-        extract_recap_pdf(rd.pk)
-        add_items_to_solr([rd.pk], "search.RECAPDocument")
+        # Extraction can mean OCR, which can take a long time, so don't hold
+        # up the upload for it. The item is indexed once it has its text.
+        extract_recap_pdf.apply_async(
+            (rd.pk,),
+            link=add_items_to_solr.si([rd.pk], "search.RECAPDocument"),
+        )
 
     mark_pq_successful(
         pq,
@@ -479,6 +542,15 @@ def process_recap_docket(self, pk):
         self.request.chain = None
         return None
 
+    fingerprint = get_upload_fingerprint(text)
+    d_pk = find_unchanged_upload(pq, fingerprint)
+    if d_pk is not None:
+        # Nothing has changed since the last time this page was uploaded, so
+        # there's nothing to parse, save or merge.
+        mark_pq_successful(pq, d_id=d_pk, msg=UNCHANGED_UPLOAD_MESSAGE)
+        self.request.chain = None
+        return {"docket_pk": d_pk, "content_updated": False}
+
     report._parse_text(text)
     data = report.data
     logger.info("Parsing completed of item %s" % pq)
@@ -525,6 +597,7 @@ def process_recap_docket(self, pk):
         newly_enqueued = enqueue_docket_alert(d.pk)
         if newly_enqueued:
             send_docket_alert(d.pk, start_time)
+    remember_upload(pq, fingerprint, d.pk)
     mark_pq_successful(pq, d_id=d.pk)
     return {
         "docket_pk": d.pk,
@@ -828,6 +901,15 @@ def process_recap_appellate_docket(self, pk):
             mark_pq_status(pq, msg, PROCESSING_STATUS.QUEUED_FOR_RETRY)
             raise self.retry(exc=exc)
 
+    fingerprint = get_upload_fingerprint(text)
+    d_pk = find_unchanged_upload(pq, fingerprint)
+    if d_pk is not None:
+        # Nothing has changed since the last time this page was uploaded, so
+        # there's nothing to parse, save or merge.
+        mark_pq_successful(pq, d_id=d_pk, msg=UNCHANGED_UPLOAD_MESSAGE)
+        self.request.chain = None
+        return {"docket_pk": d_pk, "content_updated": False}
+
     report._parse_text(text)
     data = report.data
     logger.info("Parsing completed of item %s" % pq)
@@ -878,6 +960,7 @@ def process_recap_appellate_docket(self, pk):
         newly_enqueued = enqueue_docket_alert(d.pk)
         if newly_enqueued:
             send_docket_alert(d.pk, start_time)
+    remember_upload(pq, fingerprint, d.pk)
     mark_pq_successful(pq, d_id=d.pk)
     return {
         "docket_pk": d.pk,
@@ -1,13 +1,16 @@
 import json
 import os
 from datetime import date
+from tempfile import NamedTemporaryFile
 from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from juriscraper.pacer import PacerRssFeed
 from rest_framework.status import (
@@ -30,6 +33,7 @@ from cl.people_db.models import (
 )
 from cl.recap.management.commands.import_idb import Command
 from cl.recap.mergers import (
+    DocketEntryMerger,
     add_attorney,
     add_docket_entries,
     add_parties_and_attorneys,
@@ -44,9 +48,11 @@ from cl.recap.models import (
     UPLOAD_TYPE,
     EmailProcessingQueue,
     PacerFetchQueue,
+    PacerHtmlFiles,
     ProcessingQueue,
 )
 from cl.recap.tasks import (
+    UNCHANGED_UPLOAD_MESSAGE,
     do_pacer_fetch,
     fetch_pacer_doc_by_rd,
     process_recap_appellate_docket,
@@ -55,12 +61,16 @@ from cl.recap.tasks import (
     process_recap_docket,
     process_recap_pdf,
     process_recap_zip,
+    spool_file,
 )
+from cl.recap.utils import get_upload_fingerprint
+from cl.recap_rss.utils import DatabaseRssItemCache, RedisRssItemCache
 from cl.search.models import (
     Docket,
     DocketEntry,
     OriginatingCourtInformation,
     RECAPDocument,
+    Tag,
 )
 from cl.tests import fakes
 
@@ -661,6 +671,14 @@ class RecapPdfTaskTest(TestCase):
     def test_pq_has_default_status(self) -> None:
         self.assertTrue(self.pq.status == PROCESSING_STATUS.ENQUEUED)
 
+    def test_spool_file_hashes_what_it_copies(self) -> None:
+        """Does spooling a file copy it and get its SHA1 and size?"""
+        with NamedTemporaryFile() as tmp:
+            new_sha1, size = spool_file(self.pq.filepath_local, tmp)
+            self.assertEqual(tmp.read(), self.file_content)
+        self.assertEqual(new_sha1, self.rd.sha1)
+        self.assertEqual(size, len(self.file_content))
+
     @mock.patch("cl.recap.tasks.extract_recap_pdf")
     @mock.patch(
         "cl.lib.storage.get_name_by_incrementing",
@@ -727,9 +745,10 @@ class RecapPdfTaskTest(TestCase):
         self.assertTrue(rd.sha1)
         self.assertTrue(rd.filepath_local)
         self.assertIn("gov.uscourts.scotus.asdf.1.0", rd.filepath_local.name)
+        self.assertEqual(rd.file_size, len(self.file_content))
 
         mock_get_name.assert_called()
-        mock_extract.assert_called_once()
+        mock_extract.apply_async.assert_called_once()
 
         self.pq.refresh_from_db()
         self.assertEqual(self.pq.status, PROCESSING_STATUS.SUCCESSFUL)
@@ -1161,6 +1180,50 @@ class TerminatedEntitiesTest(TestCase):
         add_parties_and_attorneys(self.d, [])
         self.assertEqual(self.d.parties.count(), count_before)
 
+    def test_parties_merged_in_bulk(self) -> None:
+        """Does merging parties take the same number of queries no matter how
+        many parties and attorneys there are, and are re-uploads idempotent?
+        """
+
+        def make_parties(count):
+            return [
+                {
+                    "extra_info": "",
+                    "name": "Party %s" % i,
+                    "type": "plaintiff",
+                    "attorneys": [
+                        {
+                            "contact": "Email: atty%s@example.com" % i,
+                            "name": "Attorney %s" % i,
+                            "roles": ["LEAD ATTORNEY"],
+                        }
+                    ],
+                    "date_terminated": None,
+                }
+                for i in range(count)
+            ]
+
+        query_counts = []
+        for count in (3, 30):
+            d = Docket.objects.create(source=0, court_id="scotus")
+            with CaptureQueriesContext(connection) as ctx:
+                add_parties_and_attorneys(d, make_parties(count))
+            query_counts.append(len(ctx.captured_queries))
+            self.assertEqual(d.parties.count(), count)
+            self.assertEqual(Role.objects.filter(docket=d).count(), count)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        role_pks = set(
+            Role.objects.filter(docket=d).values_list("pk", flat=True)
+        )
+        add_parties_and_attorneys(d, make_parties(30))
+        self.assertEqual(d.parties.count(), 30)
+        # Unchanged roles are left alone rather than replaced.
+        self.assertEqual(
+            set(Role.objects.filter(docket=d).values_list("pk", flat=True)),
+            role_pks,
+        )
+
 
 class RecapMinuteEntriesTest(TestCase):
     """Can we ingest minute and numberless entries properly?"""
@@ -1305,6 +1368,122 @@ class RecapMinuteEntriesTest(TestCase):
         expected_item_count = 1
         self.assertEqual(d.docket_entries.count(), expected_item_count)
 
+    def test_docket_entries_merged_in_bulk(self) -> None:
+        """Does merging docket entries take the same number of queries no
+        matter how many entries there are, and are re-uploads idempotent?
+        """
+        tag = Tag.objects.create(name="test-bulk-merge")
+
+        def make_entries(count):
+            return [
+                {
+                    "date_filed": date(2014, 11, 16),
+                    "description": "Entry %s" % i,
+                    "document_number": str(i),
+                    "pacer_doc_id": "0%s" % i,
+                    "pacer_seq_no": None,
+                }
+                for i in range(1, count + 1)
+            ]
+
+        query_counts = []
+        for count in (5, 50):
+            d = Docket.objects.create(source=0, court_id="scotus")
+            with CaptureQueriesContext(connection) as ctx:
+                rds_created, content_updated = add_docket_entries(
+                    d, make_entries(count), tags=[tag]
+                )
+            query_counts.append(len(ctx.captured_queries))
+            self.assertEqual(len(rds_created), count)
+            self.assertTrue(content_updated)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        # Uploading the same entries again changes nothing.
+        rds_created, content_updated = add_docket_entries(
+            d, make_entries(50), tags=[tag]
+        )
+        self.assertEqual(rds_created, [])
+        self.assertFalse(content_updated)
+        self.assertEqual(d.docket_entries.count(), 50)
+        self.assertEqual(
+            RECAPDocument.objects.filter(docket_entry__docket=d).count(), 50
+        )
+        self.assertEqual(tag.docket_entries.filter(docket=d).count(), 50)
+
+    def test_main_documents_created_during_merge_not_duplicated(self) -> None:
+        """If another process creates a main document after the merge loaded
+        the docket, is it sorted out instead of duplicated?
+        """
+        d = Docket.objects.create(source=0, court_id="scotus")
+        save_recap_documents = DocketEntryMerger.save_recap_documents
+
+        def save_after_another_process(merger):
+            # One with the same pacer_doc_id as the upload, and one without.
+            for number, pacer_doc_id in (("1", "01"), ("2", "")):
+                RECAPDocument.objects.create(
+                    docket_entry=DocketEntry.objects.get(
+                        docket=d, entry_number=int(number)
+                    ),
+                    document_number=number,
+                    pacer_doc_id=pacer_doc_id,
+                    document_type=RECAPDocument.PACER_DOCUMENT,
+                )
+            return save_recap_documents(merger)
+
+        with mock.patch.object(
+            DocketEntryMerger,
+            "save_recap_documents",
+            autospec=True,
+            side_effect=save_after_another_process,
+        ):
+            rds_created, _ = add_docket_entries(
+                d,
+                [
+                    {
+                        "date_filed": date(2014, 11, 16),
+                        "description": "Entry %s" % i,
+                        "document_number": str(i),
+                        "pacer_doc_id": "0%s" % i,
+                        "pacer_seq_no": None,
+                    }
+                    for i in (1, 2)
+                ],
+            )
+
+        # The other document 1 was replaced by ours, but the other document 2
+        # doesn't match, so ours wasn't created.
+        self.assertEqual([rd.document_number for rd in rds_created], ["1"])
+        rds = RECAPDocument.objects.filter(docket_entry__docket=d)
+        self.assertEqual(rds.count(), 2)
+        self.assertEqual(rds.get(document_number="1").pk, rds_created[0].pk)
+        self.assertEqual(rds.get(document_number="2").pacer_doc_id, "")
+
+
+class RssItemCacheTest(TestCase):
+    """Do the RSS item cache backends claim each item exactly once?"""
+
+    def test_claim_and_release(self) -> None:
+        for cache in (RedisRssItemCache(ttl=60), DatabaseRssItemCache()):
+            with self.subTest(cache=cache):
+                cache.release(["a", "b", "c"])
+                self.assertEqual(cache.claim(["a", "b", "a"]), {"a", "b"})
+                self.assertEqual(cache.claim(["a", "b", "c"]), {"c"})
+                cache.release(["b"])
+                self.assertEqual(cache.claim(["a", "b", "c"]), {"b"})
+                cache.release(["a", "b", "c"])
+
+    def test_claims_expire_until_marked_merged(self) -> None:
+        """Are claims kept for good only once their items are merged?"""
+        cache = RedisRssItemCache(ttl=600, claim_ttl=60)
+        key = cache.key_prefix + "a"
+        cache.release(["a"])
+        self.assertEqual(cache.claim(["a"]), {"a"})
+        self.assertLessEqual(cache.r.ttl(key), 60)
+        cache.mark_merged(["a"])
+        self.assertGreater(cache.r.ttl(key), 60)
+        self.assertEqual(cache.claim(["a"]), set())
+        cache.release(["a"])
+
 
 class DescriptionCleanupTest(TestCase):
     def test_has_entered_date_at_end(self) -> None:
@@ -1440,6 +1619,69 @@ class RecapDocketTaskTest(TestCase):
         pq.refresh_from_db()
         self.assertEqual(pq.status, PROCESSING_STATUS.SUCCESSFUL)
 
+    def test_unchanged_upload_is_skipped(self) -> None:
+        """If a docket is uploaded again without changes, do we skip merging
+        it, even if the PACER receipt changed?
+        """
+        text = self.pq.filepath_local.read().decode()
+        returned_data = process_recap_docket(self.pq.pk)
+        d = Docket.objects.get(pk=returned_data["docket_pk"])
+        self.assertEqual(PacerHtmlFiles.objects.count(), 1)
+
+        pq = ProcessingQueue.objects.create(
+            court_id="scotus",
+            uploader=self.user,
+            pacer_case_id="asdf",
+            filepath_local=SimpleUploadedFile(
+                self.filename,
+                text.replace(
+                    "Transaction Receipt", "Transaction Receipt\n"
+                ).encode(),
+            ),
+            upload_type=UPLOAD_TYPE.DOCKET,
+        )
+        with mock.patch("cl.recap.tasks.DocketReport._parse_text") as parse:
+            returned_data = process_recap_docket(pq.pk)
+        parse.assert_not_called()
+        self.assertEqual(returned_data["docket_pk"], d.pk)
+        self.assertFalse(returned_data["content_updated"])
+        self.assertEqual(PacerHtmlFiles.objects.count(), 1)
+        pq.refresh_from_db()
+        self.assertEqual(pq.status, PROCESSING_STATUS.SUCCESSFUL)
+        self.assertEqual(pq.error_message, UNCHANGED_UPLOAD_MESSAGE)
+        self.assertEqual(pq.docket_id, d.pk)
+
+    def test_fingerprint_ignores_the_receipt(self) -> None:
+        """Do uploads that only differ in the PACER receipt get the same
+        fingerprint, and others don't?
+        """
+        text = self.pq.filepath_local.read().decode()
+        self.assertIn("Transaction Receipt", text)
+        fingerprint = get_upload_fingerprint(text)
+        start = text.index("Transaction Receipt")
+        self.assertEqual(
+            fingerprint,
+            get_upload_fingerprint(
+                text[:start] + text[start:].replace("0", "1")
+            ),
+        )
+        self.assertNotEqual(
+            fingerprint,
+            get_upload_fingerprint(text.replace("ORDER OF TRANSFER", "ORDER")),
+        )
+
+    def test_fingerprint_keeps_tables_before_the_receipt(self) -> None:
+        """If a docket has another table like the receipt's before it, do
+        changes after that table still change the fingerprint?
+        """
+        text = self.pq.filepath_local.read().decode()
+        table = "<hr><center><table><tr><td>Header</td></tr></table></center>"
+        text = text.replace("ORDER OF TRANSFER", table + "ORDER OF TRANSFER")
+        self.assertNotEqual(
+            get_upload_fingerprint(text),
+            get_upload_fingerprint(text.replace("ORDER OF TRANSFER", "ORDER")),
+        )
+
 
 class ClaimsRegistryTaskTest(TestCase):
     """Can we handle claims registry uploads?"""
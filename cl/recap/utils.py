@@ -0,0 +1,84 @@
+import hashlib
+import re
+from typing import Optional
+
+from django.conf import settings
+
+from cl.lib.redis_utils import make_redis_interface
+
+# The receipt PACER puts at the bottom of reports has the time, the user and
+# the cost of the request, so it's different every time a page is loaded.
+# The match can't run past the end of a table, so it's only ever the receipt
+# table, never an earlier table and everything up to the receipt.
+IN_TABLE = r"(?:(?!</table>).)*?"
+PACER_RECEIPT_RE = re.compile(
+    rf"<hr>\s*<center>\s*<table[^>]*>{IN_TABLE}PACER\s+Service\s+Center"
+    rf"{IN_TABLE}Transaction\s+Receipt{IN_TABLE}</table>",
+    re.IGNORECASE | re.DOTALL,
+)
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def get_upload_fingerprint(text: str) -> str:
+    """Fingerprint the HTML of an uploaded PACER page.
+
+    The transaction receipt, comments and differences in whitespace are
+    ignored, so loading the same page again gives the same fingerprint.
+
+    :param text: The HTML of the page
+    :return: The SHA256 hexdigest of the normalized HTML.
+    """
+    text = PACER_RECEIPT_RE.sub("", text)
+    text = HTML_COMMENT_RE.sub("", text)
+    text = WHITESPACE_RE.sub(" ", text).strip()
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RecapUploadCache(object):
+    """Remember the last upload merged for each case, so that uploads of a
+    page that hasn't changed since can be skipped.
+
+    Keys are per court, case and upload type, and expire on their own.
+    """
+
+    key = "recap.upload:%s:%s:%s"
+
+    def __init__(self, ttl: int = settings.RECAP_UPLOAD_CACHE_TTL) -> None:
+        self.r = make_redis_interface("CACHE")
+        self.ttl = ttl
+
+    def get_docket_pk(
+        self,
+        court_id: str,
+        pacer_case_id: str,
+        upload_type: int,
+        fingerprint: str,
+    ) -> Optional[int]:
+        """Get the docket that an upload was last merged into, if the last
+        upload for the case had the same fingerprint.
+
+        :return: The PK of the docket, or None if the upload is new.
+        """
+        value = self.r.get(self.key % (court_id, pacer_case_id, upload_type))
+        if not value:
+            return None
+        last_fingerprint, _, d_pk = value.partition(":")
+        if last_fingerprint != fingerprint:
+            return None
+        return int(d_pk)
+
+    def set_docket_pk(
+        self,
+        court_id: str,
+        pacer_case_id: str,
+        upload_type: int,
+        fingerprint: str,
+        d_pk: int,
+    ) -> None:
+        """Remember that an upload was merged into a docket."""
+        self.r.set(
+            self.key % (court_id, pacer_case_id, upload_type),
+            "%s:%s" % (fingerprint, d_pk),
+            ex=self.ttl,
+        )
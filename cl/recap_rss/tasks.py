@@ -5,6 +5,7 @@ import logging
 import re
 from calendar import SATURDAY, SUNDAY
 from datetime import datetime, timedelta
+from functools import partial
 from typing import Optional
 
 import requests
@@ -15,6 +16,8 @@ from django.db import IntegrityError, transaction
 from django.utils.timezone import now
 from juriscraper.pacer import PacerRssFeed
 from pytz import timezone
+from redis import ConnectionError as RedisConnectionError
+from redis import RedisError
 
 from cl.alerts.tasks import enqueue_docket_alert
 from cl.celery_init import app
@@ -29,7 +32,7 @@ from cl.recap.mergers import (
     update_docket_metadata,
 )
 from cl.recap_rss.models import RssFeedData, RssFeedStatus, RssItemCache
-from cl.recap_rss.utils import emails
+from cl.recap_rss.utils import DatabaseRssItemCache, emails, get_rss_item_cache
 from cl.search.models import Court
 
 logger = logging.getLogger(__name__)
@@ -279,27 +282,6 @@ def hash_item(item):
     return item_hash
 
 
-def is_cached(item_hash):
-    """Check if a hash is in the RSS Item Cache"""
-    return RssItemCache.objects.filter(hash=item_hash).exists()
-
-
-def cache_hash(item_hash):
-    """Add a new hash to the RSS Item Cache
-
-    :param item_hash: A SHA1 hash you wish to cache.
-    :returns True if successful, False if not.
-    """
-    try:
-        RssItemCache.objects.create(hash=item_hash)
-    except IntegrityError:
-        # Happens during race conditions or when you try to cache something
-        # that's already in there.
-        return False
-    else:
-        return True
-
-
 @app.task(bind=True, max_retries=1)
 def merge_rss_feed_contents(self, feed_data, court_pk, metadata_only=False):
     """Merge the rss feed contents into CourtListener
@@ -318,45 +300,65 @@ def merge_rss_feed_contents(self, feed_data, court_pk, metadata_only=False):
     # RSS feeds are a list of normal Juriscraper docket objects.
     all_rds_created = []
     d_pks_to_alert = []
-    for docket in feed_data:
-        item_hash = hash_item(docket)
-        if is_cached(item_hash):
-            continue
-
-        with transaction.atomic():
-            cached_ok = cache_hash(item_hash)
-            if not cached_ok:
-                # The item is already in the cache, ergo it's getting processed
-                # in another thread/process and we had a race condition.
-                continue
-            d = find_docket_object(
-                court_pk, docket["pacer_case_id"], docket["docket_number"]
-            )
-
-            d.add_recap_source()
-            update_docket_metadata(d, docket)
-            if not d.pacer_case_id:
-                d.pacer_case_id = docket["pacer_case_id"]
-            try:
-                d.save()
-                add_bankruptcy_data_to_docket(d, docket)
-            except IntegrityError as exc:
-                # The docket was created while we looked it up. Retry and it
-                # should associate with the new one instead.
-                raise self.retry(exc=exc)
-            if metadata_only:
-                continue
 
-            rds_created, content_updated = add_docket_entries(
-                d, docket["docket_entries"]
-            )
+    # Claim every item in the feed that hasn't been merged before, in one go.
+    # Anything we don't claim is either done or being merged by another
+    # process.
+    item_hashes = [hash_item(docket) for docket in feed_data]
+    cache = get_rss_item_cache()
+    try:
+        unmerged = cache.claim(item_hashes)
+    except RedisConnectionError:
+        logger.warning("Redis unavailable. Using the DB for the RSS cache.")
+        cache = DatabaseRssItemCache()
+        unmerged = cache.claim(item_hashes)
 
-        if content_updated:
-            newly_enqueued = enqueue_docket_alert(d.pk)
-            if newly_enqueued:
-                d_pks_to_alert.append((d.pk, start_time))
+    try:
+        for docket, item_hash in zip(feed_data, item_hashes):
+            if item_hash not in unmerged:
+                continue
 
-        all_rds_created.extend([rd.pk for rd in rds_created])
+            with transaction.atomic():
+                # Keep the claim for good only once the item is in the DB.
+                transaction.on_commit(partial(cache.mark_merged, [item_hash]))
+                d = find_docket_object(
+                    court_pk, docket["pacer_case_id"], docket["docket_number"]
+                )
+
+                d.add_recap_source()
+                update_docket_metadata(d, docket)
+                if not d.pacer_case_id:
+                    d.pacer_case_id = docket["pacer_case_id"]
+                try:
+                    d.save()
+                    add_bankruptcy_data_to_docket(d, docket)
+                except IntegrityError as exc:
+                    # The docket was created while we looked it up. Retry and
+                    # it should associate with the new one instead.
+                    raise self.retry(exc=exc)
+                if metadata_only:
+                    rds_created, content_updated = [], False
+                else:
+                    rds_created, content_updated = add_docket_entries(
+                        d, docket["docket_entries"]
+                    )
+            unmerged.discard(item_hash)
+
+            if content_updated:
+                newly_enqueued = enqueue_docket_alert(d.pk)
+                if newly_enqueued:
+                    d_pks_to_alert.append((d.pk, start_time))
+
+            all_rds_created.extend([rd.pk for rd in rds_created])
+    finally:
+        # If we bailed out, let the items we didn't finish be merged next
+        # time, just as they would be if their claims were rolled back.
+        try:
+            cache.release(unmerged)
+        except RedisError:
+            # Their claims run out soon enough. Don't hide whatever got us
+            # here.
+            logger.warning("Unable to release claims on RSS items.")
 
     logger.info(
         "%s: Sending %s new RECAP documents to Solr for indexing and "
@@ -1,8 +1,11 @@
-from typing import Dict
+from typing import Dict, Iterable, Set
 
 from django.conf import settings
+from django.db import IntegrityError, transaction
 
+from cl.lib.redis_utils import make_redis_interface
 from cl.lib.types import EmailType
+from cl.recap_rss.models import RssItemCache
 
 emails: Dict[str, EmailType] = {
     "changed_rss_feed": {
@@ -26,3 +29,108 @@ emails: Dict[str, EmailType] = {
         "to": [a[1] for a in settings.MANAGERS],
     },
 }
+
+
+class RedisRssItemCache(object):
+    """Remember which RSS items have been merged using expiring Redis keys.
+
+    Every item gets its own key so that it can expire on its own, and a whole
+    feed is claimed in one pipelined round trip. Claims are short-lived until
+    the item is marked as merged, so the items of a worker that dies are
+    merged again soon after.
+    """
+
+    key_prefix = "rss.item:"
+
+    def __init__(
+        self,
+        ttl: int = settings.RSS_ITEM_CACHE_TTL,
+        claim_ttl: int = settings.RSS_ITEM_CLAIM_TTL,
+    ) -> None:
+        self.r = make_redis_interface("CACHE")
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+
+    def claim(self, item_hashes: Iterable[str]) -> Set[str]:
+        """Atomically mark items as being merged.
+
+        :param item_hashes: The hashes of the items in a feed.
+        :return: The hashes that hadn't been seen before. Those items are now
+        ours to merge.
+        """
+        item_hashes = list(dict.fromkeys(item_hashes))
+        pipe = self.r.pipeline(transaction=False)
+        for item_hash in item_hashes:
+            pipe.set(
+                self.key_prefix + item_hash, 1, nx=True, ex=self.claim_ttl
+            )
+        return {
+            item_hash
+            for item_hash, claimed in zip(item_hashes, pipe.execute())
+            if claimed
+        }
+
+    def mark_merged(self, item_hashes: Iterable[str]) -> None:
+        """Remember claimed items as merged for the full TTL."""
+        pipe = self.r.pipeline(transaction=False)
+        for item_hash in item_hashes:
+            pipe.set(self.key_prefix + item_hash, 1, ex=self.ttl)
+        pipe.execute()
+
+    def release(self, item_hashes: Iterable[str]) -> None:
+        """Forget items so that they get merged the next time they're seen."""
+        keys = [self.key_prefix + item_hash for item_hash in item_hashes]
+        if keys:
+            self.r.delete(*keys)
+
+
+class DatabaseRssItemCache(object):
+    """Remember which RSS items have been merged using the RssItemCache table.
+
+    Old rows are deleted by trim_rss_data.
+    """
+
+    def claim(self, item_hashes: Iterable[str]) -> Set[str]:
+        """Atomically mark items as seen.
+
+        :param item_hashes: The hashes of the items in a feed.
+        :return: The hashes that hadn't been seen before. Those items are now
+        ours to merge.
+        """
+        item_hashes = set(item_hashes)
+        seen = set(
+            RssItemCache.objects.filter(hash__in=item_hashes).values_list(
+                "hash", flat=True
+            )
+        )
+        claimed = set()
+        for item_hash in item_hashes - seen:
+            try:
+                with transaction.atomic():
+                    RssItemCache.objects.create(hash=item_hash)
+            except IntegrityError:
+                # Happens during race conditions, when another process
+                # claimed the item after we looked.
+                continue
+            claimed.add(item_hash)
+        return claimed
+
+    def mark_merged(self, item_hashes: Iterable[str]) -> None:
+        """Remember claimed items as merged.
+
+        Claims in the DB last until trim_rss_data deletes them, so there's
+        nothing to do.
+        """
+
+    def release(self, item_hashes: Iterable[str]) -> None:
+        """Forget items so that they get merged the next time they're seen."""
+        item_hashes = list(item_hashes)
+        if item_hashes:
+            RssItemCache.objects.filter(hash__in=item_hashes).delete()
+
+
+def get_rss_item_cache():
+    """Get the RSS item cache backend set in RSS_ITEM_CACHE_BACKEND."""
+    if settings.RSS_ITEM_CACHE_BACKEND == "db":
+        return DatabaseRssItemCache()
+    return RedisRssItemCache()
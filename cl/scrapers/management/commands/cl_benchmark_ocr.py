@@ -0,0 +1,105 @@
+import glob
+import os
+import time
+
+from django.conf import settings
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.scrapers.tasks import extract_by_ocr, get_page_count
+
+
+def get_test_asset_pdfs():
+    """Find the PDFs that ship with the test suite."""
+    patterns = (
+        os.path.join(settings.INSTALL_ROOT, "cl/*/test_assets/**/*.pdf"),
+        os.path.join(settings.MEDIA_ROOT, "test/**/*.pdf"),
+    )
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob.glob(pattern, recursive=True))
+    return sorted(paths)
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time OCR of every page of some PDFs at different levels of "
+        "parallelism, and check that each level gets the same text. By "
+        "default, the PDFs in the test assets are used."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths",
+            nargs="*",
+            help="The PDFs to OCR. Defaults to the test asset PDFs.",
+        )
+        parser.add_argument(
+            "--max-parallel-pages",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4, 8],
+            help="The levels of parallelism to try. The first is the "
+            "baseline the others are compared to.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=1,
+            help="How many times to OCR each PDF at each level. The best "
+            "time is reported.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        paths = options["paths"] or get_test_asset_pdfs()
+        levels = options["max_parallel_pages"]
+        totals = dict.fromkeys(levels, 0.0)
+        print(
+            "%-60s %5s %8s %9s %8s"
+            % ("pdf", "pages", "parallel", "seconds", "speedup")
+        )
+        for path in paths:
+            pages = get_page_count(path, "pdf")
+            baseline_time = baseline_text = None
+            for level in levels:
+                best = None
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    success, txt = extract_by_ocr(
+                        path, max_parallel_pages=level
+                    )
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                totals[level] += best
+                if baseline_time is None:
+                    baseline_time, baseline_text = best, txt
+                elif txt != baseline_text:
+                    logger.warning(
+                        "Text from %s at %s pages at a time differs from "
+                        "the baseline.",
+                        path,
+                        level,
+                    )
+                print(
+                    "%-60s %5s %8s %9.2f %7.2fx"
+                    % (
+                        os.path.basename(path)[-60:],
+                        pages,
+                        level,
+                        best,
+                        baseline_time / best if best else 0,
+                    )
+                )
+                if not success:
+                    logger.warning("Unable to OCR %s.", path)
+
+        baseline_total = totals[levels[0]]
+        for level in levels:
+            print(
+                "Total at %s pages at a time: %.2fs (%.2fx)"
+                % (
+                    level,
+                    totals[level],
+                    baseline_total / totals[level] if totals[level] else 0,
+                )
+            )
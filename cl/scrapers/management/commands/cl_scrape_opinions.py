@@ -18,10 +18,15 @@ from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.crypto import sha1
 from cl.lib.import_lib import get_candidate_judges
 from cl.lib.string_utils import trunc
+from cl.scrapers import utils as scraper_utils
 from cl.scrapers.DupChecker import DupChecker
-from cl.scrapers.models import ErrorLog
+from cl.scrapers.scheduler import (
+    ScrapeScheduler,
+    iter_site_binaries,
+    record_new_item,
+)
 from cl.scrapers.tasks import extract_doc_content
-from cl.scrapers.utils import get_binary_content, get_extension, signal_handler
+from cl.scrapers.utils import get_extension, signal_handler
 from cl.search.models import (
     SEARCH_TYPES,
     Citation,
@@ -162,6 +167,9 @@ def save_everything(
 class Command(VerboseCommand):
     help = "Runs the Juriscraper toolkit against one or many jurisdictions."
 
+    # How many binaries to download ahead of the item being processed.
+    download_lookahead = 3
+
     def __init__(self, stdout=None, stderr=None, no_color=False):
         super(Command, self).__init__(stdout=None, stderr=None, no_color=False)
 
@@ -208,6 +216,53 @@ class Command(VerboseCommand):
             default=False,
             help="Disable duplicate aborting.",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help=(
+                "In daemon mode, the number of courts to scrape at once. "
+                "Default is 4."
+            ),
+        )
+        parser.add_argument(
+            "--per-host",
+            type=int,
+            default=1,
+            help=(
+                "In daemon mode, the number of courts on the same host to "
+                "scrape at once. Default is 1."
+            ),
+        )
+        parser.add_argument(
+            "--court-timeout",
+            type=int,
+            default=None,
+            help=(
+                "In daemon mode, the number of minutes a court may take "
+                "before it's stopped until its next run. Default is the "
+                "rate."
+            ),
+        )
+        parser.add_argument(
+            "--host-delay",
+            type=float,
+            default=1,
+            help=(
+                "In daemon mode, the minimum number of seconds between "
+                "downloads from the same host. Default is 1."
+            ),
+        )
+        parser.add_argument(
+            "--download-lookahead",
+            type=int,
+            default=3,
+            help=(
+                "The number of binaries to download ahead of the item being "
+                "processed. Use 0 to download them one at a time. Default "
+                "is 3."
+            ),
+        )
 
     def scrape_court(self, site, full_crawl=False, ocr_available=True):
         # Get the court object early for logging
@@ -221,17 +276,9 @@ class Command(VerboseCommand):
 
         if site.cookies:
             logger.info("Using cookies: %s" % site.cookies)
-        for i, item in enumerate(site):
-            msg, r = get_binary_content(
-                item["download_urls"],
-                site.cookies,
-                method=site.method,
-            )
-            if msg:
-                logger.warning(msg)
-                ErrorLog(log_level="WARNING", court=court, message=msg).save()
-                continue
-
+        for i, item, r in iter_site_binaries(
+            site, court, lookahead=self.download_lookahead
+        ):
             content = site.cleanup_content(r.content)
 
             current_date = item["case_dates"]
@@ -287,6 +334,7 @@ class Command(VerboseCommand):
                 },
                 index=False,
             )
+            record_new_item()
             extract_doc_content.delay(
                 opinion.pk, ocr_available=ocr_available, citation_jitter=True
             )
@@ -307,6 +355,30 @@ class Command(VerboseCommand):
         site = mod.Site().parse()
         self.scrape_court(site, full_crawl)
 
+    def run_daemon(self, module_strings, options):
+        """Scrape the courts concurrently, forever, or until told to stop."""
+        modules = []
+        for module_string in module_strings:
+            package, module = module_string.rsplit(".", 1)
+            modules.append(
+                __import__(
+                    "%s.%s" % (package, module), globals(), locals(), [module]
+                )
+            )
+
+        court_timeout = options["court_timeout"] or options["rate"]
+        scheduler = ScrapeScheduler(
+            modules,
+            lambda mod: self.parse_and_scrape_site(mod, options["full_crawl"]),
+            interval=options["rate"] * 60,
+            workers=options["workers"],
+            per_host=options["per_host"],
+            timeout=court_timeout * 60,
+            host_delay=options["host_delay"],
+            should_stop=lambda: die_now or scraper_utils.die_now,
+        )
+        scheduler.run()
+
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
         global die_now
@@ -319,17 +391,22 @@ class Command(VerboseCommand):
         if not len(module_strings):
             raise CommandError("Unable to import module or package. Aborting.")
 
+        self.download_lookahead = options["download_lookahead"]
         logger.info("Starting up the scraper.")
+        if options["daemon"]:
+            self.run_daemon(module_strings, options)
+            logger.info("The scraper has stopped.")
+            return
+
         num_courts = len(module_strings)
         wait = (options["rate"] * 60) / num_courts
-        i = 0
-        while i < num_courts:
+        for i, module_string in enumerate(module_strings):
             # this catches SIGTERM, so the code can be killed safely.
-            if die_now:
+            if die_now or scraper_utils.die_now:
                 logger.info("The scraper has stopped.")
                 sys.exit(1)
 
-            package, module = module_strings[i].rsplit(".", 1)
+            package, module = module_string.rsplit(".", 1)
 
             mod = __import__(
                 "%s.%s" % (package, module), globals(), locals(), [module]
@@ -338,19 +415,7 @@ class Command(VerboseCommand):
                 self.parse_and_scrape_site(mod, options["full_crawl"])
             except Exception as e:
                 capture_exception(e)
-            last_court_in_list = i == (num_courts - 1)
-            daemon_mode = options["daemon"]
-            if last_court_in_list:
-                if not daemon_mode:
-                    break
-                else:
-                    logger.info(
-                        "All jurisdictions done. Looping back to "
-                        "the beginning because daemon mode is enabled."
-                    )
-                    i = 0
-            else:
-                i += 1
-            time.sleep(wait)
+            if i < num_courts - 1:
+                time.sleep(wait)
 
         logger.info("The scraper has stopped.")
@@ -15,9 +15,9 @@ from cl.lib.import_lib import get_candidate_judges, get_scotus_judges
 from cl.lib.string_utils import trunc
 from cl.scrapers.DupChecker import DupChecker
 from cl.scrapers.management.commands import cl_scrape_opinions
-from cl.scrapers.models import ErrorLog
+from cl.scrapers.scheduler import iter_site_binaries, record_new_item
 from cl.scrapers.tasks import process_audio_file
-from cl.scrapers.utils import get_binary_content, get_extension
+from cl.scrapers.utils import get_extension
 from cl.search.models import SEARCH_TYPES, Court, Docket
 
 cnt = CaseNameTweaker()
@@ -119,17 +119,9 @@ class Command(cl_scrape_opinions.Command):
 
         if site.cookies:
             logger.info("Using cookies: %s" % site.cookies)
-        for i, item in enumerate(site):
-            msg, r = get_binary_content(
-                item["download_urls"],
-                site.cookies,
-                method=site.method,
-            )
-            if msg:
-                logger.warning(msg)
-                ErrorLog(log_level="WARNING", court=court, message=msg).save()
-                continue
-
+        for i, item, r in iter_site_binaries(
+            site, court, lookahead=self.download_lookahead
+        ):
             content = site.cleanup_content(r.content)
 
             current_date = item["case_dates"]
@@ -168,6 +160,7 @@ class Command(cl_scrape_opinions.Command):
                     index=False,
                     backscrape=backscrape,
                 )
+                record_new_item()
                 process_audio_file.apply_async(
                     (audio_file.pk,), countdown=random.randint(0, 3600)
                 )
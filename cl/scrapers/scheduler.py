@@ -0,0 +1,385 @@
+"""Run court scrapers concurrently.
+
+In daemon mode, cl_scrape_opinions and cl_scrape_oral_arguments scrape every
+court every few minutes. Most of that time is spent waiting on court
+websites, so rather than doing one court at a time, courts are scraped on a
+pool of worker threads, with:
+
+ - At most a few courts on the same host at once, and a minimum gap between
+   the downloads from a host, so we stay polite to courts that share servers.
+ - A deadline for each court, so one slow court can't hold up a worker
+   forever. A court that runs out of time stops between items and doesn't
+   update its site hash, so the next run picks up where it left off.
+ - The binaries of a court downloaded a few items ahead of the one being
+   processed. Items are still processed one at a time and in order, so the
+   DupChecker sees them exactly as it did before.
+
+The latency and item counts of the last run of each court are logged and
+kept in Redis.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from django.db import connections
+from django.utils.timezone import now
+from requests import Response
+from sentry_sdk import capture_exception
+
+from cl.lib.redis_utils import make_redis_interface
+from cl.scrapers.models import ErrorLog
+from cl.scrapers.utils import get_binary_content
+
+logger = logging.getLogger(__name__)
+
+# Where the metrics of the last run of a court are kept, in the STATS db.
+COURT_METRICS_KEY = "scraper.court:%s"
+
+_local = threading.local()
+
+
+class CourtDeadlineExceeded(Exception):
+    """Raised when a court takes longer to scrape than it's allowed."""
+
+
+class HostRateLimiter(object):
+    """Keep a minimum gap between the requests made to each host."""
+
+    def __init__(self, min_interval: float = 0) -> None:
+        self.min_interval = min_interval
+        self.next_request: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        """Block until it's polite to make a request to the host of a URL."""
+        if not self.min_interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            current = time.monotonic()
+            request_at = max(current, self.next_request.get(host, 0))
+            self.next_request[host] = request_at + self.min_interval
+        if request_at > current:
+            time.sleep(request_at - current)
+
+
+class CourtRun(object):
+    """The deadline and metrics of a single scrape of a court."""
+
+    def __init__(self, court_id: str, timeout: Optional[float] = None):
+        self.court_id = court_id
+        self.started = now()
+        self.start_time = time.monotonic()
+        self.deadline = self.start_time + timeout if timeout else None
+        self.items = 0
+        self.downloads = 0
+        self.download_errors = 0
+        self.download_seconds = 0.0
+        self.new_items = 0
+        self.status = "running"
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def check_deadline(self) -> None:
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise CourtDeadlineExceeded(
+                "%s: Ran out of time after %d items."
+                % (self.court_id, self.items)
+            )
+
+    def as_dict(self) -> Dict[str, str]:
+        return {
+            "started": self.started.isoformat(),
+            "status": self.status,
+            "seconds": "%.2f" % self.seconds,
+            "items": str(self.items),
+            "new_items": str(self.new_items),
+            "downloads": str(self.downloads),
+            "download_errors": str(self.download_errors),
+            "download_seconds": "%.2f" % self.download_seconds,
+        }
+
+
+def get_court_run() -> Optional[CourtRun]:
+    """Get the run of the court being scraped in this thread, if any."""
+    return getattr(_local, "court_run", None)
+
+
+def get_rate_limiter() -> HostRateLimiter:
+    return getattr(_local, "rate_limiter", None) or HostRateLimiter()
+
+
+def record_new_item() -> None:
+    """Count a new item for the court being scraped in this thread."""
+    court_run = get_court_run()
+    if court_run is not None:
+        court_run.new_items += 1
+
+
+def save_court_metrics(court_run: CourtRun) -> None:
+    """Log the metrics of a court run and keep them in Redis."""
+    metrics = court_run.as_dict()
+    logger.info(
+        "%s: %s in %ss, %s items, %s new, %s downloads (%s failed) in %ss.",
+        court_run.court_id,
+        metrics["status"],
+        metrics["seconds"],
+        metrics["items"],
+        metrics["new_items"],
+        metrics["downloads"],
+        metrics["download_errors"],
+        metrics["download_seconds"],
+    )
+    try:
+        r = make_redis_interface("STATS")
+        r.hset(COURT_METRICS_KEY % court_run.court_id, mapping=metrics)
+    except Exception:
+        logger.warning(
+            "Unable to save metrics for %s to Redis.", court_run.court_id
+        )
+
+
+def _download(
+    url: str, cookies, method: str, rate_limiter: HostRateLimiter
+) -> Tuple[str, Optional[Response], float]:
+    if method != "LOCAL":
+        rate_limiter.wait(url)
+    t1 = time.monotonic()
+    msg, r = get_binary_content(url, cookies, method=method)
+    return msg, r, time.monotonic() - t1
+
+
+def iter_site_binaries(
+    site, court, lookahead: int = 3
+) -> Iterator[Tuple[int, Dict, Response]]:
+    """Iterate over the items of a site along with their binaries.
+
+    The binaries are downloaded up to lookahead items ahead of the item being
+    yielded, but the items are yielded one by one, in order. Items whose
+    binaries can't be downloaded are logged and skipped.
+
+    If a court run has been started in this thread, the items and downloads
+    are counted, and CourtDeadlineExceeded is raised if it runs out of time.
+
+    :param site: A parsed Juriscraper Site
+    :param court: The Court of the site, for logging errors
+    :param lookahead: How many binaries to download ahead. If zero, they're
+    downloaded as each item is reached.
+    :return: An iterator of the item indexes, the items, and the responses
+    with their binaries.
+    """
+    court_run = get_court_run()
+    rate_limiter = get_rate_limiter()
+    items = list(enumerate(site))
+    pool = None
+    if lookahead and len(items) > 1:
+        pool = ThreadPoolExecutor(max_workers=lookahead)
+    pending = deque()
+    next_item = 0
+    try:
+        for i, item in items:
+            if court_run is not None:
+                court_run.check_deadline()
+            if pool is None:
+                msg, r, seconds = _download(
+                    item["download_urls"],
+                    site.cookies,
+                    site.method,
+                    rate_limiter,
+                )
+            else:
+                while next_item < len(items) and len(pending) < lookahead:
+                    pending.append(
+                        pool.submit(
+                            _download,
+                            items[next_item][1]["download_urls"],
+                            site.cookies,
+                            site.method,
+                            rate_limiter,
+                        )
+                    )
+                    next_item += 1
+                msg, r, seconds = pending.popleft().result()
+
+            if court_run is not None:
+                court_run.items += 1
+                court_run.downloads += 1
+                court_run.download_seconds += seconds
+            if msg:
+                logger.warning(msg)
+                ErrorLog(log_level="WARNING", court=court, message=msg).save()
+                if court_run is not None:
+                    court_run.download_errors += 1
+                continue
+            yield i, item, r
+    finally:
+        if pool is not None:
+            # The caller can stop early, when the DupChecker decides the
+            # rest of the items have been seen.
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+def get_module_host(mod) -> str:
+    """Get the host that a scraper module scrapes, for rate limiting."""
+    try:
+        return urlparse(mod.Site().url).netloc or mod.__name__
+    except Exception:
+        return mod.__name__
+
+
+def scrape_with_metrics(
+    scrape: Callable,
+    mod,
+    timeout: Optional[float] = None,
+    rate_limiter: Optional[HostRateLimiter] = None,
+) -> CourtRun:
+    """Scrape a court in this thread, tracking its deadline and metrics.
+
+    :param scrape: A function that takes a scraper module and scrapes it
+    :param mod: The scraper module
+    :param timeout: How many seconds the court may take, or None for no limit
+    :param rate_limiter: The rate limiter for downloads, shared by threads
+    :return: The finished court run
+    """
+    court_run = CourtRun(mod.__name__.rsplit(".", 1)[-1], timeout)
+    _local.court_run = court_run
+    _local.rate_limiter = rate_limiter
+    try:
+        scrape(mod)
+        court_run.status = "ok"
+    except CourtDeadlineExceeded as e:
+        court_run.status = "timeout"
+        logger.warning(str(e))
+    except Exception as e:
+        court_run.status = "error"
+        capture_exception(e)
+    finally:
+        _local.court_run = None
+        _local.rate_limiter = None
+        save_court_metrics(court_run)
+    return court_run
+
+
+class ScrapeScheduler(object):
+    """Scrape courts repeatedly on a pool of worker threads.
+
+    Each court is scraped about once per interval, with the first scrapes
+    spread over the interval, like the serial loop did. A court that comes
+    due while it's still running, or while its host is busy with other
+    courts, waits until it can go.
+    """
+
+    def __init__(
+        self,
+        modules: List,
+        scrape: Callable,
+        interval: float,
+        workers: int = 4,
+        per_host: int = 1,
+        timeout: Optional[float] = None,
+        host_delay: float = 0,
+        should_stop: Callable[[], bool] = lambda: False,
+    ) -> None:
+        """
+        :param modules: The scraper modules to run
+        :param scrape: A function that takes a scraper module and scrapes it
+        :param interval: How many seconds between scrapes of each court
+        :param workers: How many courts to scrape at once
+        :param per_host: How many courts on a host to scrape at once
+        :param timeout: How many seconds each court may take
+        :param host_delay: The minimum seconds between downloads from a host
+        :param should_stop: A function that says whether to stop scheduling
+        """
+        self.modules = modules
+        self.scrape = scrape
+        self.interval = interval
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(host_delay)
+        self.should_stop = should_stop
+        self.hosts = {mod.__name__: get_module_host(mod) for mod in modules}
+
+    def _run_job(self, mod) -> CourtRun:
+        try:
+            return scrape_with_metrics(
+                self.scrape, mod, self.timeout, self.rate_limiter
+            )
+        finally:
+            # Worker threads each get their own DB connections, so close
+            # them rather than leave them idle between jobs.
+            connections.close_all()
+
+    def _next_job(
+        self, due: Dict, running: Dict, candidates: List
+    ) -> Optional[object]:
+        """Get the most overdue candidate that's allowed to run now."""
+        current = time.monotonic()
+        busy_hosts: Dict[str, int] = {}
+        for mod in running.values():
+            host = self.hosts[mod.__name__]
+            busy_hosts[host] = busy_hosts.get(host, 0) + 1
+        running_mods = {mod.__name__ for mod in running.values()}
+        for mod in sorted(candidates, key=lambda m: due[m.__name__]):
+            if due[mod.__name__] > current:
+                break
+            if mod.__name__ in running_mods:
+                continue
+            if busy_hosts.get(self.hosts[mod.__name__], 0) >= self.per_host:
+                continue
+            return mod
+        return None
+
+    def run(self, loop: bool = True) -> None:
+        """Scrape the courts until should_stop says to, or, if loop is
+        False, until every court has been scraped once.
+        """
+        start = time.monotonic()
+        stagger = self.interval / len(self.modules)
+        due = {
+            mod.__name__: start + i * stagger
+            for i, mod in enumerate(self.modules)
+        }
+        remaining = list(self.modules)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self.should_stop():
+                if not loop and not remaining and not running:
+                    break
+                while len(running) < self.workers:
+                    candidates = self.modules if loop else remaining
+                    mod = self._next_job(due, running, candidates)
+                    if mod is None:
+                        break
+                    if not loop:
+                        remaining.remove(mod)
+                    due[mod.__name__] += self.interval
+                    future = pool.submit(self._run_job, mod)
+                    running[future] = mod
+                if running:
+                    done, _ = wait(
+                        running, timeout=1, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        mod = running.pop(future)
+                        # A court that took longer than the interval goes
+                        # again as soon as it can, but not all at once.
+                        due[mod.__name__] = max(
+                            due[mod.__name__], time.monotonic()
+                        )
+                else:
+                    next_due = min(due.values()) - time.monotonic()
+                    time.sleep(min(1, max(next_due, 0.01)))
+            if running:
+                logger.info(
+                    "Waiting for %s courts to finish before stopping.",
+                    len(running),
+                )
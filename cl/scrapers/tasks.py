@@ -1,11 +1,13 @@
 import base64
 import logging
+import mmap
+import os
 import random
-import re
 import subprocess
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple, Union
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
 
 import requests
 from django.apps import apps
@@ -21,6 +23,7 @@ from juriscraper.pacer import CaseQuery, PacerSession
 from lxml.etree import XMLSyntaxError
 from lxml.html.clean import Cleaner
 from PyPDF2 import PdfFileReader
+from PyPDF2.pdf import ContentStream
 from PyPDF2.utils import PdfReadError
 
 from cl.audio.models import Audio
@@ -128,52 +131,259 @@ def make_pdftotext_process(path: str) -> subprocess.Popen:
     )
 
 
-def pdf_has_images(path: str) -> bool:
-    """Check raw PDF for embedded images.
+# The most Form XObjects deep we'll look for images. Real PDFs rarely nest
+# them more than a level or two, but a malicious one could nest them forever.
+MAX_FORM_DEPTH = 5
+IDENTITY_MATRIX = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+# A page that's mostly image with only a little text is a scan with something
+# stamped on it, like a page number, a header or a "Filed" stamp, so it gets
+# OCRed even though it has some text. A page of real text has thousands of
+# characters.
+OCR_IMAGE_COVERAGE_THRESHOLD = 0.8
+OCR_MIN_TEXT_LENGTH = 200
 
-    We need to check if a PDF contains any images.  If a PDF contains images it
-    likely has content that needs to be scanned.
 
-    :param path: Location of PDF to process.
-    :return: Does the PDF contain images?
-    :type: bool
+def get_text_length(page_text: str) -> int:
+    """Count the characters of usable text on a page.
+
+    Like needs_ocr, this ignores the "Case ..." header PACER puts on every
+    page, along with whitespace.
+
+    :param page_text: The pdftotext output for the page.
+    :return: The number of characters.
     """
-    with open(path, "rb") as pdf_file:
-        pdf_bytes = pdf_file.read()
-        return True if re.search(rb"/Image ?/", pdf_bytes) else False
+    length = 0
+    for line in page_text.splitlines():
+        line = line.strip()
+        if not line.startswith("Case"):
+            length += len(line)
+    return length
+
+
+class PageAnalysis(object):
+    """What's on one page of a PDF, as far as OCR is concerned."""
+
+    def __init__(
+        self, page_number: int, text_length: int, image_coverage: float
+    ) -> None:
+        """
+        :param page_number: The page, counting from one.
+        :param text_length: How many characters of usable text pdftotext got
+        from the page.
+        :param image_coverage: Roughly how much of the page is covered by
+        images, from 0 to 1.
+        """
+        self.page_number = page_number
+        self.text_length = text_length
+        self.image_coverage = image_coverage
+
+    @property
+    def has_text(self) -> bool:
+        return self.text_length > 0
+
+    @property
+    def needs_ocr(self) -> bool:
+        if not self.has_text:
+            # A page without text or images is blank, so there's nothing to
+            # OCR.
+            return self.image_coverage > 0
+        return (
+            self.image_coverage >= OCR_IMAGE_COVERAGE_THRESHOLD
+            and self.text_length < OCR_MIN_TEXT_LENGTH
+        )
 
+    def __repr__(self) -> str:
+        return "<PageAnalysis: page %s, text: %s, images: %.0f%%>" % (
+            self.page_number,
+            self.text_length,
+            self.image_coverage * 100,
+        )
+
+
+def _multiply_matrices(m: Sequence[float], n: Sequence[float]) -> tuple:
+    """Multiply two PDF transformation matrices, given as [a b c d e f]."""
+    a, b, c, d, e, f = m
+    A, B, C, D, E, F = n
+    return (
+        a * A + b * C,
+        a * B + b * D,
+        c * A + d * C,
+        c * B + d * D,
+        e * A + f * C + E,
+        e * B + f * D + F,
+    )
+
+
+def _get_image_area(
+    content,
+    resources,
+    reader: PdfFileReader,
+    ctm: Sequence[float] = IDENTITY_MATRIX,
+    depth: int = 0,
+) -> float:
+    """Add up the area of the images drawn by a content stream.
+
+    Images are drawn into a unit square, so each one covers the area of that
+    square under the current transformation matrix. Overlapping images are
+    counted twice, which is fine for our purposes.
+
+    :param content: A page's content stream, or a Form XObject.
+    :param resources: The resources dictionary that goes with the content.
+    :param reader: The reader the content came from.
+    :param ctm: The transformation matrix in effect when the content starts.
+    :param depth: How many Form XObjects deep we are.
+    :return: The area of the images, in the page's units.
+    """
+    xobjects = resources.get("/XObject", {}) if resources else {}
+    if xobjects:
+        xobjects = xobjects.getObject()
+    area = 0.0
+    stack = []
+    for operands, operator in ContentStream(content, reader).operations:
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q":
+            ctm = stack.pop() if stack else ctm
+        elif operator == b"cm":
+            ctm = _multiply_matrices([float(x) for x in operands], ctm)
+        elif operator == b"INLINE IMAGE":
+            area += abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+        elif operator == b"Do":
+            xobject = xobjects.get(operands[0])
+            if xobject is None:
+                continue
+            xobject = xobject.getObject()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                area += abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+            elif subtype == "/Form" and depth < MAX_FORM_DEPTH:
+                matrix = [
+                    float(x) for x in xobject.get("/Matrix", IDENTITY_MATRIX)
+                ]
+                area += _get_image_area(
+                    xobject,
+                    xobject.get("/Resources", resources),
+                    reader,
+                    _multiply_matrices(matrix, ctm),
+                    depth + 1,
+                )
+    return area
+
+
+def get_image_coverage(page, reader: PdfFileReader) -> float:
+    """Estimate how much of a page is covered by images.
+
+    :param page: A PyPDF2 page.
+    :param reader: The reader the page came from.
+    :return: The fraction of the page covered by images, from 0 to 1. If the
+    page can't be parsed, assume that it's all image, so it gets OCRed.
+    """
+    try:
+        content = page.getContents()
+        if content is None:
+            return 0.0
+        box = page.mediaBox
+        page_area = abs(float(box.getWidth()) * float(box.getHeight()))
+        resources = page.get("/Resources")
+        if resources is not None:
+            resources = resources.getObject()
+        image_area = _get_image_area(content, resources, reader)
+    except Exception:
+        # PyPDF2 raises all sorts of things on broken content streams.
+        return 1.0
+    if not page_area:
+        return 1.0 if image_area else 0.0
+    return min(image_area / page_area, 1.0)
 
-def ocr_needed(path: str, content: str) -> bool:
-    """Check if OCR is needed on a PDF
 
-    Check if images are in PDF or content is empty.
+def analyze_pdf_pages(
+    path: str, text_pages: List[str]
+) -> Optional[List[PageAnalysis]]:
+    """Work out which pages of a PDF have text and which have images.
+
+    The PDF is memory-mapped rather than read into memory, and only the
+    content streams of its pages are parsed, so this is cheap even for large
+    documents.
 
     :param path: The path to the PDF
-    :param content: The content extracted from the PDF.
-    :return: Whether OCR should be run on the document.
+    :param text_pages: The pdftotext output for the PDF, split on form feeds.
+    :return: An analysis of each page, or None if the PDF couldn't be read.
     """
-    if content.strip() == "" or pdf_has_images(path):
-        return True
-    return False
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as pdf_bytes:
+            reader = PdfFileReader(pdf_bytes, strict=False)
+            if reader.isEncrypted and not reader.decrypt(""):
+                return None
+            pages = []
+            for i in range(reader.getNumPages()):
+                page_text = text_pages[i] if i < len(text_pages) else ""
+                pages.append(
+                    PageAnalysis(
+                        i + 1,
+                        get_text_length(page_text),
+                        get_image_coverage(reader.getPage(i), reader),
+                    )
+                )
+            return pages
+    except (
+        IOError,
+        ValueError,
+        TypeError,
+        KeyError,
+        AssertionError,
+        NotImplementedError,
+        PdfReadError,
+    ):
+        # See get_page_count for the ways PyPDF2 fails on bad PDFs.
+        return None
+
+
+def pages_needing_ocr(path: str, text_pages: List[str]) -> List[int]:
+    """Get the numbers of the pages in a PDF that should be OCRed.
+
+    These are the pages that have images but no usable text layer, and the
+    scanned pages that only have a little text stamped on them. If the PDF
+    can't be analyzed, every page without usable text is OCRed.
+
+    :param path: The path to the PDF
+    :param text_pages: The pdftotext output for the PDF, split on form feeds.
+    :return: A list of page numbers, counting from one.
+    """
+    pages = analyze_pdf_pages(path, text_pages)
+    if pages is not None:
+        return [page.page_number for page in pages if page.needs_ocr]
+    page_count = get_page_count(path, "pdf") or 0
+    return [
+        i + 1
+        for i in range(page_count)
+        if i >= len(text_pages) or needs_ocr(text_pages[i])
+    ]
 
 
 def extract_from_pdf(
     path: str,
     opinion: Opinion,
     ocr_available: bool = False,
+    max_parallel_pages: Optional[int] = None,
 ) -> ExtractProcessResult:
     """Extract text from pdfs.
 
-    Start with pdftotext. If we we enabled OCR - and the the content is empty
-    or the PDF contains images, use tesseract. This pattern occurs because PDFs
-    can be images, text-based and a mix of the two. We check for images to
-    make sure we do OCR on mix-type PDFs.
+    Start with pdftotext. If we we enabled OCR, use tesseract on any pages
+    that are scans, even ones with a stamp or page number on top, and merge
+    their text back into the pdftotext output. This pattern occurs because
+    PDFs can be images, text-based and a mix of the two. We check each page so
+    that we do OCR on mix-type PDFs without OCRing pages that already have
+    text, like those with a logo in the letterhead.
 
     If a text-based PDF we fix corrupt PDFs from ca9.
 
     :param path: The path to the PDF
     :param opinion: The Opinion associated with the PDF
     :param ocr_available: Whether we should do OCR stuff
+    :param max_parallel_pages: The most pages to OCR at a time. Defaults to
+    settings.OCR_MAX_PARALLEL_PAGES.
     :return Tuple of the content itself and any errors we received
     """
     process = make_pdftotext_process(path)
@@ -187,8 +397,15 @@ def extract_from_pdf(
             # It's a corrupt PDF from ca9. Fix it.
             content = fix_mojibake(content)
     else:
-        if ocr_needed(path, content):
-            success, ocr_content = extract_by_ocr(path)
+        text_pages = content.split("\f")
+        page_numbers = pages_needing_ocr(path, text_pages)
+        if page_numbers:
+            success, ocr_content = extract_by_ocr(
+                path,
+                max_parallel_pages=max_parallel_pages,
+                text_pages=text_pages,
+                page_numbers=page_numbers,
+            )
             if success:
                 # Check content length and take the longer of the two
                 if len(ocr_content) > len(content):
@@ -249,10 +466,16 @@ def extract_from_wpd(path: str, opinion: Opinion) -> ExtractProcessResult:
     return content, err
 
 
-def convert_file_to_txt(path: str) -> str:
+def convert_file_to_txt(path: str, single_threaded: bool = False) -> str:
     tesseract_command = ["tesseract", path, "stdout", "-l", "eng"]
+    env = None
+    if single_threaded:
+        env = {**os.environ, "OMP_THREAD_LIMIT": "1"}
     p = subprocess.Popen(
-        tesseract_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        tesseract_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
     )
     return p.communicate()[0].decode()
 
@@ -430,8 +653,18 @@ def extract_recap_pdf(
     pks: Union[int, List[int]],
     skip_ocr: bool = False,
     check_if_needed: bool = True,
+    max_parallel_pages: Optional[int] = None,
 ) -> List[int]:
-    """Extract the contents from a RECAP PDF if necessary."""
+    """Extract the contents from a RECAP PDF if necessary.
+
+    :param pks: The RECAPDocument pk or pks to work on
+    :param skip_ocr: Whether to skip OCR on documents that need it
+    :param check_if_needed: Whether to skip documents that don't need
+    extraction
+    :param max_parallel_pages: The most pages of a document to OCR at a time.
+    Defaults to settings.OCR_MAX_PARALLEL_PAGES.
+    :return: The pks that were processed
+    """
     if not is_iter(pks):
         pks = [pks]
 
@@ -449,7 +682,8 @@ def extract_recap_pdf(
             suffix=".pdf",
             buffering=0,  # Make sure it's on disk when we try to use it
         ) as tmp:
-            tmp.write(rd.filepath_local.read())
+            for chunk in rd.filepath_local.chunks():
+                tmp.write(chunk)
             process = make_pdftotext_process(tmp.name)
             content, err = process.communicate()
             content = content.decode()
@@ -457,7 +691,9 @@ def extract_recap_pdf(
             if needs_ocr(content):
                 if not skip_ocr:
                     # probably an image PDF. Send it to OCR.
-                    success, content = extract_by_ocr(tmp.name)
+                    success, content = extract_by_ocr(
+                        tmp.name, max_parallel_pages=max_parallel_pages
+                    )
                     if success:
                         rd.ocr_status = RECAPDocument.OCR_COMPLETE
                     elif content == "" or not success:
@@ -477,13 +713,25 @@ def extract_recap_pdf(
     return processed
 
 
-def rasterize_pdf(path: str, destination: str) -> Tuple[str, str, int]:
+def rasterize_pdf(
+    path: str,
+    destination: str,
+    first_page: Optional[int] = None,
+    last_page: Optional[int] = None,
+) -> Tuple[str, str, int]:
     """Convert the PDF into a multipage Tiff file.
 
     This function uses ghostscript for processing and borrows heavily from:
 
         https://github.com/jbarlow83/OCRmyPDF/blob/636d1903b35fed6b07a01af53769fea81f388b82/ocrmypdf/ghostscript.py#L11
 
+    :param path: The path to the PDF
+    :param destination: Where to write the Tiff file
+    :param first_page: The first page to rasterize, counting from one. If
+    None, start at the beginning of the document.
+    :param last_page: The last page to rasterize. If None, go to the end of
+    the document.
+    :return: Ghostscript's stdout, stderr and return code.
     """
     # gs docs, see: http://ghostscript.com/doc/7.07/Use.htm
     # gs devices, see: http://ghostscript.com/doc/current/Devices.htm
@@ -501,10 +749,12 @@ def rasterize_pdf(path: str, destination: str) -> Tuple[str, str, int]:
         "-sDEVICE=tiffgray",
         "-sCompression=lzw",
         "-r300x300",  # Set the resolution to 300 DPI.
-        "-o",
-        destination,
-        path,
     ]
+    if first_page is not None:
+        gs.append(f"-dFirstPage={first_page}")
+    if last_page is not None:
+        gs.append(f"-dLastPage={last_page}")
+    gs.extend(["-o", destination, path])
     p = subprocess.Popen(
         gs,
         close_fds=True,
@@ -533,22 +783,130 @@ def cleanup_ocr_text(txt: str) -> str:
     return txt
 
 
+def ocr_page(path: str, page_number: int) -> Optional[str]:
+    """Rasterize and OCR a single page of a PDF.
+
+    Tesseract is held to one thread, since we get our parallelism by OCRing
+    several pages at once instead.
+
+    :param path: The path to the PDF
+    :param page_number: The page to OCR, counting from one.
+    :return: The cleaned up text of the page, or None if it couldn't be
+    rasterized.
+    """
+    with NamedTemporaryFile(prefix="ocr_", suffix=".tiff", buffering=0) as tmp:
+        out, err, returncode = rasterize_pdf(
+            path, tmp.name, first_page=page_number, last_page=page_number
+        )
+        if returncode != 0:
+            logger.warning(
+                "Unable to rasterize page %s of %s: %s", page_number, path, err
+            )
+            return None
+        txt = convert_file_to_txt(tmp.name, single_threaded=True)
+    # Tesseract ends every page with a form feed. We add our own when the
+    # pages are put back together.
+    return cleanup_ocr_text(txt.rstrip("\f"))
+
+
+def ocr_pages(
+    path: str, page_numbers: List[int], max_parallel_pages: int
+) -> Iterator[Optional[str]]:
+    """OCR several pages of a PDF at once.
+
+    The heavy lifting is done by ghostscript and tesseract subprocesses, so a
+    thread per page is all we need to keep up to max_parallel_pages of them
+    running. Threads also work inside celery's daemonic worker processes,
+    which aren't allowed to have child processes of their own.
+
+    :param path: The path to the PDF
+    :param page_numbers: The pages to OCR, counting from one.
+    :param max_parallel_pages: The most pages to work on at a time.
+    :return: Yields the text of each page, in the order it was requested, as
+    soon as it and the pages before it are done. A page that couldn't be
+    rasterized yields None.
+    """
+    if max_parallel_pages <= 1 or len(page_numbers) <= 1:
+        for page_number in page_numbers:
+            yield ocr_page(path, page_number)
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_parallel_pages, len(page_numbers))
+    ) as executor:
+        yield from executor.map(
+            lambda page_number: ocr_page(path, page_number), page_numbers
+        )
+
+
 @app.task
-def extract_by_ocr(path: str) -> (bool, str):
-    """Extract the contents of a PDF using OCR."""
+def extract_by_ocr(
+    path: str,
+    max_parallel_pages: Optional[int] = None,
+    text_pages: Optional[List[str]] = None,
+    page_numbers: Optional[List[int]] = None,
+) -> (bool, str):
+    """Extract the contents of a PDF using OCR.
+
+    Pages are rasterized and OCRed one at a time, up to max_parallel_pages of
+    them at once, so that long scanned documents can use every core instead
+    of just one.
+
+    :param path: The path to the PDF
+    :param max_parallel_pages: The most pages to OCR at a time. Defaults to
+    settings.OCR_MAX_PARALLEL_PAGES.
+    :param text_pages: The text that pdftotext got from each page, if it has
+    already been run. Pages that already have usable text or that have no
+    images are kept as they are instead of being OCRed.
+    :param page_numbers: The pages to OCR, counting from one, if the caller
+    has already worked them out. Any other pages are taken from text_pages.
+    :return: Whether OCR succeeded, and the text with pages separated by form
+    feeds.
+    """
     fail_msg = (
         "Unable to extract the content from this file. Please try "
         "reading the original."
     )
-    with NamedTemporaryFile(prefix="ocr_", suffix=".tiff", buffering=0) as tmp:
-        out, err, returncode = rasterize_pdf(path, tmp.name)
-        if returncode != 0:
-            return False, fail_msg
-
-        txt = convert_file_to_txt(tmp.name)
-        txt = cleanup_ocr_text(txt)
+    if max_parallel_pages is None:
+        max_parallel_pages = settings.OCR_MAX_PARALLEL_PAGES
+    page_count = get_page_count(path, "pdf")
+    if not page_count:
+        # PyPDF2 can't read it, so we don't know where the pages are. Let
+        # ghostscript have a go at the whole thing.
+        with NamedTemporaryFile(
+            prefix="ocr_", suffix=".tiff", buffering=0
+        ) as tmp:
+            out, err, returncode = rasterize_pdf(path, tmp.name)
+            if returncode != 0:
+                return False, fail_msg
+
+            txt = convert_file_to_txt(tmp.name)
+            txt = cleanup_ocr_text(txt)
+
+        return True, txt
+
+    pages = [""] * page_count
+    if text_pages is not None:
+        for i, page_text in enumerate(text_pages[:page_count]):
+            pages[i] = page_text
+    if page_numbers is not None:
+        to_ocr = [n for n in page_numbers if 1 <= n <= page_count]
+    elif text_pages is not None:
+        to_ocr = pages_needing_ocr(path, text_pages)
+    else:
+        to_ocr = list(range(1, page_count + 1))
+    failures = 0
+    for page_number, txt in zip(
+        to_ocr, ocr_pages(path, to_ocr, max_parallel_pages)
+    ):
+        if txt is None:
+            failures += 1
+            continue
+        pages[page_number - 1] = txt
+    if to_ocr and failures == len(to_ocr):
+        return False, fail_msg
 
-    return True, txt
+    return True, "\f".join(pages)
 
 
 @app.task(bind=True, max_retries=1, countdown=2)
@@ -1,4 +1,5 @@
 import os
+import time
 from datetime import timedelta
 from unittest import mock
 
@@ -16,9 +17,15 @@ from cl.scrapers.management.commands import (
     cl_scrape_oral_arguments,
 )
 from cl.scrapers.models import ErrorLog, UrlHash
+from cl.scrapers.scheduler import scrape_with_metrics
 from cl.scrapers.tasks import (
+    analyze_pdf_pages,
+    extract_by_ocr,
     extract_doc_content,
     extract_from_txt,
+    get_page_count,
+    make_pdftotext_process,
+    pages_needing_ocr,
     process_audio_file,
 )
 from cl.scrapers.test_assets import test_opinion_scraper, test_oral_arg_scraper
@@ -65,6 +72,44 @@ class ScraperIngestionTest(TestCase):
         self.assertEqual(2, audio_files.count())
         mock.assert_called()
 
+    def test_ingest_opinions_with_metrics(self, mock) -> None:
+        """Are the items of a court counted when it's scraped for metrics?"""
+        site = test_opinion_scraper.Site()
+        site.method = "LOCAL"
+        parsed_site = site.parse()
+        court_run = scrape_with_metrics(
+            lambda mod: cl_scrape_opinions.Command().scrape_court(
+                parsed_site, ocr_available=False
+            ),
+            test_opinion_scraper,
+        )
+
+        self.assertEqual(court_run.status, "ok")
+        self.assertEqual(court_run.items, 6)
+        self.assertEqual(court_run.new_items, 6)
+        self.assertEqual(Opinion.objects.count(), 6)
+        self.assertEqual(UrlHash.objects.count(), 1)
+
+    def test_court_deadline_stops_scrape(self, mock) -> None:
+        """Does a court that runs out of time stop without saving its hash?"""
+        site = test_opinion_scraper.Site()
+        site.method = "LOCAL"
+        parsed_site = site.parse()
+
+        def scrape(mod):
+            time.sleep(0.01)
+            cl_scrape_opinions.Command().scrape_court(
+                parsed_site, ocr_available=False
+            )
+
+        court_run = scrape_with_metrics(
+            scrape, test_opinion_scraper, timeout=0.001
+        )
+
+        self.assertEqual(court_run.status, "timeout")
+        self.assertEqual(Opinion.objects.count(), 0)
+        self.assertEqual(UrlHash.objects.count(), 0)
+
     def test_parsing_xml_opinion_site_to_site_object(self, mock) -> None:
         """Does a basic parse of a site reveal the right number of items?"""
         site = test_opinion_scraper.Site().parse()
@@ -173,6 +218,75 @@ class ExtractionTest(TestCase):
         )
 
 
+class OCRTest(TestCase):
+    def setUp(self) -> None:
+        self.path = os.path.join(
+            settings.MEDIA_ROOT,
+            "test",
+            "search",
+            "opinion_pdf_image_based.pdf",
+        )
+
+    def test_parallel_ocr_matches_serial_ocr(self) -> None:
+        """Do we get the same text no matter how many pages we OCR at once?"""
+        success, serial = extract_by_ocr(self.path, max_parallel_pages=1)
+        self.assertTrue(success)
+        self.assertIn("intelligence", serial.lower())
+        success, parallel = extract_by_ocr(self.path, max_parallel_pages=4)
+        self.assertTrue(success)
+        self.assertEqual(serial, parallel)
+
+    @mock.patch("cl.scrapers.tasks.ocr_page", return_value="ocr text")
+    def test_pages_with_text_are_not_ocred(self, mock_ocr_page) -> None:
+        """Do we keep the pdftotext output of pages that have good text?"""
+        page_count = get_page_count(self.path, "pdf")
+        text_pages = ["A page with text on it."] * page_count
+        text_pages[0] = ""
+        success, txt = extract_by_ocr(
+            self.path, max_parallel_pages=4, text_pages=text_pages
+        )
+        self.assertTrue(success)
+        mock_ocr_page.assert_called_once_with(self.path, 1)
+        self.assertEqual(txt.split("\f"), ["ocr text"] + text_pages[1:])
+
+    def test_analyze_pdf_pages(self) -> None:
+        """Can we tell which pages have text and which are scans?"""
+        pages = analyze_pdf_pages(self.path, [""])
+        self.assertTrue(pages)
+        for page in pages:
+            self.assertFalse(page.has_text)
+            self.assertGreater(page.image_coverage, 0.5)
+            self.assertTrue(page.needs_ocr)
+
+        path = os.path.join(
+            settings.MEDIA_ROOT, "test", "search", "opinion_pdf_text_based.pdf"
+        )
+        content, _ = make_pdftotext_process(path).communicate()
+        pages = analyze_pdf_pages(path, content.decode().split("\f"))
+        self.assertEqual(len(pages), 30)
+        # The last two pages are images without a text layer.
+        self.assertEqual(
+            [page.page_number for page in pages if page.needs_ocr], [29, 30]
+        )
+
+    def test_scans_with_a_stamp_are_ocred(self) -> None:
+        """Do we OCR scanned pages that have a line of text stamped on them?"""
+        page_count = get_page_count(self.path, "pdf")
+        text_pages = [
+            "Case 2:06-cv-00376-SRW Document 1-2 Filed 04/25/2006\n"
+            "RECEIVED APR 25 2006 - Page %s\n" % (i + 1)
+            for i in range(page_count)
+        ]
+        pages = analyze_pdf_pages(self.path, text_pages)
+        for page in pages:
+            self.assertTrue(page.has_text)
+            self.assertTrue(page.needs_ocr)
+        self.assertEqual(
+            pages_needing_ocr(self.path, text_pages),
+            list(range(1, page_count + 1)),
+        )
+
+
 class ExtensionIdentificationTest(TestCase):
     def setUp(self) -> None:
         self.path = os.path.join(settings.MEDIA_ROOT, "test", "search")
@@ -0,0 +1,105 @@
+import time
+
+from django.template import loader
+
+from cl.audio.models import Audio
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.search_index_text import INDEX_TEXT_BUILDERS
+from cl.people_db.models import Person
+from cl.search.models import Opinion, RECAPDocument
+
+
+def get_contexts(template_name, count):
+    """Get the template contexts of some items of a type."""
+    if template_name == "indexes/opinion_text.txt":
+        items = Opinion.objects.select_related(
+            "cluster__docket__court"
+        ).prefetch_related("cluster__panel", "cluster__citations")[:count]
+        return [
+            {"item": o, "citation_string": o.cluster.citation_string}
+            for o in items
+        ]
+    if template_name == "indexes/dockets_text.txt":
+        items = RECAPDocument.objects.select_related(
+            "docket_entry__docket__court",
+            "docket_entry__docket__assigned_to",
+            "docket_entry__docket__referred_to",
+            "docket_entry__docket__bankruptcy_information",
+        )[:count]
+    elif template_name == "indexes/audio_text.txt":
+        items = Audio.objects.select_related("docket__court")[:count]
+    else:
+        items = Person.objects.prefetch_related(
+            "aliases",
+            "positions__court",
+            "political_affiliations",
+            "educations__school",
+            "aba_ratings",
+        )[:count]
+    return [{"item": item} for item in items]
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time the index text builders against the templates they copy, on "
+        "items from the database, and check they make the same text."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=200,
+            help="How many items of each type to use.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="How many times to make the text of each item. The best "
+            "time is reported.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        print(
+            "%-28s %6s %13s %13s %8s"
+            % ("template", "items", "template (s)", "builder (s)", "speedup")
+        )
+        for template_name, builder in INDEX_TEXT_BUILDERS.items():
+            template = loader.get_template(template_name)
+            contexts = get_contexts(template_name, options["count"])
+            # Warm up any lazy lookups, so neither side pays for them.
+            expected = [template.render(c) for c in contexts]
+
+            template_time = builder_time = None
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                for context in contexts:
+                    template.render(context)
+                elapsed = time.perf_counter() - start
+                template_time = min(template_time or elapsed, elapsed)
+
+                start = time.perf_counter()
+                got = [builder(**context) for context in contexts]
+                elapsed = time.perf_counter() - start
+                builder_time = min(builder_time or elapsed, elapsed)
+
+            mismatches = sum(1 for a, b in zip(expected, got) if a != b)
+            if mismatches:
+                logger.warning(
+                    "%s: The builder's text differs from the template's for "
+                    "%s items.",
+                    template_name,
+                    mismatches,
+                )
+            print(
+                "%-28s %6s %13.3f %13.3f %7.1fx"
+                % (
+                    template_name,
+                    len(contexts),
+                    template_time,
+                    builder_time,
+                    template_time / builder_time if builder_time else 0,
+                )
+            )
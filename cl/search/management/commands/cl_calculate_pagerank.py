@@ -1,82 +1,80 @@
-import os
-
-import igraph
 from django.conf import settings
 
-from cl.lib.command_utils import VerboseCommand
+from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.solr_core_admin import get_data_dir
-from cl.search.models import Opinion, OpinionsCited
-
-
-def make_and_populate_nx_graph():
-    """Create a new igraph object and populate it.
-
-    This pulls all of the inter-opinion citations into memory then passes all of
-    them to igraph as a directed graph.
-    """
-    g = igraph.Graph(
-        directed=True,
-        edges=list(
-            OpinionsCited.objects.values_list(
-                "citing_opinion", "cited_opinion"
-            )
-        ),
-    )
-    return g
-
-
-def make_sorted_pr_file(pr_results, result_file_path):
-    """Convert the pagerank results list into something Solr can use.
-
-    Solr uses a file of the form:
-
-        1=0.387789712299
-        2=0.214810626172
-        3=0.397399661529
-
-    The IDs must be sorted for performance, and every ID should be listed. This
-    function takes the pagerank results and converts them into a file like this,
-    using the os's `sort` executable for fastest sorting.
-    """
-    temp_extension = ".tmp"
-    min_value = min(pr_results)
-    with open(result_file_path + temp_extension, "w") as f:
-        # pr_results has a score for every value between 0 and our highest
-        # opinion id that has citations. Write a file that only contains values
-        # matching valid Opinions.
-        for pk in Opinion.objects.values_list("pk", flat=True):
-            try:
-                score = pr_results[pk]
-            except IndexError:
-                # Happens because some items don't have citations, thus aren't
-                # in network.
-                score = min_value
-            f.write("{}={}\n".format(pk, score))
-
-    # For improved Solr performance, sort the temp file, creating a new file
-    # without the temp_extension value.
-    os.system(
-        "sort -n %s%s > %s"
-        % (result_file_path, temp_extension, result_file_path)
-    )
-    os.remove(result_file_path + temp_extension)
+from cl.search.pagerank import (
+    CitationGraph,
+    load_scores,
+    write_solr_pagerank_file,
+)
 
 
 class Command(VerboseCommand):
     args = "<args>"
-    help = "Calculate pagerank value for every case"
+    help = (
+        "Calculate pagerank value for every case. By default this picks up "
+        "where the last run left off, adding only new citations to the "
+        "snapshot of the citation graph and starting from the last scores."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--snapshot-dir",
+            default=settings.PAGERANK_SNAPSHOT_DIR,
+            help="Where to keep the snapshot of the citation graph between "
+            "runs.",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            default=False,
+            help="Ignore any existing snapshot and rebuild the graph from "
+            "scratch. Do this occasionally to drop deleted citations.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1_000_000,
+            help="The number of citations to pull from the DB per query.",
+        )
 
     @staticmethod
-    def do_pagerank():
-        g = make_and_populate_nx_graph()
-        pr_results = g.pagerank()
+    def do_pagerank(snapshot_dir=None, rebuild=False, chunk_size=1_000_000):
+        """Update the citation graph and compute its pagerank scores.
+
+        :param snapshot_dir: Where to load and save the graph snapshot. If
+        None, the graph is built in memory and not persisted.
+        :param rebuild: Whether to ignore the existing snapshot.
+        :param chunk_size: How many citations to pull from the DB at a time.
+        :return: An array of scores, indexed by opinion ID.
+        """
+        if snapshot_dir and not rebuild:
+            g = CitationGraph.load(snapshot_dir)
+            initial = load_scores(snapshot_dir)
+        else:
+            g = CitationGraph()
+            initial = None
+        added = g.update_from_db(chunk_size=chunk_size)
+        logger.info(
+            "Added %s citations. Graph has %s nodes and %s edges.",
+            added,
+            g.node_count,
+            g.edge_count,
+        )
+        pr_results = g.pagerank(initial=initial)
+        if snapshot_dir:
+            g.save(snapshot_dir, pr_results)
         return pr_results
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
-        pr_results = self.do_pagerank()
+        pr_results = self.do_pagerank(
+            snapshot_dir=options["snapshot_dir"],
+            rebuild=options["rebuild"],
+            chunk_size=options["chunk_size"],
+        )
         pr_dest_dir = settings.SOLR_PAGERANK_DEST_DIR
-        make_sorted_pr_file(pr_results, pr_dest_dir)
+        write_solr_pagerank_file(pr_results, pr_dest_dir)
         normal_dest_dir = get_data_dir("collection1") + "external_pagerank"
         print(
             "Pagerank file created at %s. Because of distributed servers, "
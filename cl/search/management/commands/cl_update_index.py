@@ -167,6 +167,14 @@ class Command(VerboseCommand):
             "date and time (YYYY-MM-DD HH:MM:SS)",
         )
 
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="The number of items to send to a single Celery task. Larger "
+            "chunks mean fewer, bigger requests to Solr, since each task "
+            "sends its documents in batches over a pooled connection.",
+        )
         parser.add_argument(
             "--start-at",
             type=int,
@@ -219,7 +227,6 @@ class Command(VerboseCommand):
         if options.get("optimize_everything"):
             self.optimize_everything()
 
-        self.si.conn.http_connection.close()
         if not any(
             [
                 options["update"],
@@ -244,7 +251,7 @@ class Command(VerboseCommand):
         :param count: The number of items that will be processed.
         """
         # The count to send in a single Celery task
-        chunk_size = 100
+        chunk_size = self.options["chunk_size"]
 
         queue = self.options["queue"]
         start_at = self.options["start_at"]
@@ -1,5 +1,5 @@
 import re
-from typing import Any, Dict, List, Tuple, TypeVar
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, TypeVar
 
 from celery.canvas import chain
 from django.contrib.contenttypes.fields import GenericRelation
@@ -7,7 +7,6 @@ from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import Prefetch, Q, QuerySet
 from django.db.models.base import ModelBase
-from django.template import loader
 from django.urls import NoReverseMatch, reverse
 from django.utils.encoding import force_str
 from django.utils.text import slugify
@@ -24,10 +23,11 @@ from cl.lib.model_helpers import (
     make_upload_path,
 )
 from cl.lib.models import AbstractDateTimeModel, AbstractPDF, s3_warning_note
+from cl.lib.search_index_text import render_index_text
 from cl.lib.search_index_utils import (
     InvalidDocumentError,
     normalize_search_dicts,
-    null_map,
+    record_docket_changes,
 )
 from cl.lib.storage import IncrementingAWSMediaStorage
 from cl.lib.string_utils import trunc
@@ -256,6 +256,43 @@ class Docket(AbstractDateTimeModel):
         COLUMBIA_AND_RECAP_AND_SCRAPER_AND_IDB,
     ]
 
+    # Docket fields that are denormalized into every RECAPDocument in the
+    # RECAP search index, and the Solr fields they're copied into. Changes to
+    # these can be patched into Solr with atomic updates. "parties" isn't a
+    # field, but is recorded when the parties or attorneys on a docket change.
+    SEARCH_ATOMIC_FIELDS = {
+        "cause": ["cause"],
+        "jurisdiction_type": ["jurisdictionType"],
+        "slug": ["docket_absolute_url"],
+        "parties": [
+            "party_id",
+            "party",
+            "attorney_id",
+            "attorney",
+            "firm_id",
+            "firm",
+        ],
+    }
+    # Docket fields that are also rendered into the text field of each
+    # document. Since that field is different for every document, changing
+    # any of these means re-indexing the whole docket.
+    SEARCH_TEXT_FIELDS = (
+        "case_name",
+        "case_name_full",
+        "case_name_short",
+        "docket_number",
+        "nature_of_suit",
+        "jury_demand",
+        "date_argued",
+        "date_filed",
+        "date_terminated",
+        "court_id",
+        "assigned_to_id",
+        "assigned_to_str",
+        "referred_to_id",
+        "referred_to_str",
+    )
+
     source = models.SmallIntegerField(
         help_text="contains the source of the Docket.", choices=SOURCE_CHOICES
     )
@@ -601,6 +638,30 @@ class Docket(AbstractDateTimeModel):
         else:
             return "{pk}".format(pk=self.pk)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Docket, cls).from_db(db, field_names, values)
+        instance._snapshot_search_values()
+        return instance
+
+    def _snapshot_search_values(self) -> None:
+        """Remember the current values of the denormalized search fields so
+        that we can tell which of them change.
+        """
+        loaded = self.__dict__
+        self._search_values = {
+            f: loaded[f]
+            for f in self.SEARCH_TEXT_FIELDS + tuple(self.SEARCH_ATOMIC_FIELDS)
+            if f in loaded
+        }
+
+    def changed_search_fields(self) -> List[str]:
+        """Get the denormalized search fields that have been changed on this
+        instance since it was loaded or last saved.
+        """
+        snapshot = getattr(self, "_search_values", {})
+        return [f for f, v in snapshot.items() if getattr(self, f) != v]
+
     def save(self, *args, **kwargs):
         self.slug = slugify(trunc(best_case_name(self), 75))
         if self.docket_number and not self.docket_number_core:
@@ -615,7 +676,11 @@ class Docket(AbstractDateTimeModel):
                         "RECAP dockets." % field
                     )
 
+        changed = self.changed_search_fields()
         super(Docket, self).save(*args, **kwargs)
+        if changed and self.date_last_index is not None:
+            record_docket_changes(self.pk, changed)
+        self._snapshot_search_values()
 
     def get_absolute_url(self) -> str:
         return reverse("view_docket", args=[self.pk, self.slug])
@@ -782,9 +847,26 @@ class Docket(AbstractDateTimeModel):
     def as_search_list(self):
         """Create list of search dicts from a single docket. This should be
         faster than creating a search dict per document on the docket.
+
+        On big dockets, prefer iter_search_docs, which doesn't hold every
+        search dict in memory at once.
         """
-        search_list = []
+        return list(self.iter_search_docs())
+
+    def iter_search_docs(
+        self, chunk_size: int = 500
+    ) -> Iterator[Dict[str, Any]]:
+        """Make a search dict for every RECAPDocument on the docket, one at
+        a time.
+
+        Docket entries are pulled chunk_size at a time, along with their
+        documents, in two queries per chunk. Send the dicts to a
+        SolrBatchWriter as they're made, and memory use is bounded by the
+        chunk size rather than the size of the docket.
 
+        :param chunk_size: How many docket entries to pull at once.
+        :return: Yields a search dict for each RECAPDocument.
+        """
         # Docket
         out = {
             "docketNumber": self.docket_number,
@@ -849,68 +931,74 @@ class Docket(AbstractDateTimeModel):
                     out["firm"].add(f.name)
 
         # Do RECAPDocument and Docket Entries in a nested loop
-        for de in self.docket_entries.all().iterator():
-            # Docket Entry
-            de_out = {
-                "description": de.description,
-            }
-            if de.entry_number is not None:
-                de_out["entry_number"] = de.entry_number
-            if de.date_filed is not None:
-                de_out["entry_date_filed"] = midnight_pst(de.date_filed)
-            rds = de.recap_documents.all()
-
-            if len(rds) == 0:
-                # Minute entry or other entry that lacks docs.
-                # For now, we punt.
-                # https://github.com/freelawproject/courtlistener/issues/784
-                continue
-
-            for rd in rds:
-                # IDs
-                rd_out = {
-                    "id": rd.pk,
-                    "docket_entry_id": de.pk,
-                    "docket_id": self.pk,
-                    "court_id": self.court.pk,
-                    "assigned_to_id": getattr(self.assigned_to, "pk", None),
-                    "referred_to_id": getattr(self.referred_to, "pk", None),
+        entry_pks = list(self.docket_entries.values_list("pk", flat=True))
+        for i in range(0, len(entry_pks), chunk_size):
+            entries = self.docket_entries.filter(
+                pk__in=entry_pks[i : i + chunk_size]
+            ).prefetch_related("recap_documents")
+            for de in entries:
+                # Docket Entry
+                de_out = {
+                    "description": de.description,
                 }
-
-                # RECAPDocument
-                rd_out.update(
-                    {
-                        "short_description": rd.description,
-                        "document_type": rd.get_document_type_display(),
-                        "document_number": rd.document_number or None,
-                        "attachment_number": rd.attachment_number,
-                        "is_available": rd.is_available,
-                        "page_count": rd.page_count,
+                if de.entry_number is not None:
+                    de_out["entry_number"] = de.entry_number
+                if de.date_filed is not None:
+                    de_out["entry_date_filed"] = midnight_pst(de.date_filed)
+                rds = de.recap_documents.all()
+
+                if len(rds) == 0:
+                    # Minute entry or other entry that lacks docs.
+                    # For now, we punt.
+                    # https://github.com/freelawproject/courtlistener/issues/784
+                    continue
+
+                for rd in rds:
+                    # IDs
+                    rd_out = {
+                        "id": rd.pk,
+                        "docket_entry_id": de.pk,
+                        "docket_id": self.pk,
+                        "court_id": self.court.pk,
+                        "assigned_to_id": getattr(
+                            self.assigned_to, "pk", None
+                        ),
+                        "referred_to_id": getattr(
+                            self.referred_to, "pk", None
+                        ),
                     }
-                )
-                if rd.filepath_local:
-                    rd_out["filepath_local"] = rd.filepath_local.name
-                try:
-                    rd_out["absolute_url"] = rd.get_absolute_url()
-                except NoReverseMatch:
-                    raise InvalidDocumentError(
-                        "Unable to save to index due to missing absolute_url: "
-                        "%s" % self.pk
-                    )
 
-                text_template = loader.get_template("indexes/dockets_text.txt")
-                rd_out["text"] = text_template.render({"item": rd}).translate(
-                    null_map
-                )
+                    # RECAPDocument
+                    rd_out.update(
+                        {
+                            "short_description": rd.description,
+                            "document_type": rd.get_document_type_display(),
+                            "document_number": rd.document_number or None,
+                            "attachment_number": rd.attachment_number,
+                            "is_available": rd.is_available,
+                            "page_count": rd.page_count,
+                        }
+                    )
+                    if rd.filepath_local:
+                        rd_out["filepath_local"] = rd.filepath_local.name
+                    try:
+                        rd_out["absolute_url"] = rd.get_absolute_url()
+                    except NoReverseMatch:
+                        raise InvalidDocumentError(
+                            "Unable to save to index due to missing "
+                            "absolute_url: %s" % self.pk
+                        )
+
+                    rd_out["text"] = render_index_text(
+                        "indexes/dockets_text.txt", {"item": rd}
+                    )
 
-                # Ensure that loops to bleed into each other
-                out_copy = out.copy()
-                out_copy.update(rd_out)
-                out_copy.update(de_out)
+                    # Ensure that loops to bleed into each other
+                    out_copy = out.copy()
+                    out_copy.update(rd_out)
+                    out_copy.update(de_out)
 
-                search_list.append(normalize_search_dicts(out_copy))
-
-        return search_list
+                    yield normalize_search_dicts(out_copy)
 
     def reprocess_recap_content(self, do_original_xml: bool = False) -> None:
         """Go over any associated RECAP files and reprocess them.
@@ -1423,8 +1511,9 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF, AbstractDateTimeModel):
                 self.docket_entry.date_filed
             )
 
-        text_template = loader.get_template("indexes/dockets_text.txt")
-        out["text"] = text_template.render({"item": self}).translate(null_map)
+        out["text"] = render_index_text(
+            "indexes/dockets_text.txt", {"item": self}
+        )
 
         return normalize_search_dicts(out)
 
@@ -2316,6 +2405,53 @@ class OpinionCluster(AbstractDateTimeModel):
 
         delete_items.delay([id_cache], "search.Opinion")
 
+    def _get_special_cites(self) -> Dict[str, str]:
+        """Get the lexis and neutral citations for the search index.
+
+        This iterates over the cluster's citations instead of filtering them
+        so that it uses the prefetch cache when there is one.
+        """
+        out = {}
+        cite_fields = {
+            Citation.LEXIS: "lexisCite",
+            Citation.NEUTRAL: "neutralCite",
+        }
+        for cite in self.citations.all():
+            field = cite_fields.get(cite.type)
+            if field is not None and field not in out:
+                out[field] = str(cite)
+        return out
+
+    @staticmethod
+    def prefetch_for_search(queryset: QuerySet) -> QuerySet:
+        """Pull in everything as_search_list needs, in a fixed number of
+        queries no matter how many clusters are in the queryset.
+        """
+        return queryset.select_related("docket__court").prefetch_related(
+            "citations",
+            "panel",
+            "non_participating_judges",
+            Prefetch(
+                "sub_opinions",
+                queryset=Opinion.objects.prefetch_related(
+                    Prefetch(
+                        "opinions_cited", queryset=Opinion.objects.only("pk")
+                    ),
+                    "joined_by",
+                ),
+            ),
+        )
+
+    @classmethod
+    def as_search_lists(cls, queryset: QuerySet) -> Iterator[Dict[str, Any]]:
+        """Make search dicts for every opinion in a queryset of clusters.
+
+        :param queryset: The clusters to make search dicts for.
+        :return: Yields a search dict for each opinion.
+        """
+        for cluster in cls.prefetch_for_search(queryset):
+            yield from cluster.as_search_list()
+
     def as_search_list(self):
         # IDs
         out = {}
@@ -2368,18 +2504,7 @@ class OpinionCluster(AbstractDateTimeModel):
                 ],
             }
         )
-        try:
-            out["lexisCite"] = str(
-                self.citations.filter(type=Citation.LEXIS)[0]
-            )
-        except IndexError:
-            pass
-        try:
-            out["neutralCite"] = str(
-                self.citations.filter(type=Citation.NEUTRAL)[0]
-            )
-        except IndexError:
-            pass
+        out.update(self._get_special_cites())
 
         if self.date_filed is not None:
             out["dateFiled"] = midnight_pst(self.date_filed)
@@ -2394,7 +2519,6 @@ class OpinionCluster(AbstractDateTimeModel):
 
         # Opinion
         search_list = []
-        text_template = loader.get_template("indexes/opinion_text.txt")
         for opinion in self.sub_opinions.all():
             # Always make a copy to get a fresh version above metadata. Failure
             # to do this pushes metadata from previous iterations to objects
@@ -2404,17 +2528,18 @@ class OpinionCluster(AbstractDateTimeModel):
                 {
                     "id": opinion.pk,
                     "cites": [o.pk for o in opinion.opinions_cited.all()],
-                    "author_id": getattr(opinion.author, "pk", None),
+                    "author_id": opinion.author_id,
                     "joined_by_ids": [j.pk for j in opinion.joined_by.all()],
                     "type": opinion.type,
                     "download_url": opinion.download_url or None,
                     "local_path": deepgetattr(self, "local_path.name", None),
-                    "text": text_template.render(
+                    "text": render_index_text(
+                        "indexes/opinion_text.txt",
                         {
                             "item": opinion,
                             "citation_string": self.citation_string,
-                        }
-                    ).translate(null_map),
+                        },
+                    ),
                 }
             )
 
@@ -2727,8 +2852,40 @@ class Opinion(AbstractDateTimeModel):
 
             add_items_to_solr.delay([self.pk], "search.Opinion", force_commit)
 
+    @staticmethod
+    def prefetch_for_search(queryset: QuerySet) -> QuerySet:
+        """Pull in everything as_search_dict needs, in a fixed number of
+        queries no matter how many opinions are in the queryset.
+        """
+        return queryset.select_related(
+            "cluster__docket__court"
+        ).prefetch_related(
+            Prefetch("opinions_cited", queryset=Opinion.objects.only("pk")),
+            "joined_by",
+            Prefetch(
+                "cluster__sub_opinions", queryset=Opinion.objects.only("pk")
+            ),
+            "cluster__citations",
+            "cluster__panel",
+            "cluster__non_participating_judges",
+        )
+
+    @classmethod
+    def as_search_dicts(cls, queryset: QuerySet) -> Iterator[Dict[str, Any]]:
+        """Make search dicts for every opinion in a queryset.
+
+        :param queryset: The opinions to make search dicts for.
+        :return: Yields a search dict for each opinion.
+        """
+        for opinion in cls.prefetch_for_search(queryset):
+            yield opinion.as_search_dict()
+
     def as_search_dict(self) -> Dict[str, Any]:
-        """Create a dict that can be ingested by Solr."""
+        """Create a dict that can be ingested by Solr.
+
+        Use as_search_dicts or prefetch_for_search when making dicts for
+        many opinions, or this will do a couple dozen queries for each one.
+        """
         # IDs
         out = {
             "id": self.pk,
@@ -2741,7 +2898,7 @@ class Opinion(AbstractDateTimeModel):
         out.update(
             {
                 "cites": [opinion.pk for opinion in self.opinions_cited.all()],
-                "author_id": getattr(self.author, "pk", None),
+                "author_id": self.author_id,
                 # 'per_curiam': self.per_curiam,
                 "joined_by_ids": [judge.pk for judge in self.joined_by.all()],
                 "type": self.type,
@@ -2774,19 +2931,7 @@ class Opinion(AbstractDateTimeModel):
                 "status_exact": self.cluster.get_precedential_status_display(),
             }
         )
-        try:
-            out["lexisCite"] = str(
-                self.cluster.citations.filter(type=Citation.LEXIS)[0]
-            )
-        except IndexError:
-            pass
-
-        try:
-            out["neutralCite"] = str(
-                self.cluster.citations.filter(type=Citation.NEUTRAL)[0]
-            )
-        except IndexError:
-            pass
+        out.update(self.cluster._get_special_cites())
 
         if self.cluster.date_filed is not None:
             out["dateFiled"] = midnight_pst(self.cluster.date_filed)
@@ -2823,10 +2968,10 @@ class Opinion(AbstractDateTimeModel):
         out.update(court)
 
         # Load the document text using a template for cleanup and concatenation
-        text_template = loader.get_template("indexes/opinion_text.txt")
-        out["text"] = text_template.render(
-            {"item": self, "citation_string": self.cluster.citation_string}
-        ).translate(null_map)
+        out["text"] = render_index_text(
+            "indexes/opinion_text.txt",
+            {"item": self, "citation_string": self.cluster.citation_string},
+        )
 
         return normalize_search_dicts(out)
 
@@ -2917,6 +3062,38 @@ class Tag(AbstractDateTimeModel):
         else:
             raise NotImplementedError("Object type not supported for tagging.")
 
+    def tag_objects(self, things: Iterable[TaggableType]) -> None:
+        """Atomically add a tag to many items of the same type at once.
+
+        This is the bulk version of tag_object. Instead of a get_or_create per
+        item, it inserts all the through table rows in one query and lets the
+        database skip any that already exist.
+
+        :param things: An iterable of Dockets, DocketEntries, RECAPDocuments,
+        or Claims.
+        :return: None
+        """
+        things = list(things)
+        if not things:
+            return
+        if type(things[0]) == Docket:
+            through, field = self.dockets.through, "docket_id"
+        elif type(things[0]) == DocketEntry:
+            through, field = self.docket_entries.through, "docketentry_id"
+        elif type(things[0]) == RECAPDocument:
+            through, field = self.recap_documents.through, "recapdocument_id"
+        elif type(things[0]) == Claim:
+            through, field = self.claims.through, "claim_id"
+        else:
+            raise NotImplementedError("Object type not supported for tagging.")
+        through.objects.bulk_create(
+            [
+                through(**{field: thing.pk, "tag_id": self.pk})
+                for thing in things
+            ],
+            ignore_conflicts=True,
+        )
+
 
 # class AppellateReview(models.Model):
 #     REVIEW_STANDARDS = (
@@ -1,15 +1,27 @@
 import socket
 from datetime import timedelta
+from typing import Set
 
-import scorched
 from django.apps import apps
 from django.conf import settings
+from django.db.models import Q
 from django.utils.timezone import now
 from scorched.exc import SolrError
 
 from cl.celery_init import app
-from cl.lib.search_index_utils import InvalidDocumentError
-from cl.search.models import Docket, OpinionCluster, RECAPDocument
+from cl.lib.scorched_utils import ExtraSolrInterface, SolrBatchWriter
+from cl.lib.search_index_utils import (
+    InvalidDocumentError,
+    clear_docket_changes,
+    get_docket_changes,
+    normalize_search_dicts,
+)
+from cl.search.models import (
+    BankruptcyInformation,
+    Docket,
+    OpinionCluster,
+    RECAPDocument,
+)
 
 
 @app.task
@@ -21,36 +33,115 @@ def add_items_to_solr(item_pks, app_label, force_commit=False):
     :param force_commit: Whether to send a commit to Solr after your addition.
     This is generally not advised and is mostly used for testing.
     """
-    search_dicts = []
     model = apps.get_model(app_label)
     items = model.objects.filter(pk__in=item_pks).order_by()
-    for item in items:
-        try:
-            if model in [OpinionCluster, Docket]:
-                # Dockets make a list of items; extend, don't append
-                search_dicts.extend(item.as_search_list())
-            else:
-                search_dicts.append(item.as_search_dict())
-        except AttributeError as e:
-            print("AttributeError trying to add: %s\n  %s" % (item, e))
-        except ValueError as e:
-            print("ValueError trying to add: %s\n  %s" % (item, e))
-        except InvalidDocumentError:
-            print("Unable to parse: %s" % item)
-
-    si = scorched.SolrInterface(settings.SOLR_URLS[app_label], mode="w")
+    if hasattr(model, "prefetch_for_search"):
+        # Pull related data for the whole chunk up front, not item by item.
+        to_index = model.prefetch_for_search(items)
+    else:
+        to_index = items
     try:
-        si.add(search_dicts)
-        if force_commit:
-            si.commit()
-        si.conn.http_connection.close()
+        with SolrBatchWriter(commit=force_commit) as writer:
+            url = settings.SOLR_URLS[app_label]
+            for item in to_index:
+                try:
+                    if model == Docket:
+                        # Stream the documents of the docket, so big dockets
+                        # are sent in batches rather than built all at once.
+                        writer.add(url, item.iter_search_docs())
+                    elif model == OpinionCluster:
+                        # Clusters make a list of items; extend, don't append
+                        writer.add(url, item.as_search_list())
+                    else:
+                        writer.add(url, item.as_search_dict())
+                except AttributeError as e:
+                    print("AttributeError trying to add: %s\n  %s" % (item, e))
+                except ValueError as e:
+                    print("ValueError trying to add: %s\n  %s" % (item, e))
+                except InvalidDocumentError:
+                    print("Unable to parse: %s" % item)
     except (socket.error, SolrError) as exc:
         add_items_to_solr.retry(exc=exc, countdown=30)
     else:
         # Mark dockets as updated if needed
         if model == Docket:
             items.update(date_modified=now(), date_last_index=now())
-        si.conn.http_connection.close()
+
+
+def needs_full_docket_reindex(d: Docket, changes: Set[str]) -> bool:
+    """Work out whether a docket's changes can be patched into Solr or if
+    every document on the docket has to be re-indexed.
+
+    :param d: The docket that changed.
+    :param changes: The fields that changed since it was last indexed.
+    :return: True if every document must be re-indexed.
+    """
+    if d.date_last_index is None:
+        return True
+    if changes.intersection(Docket.SEARCH_TEXT_FIELDS):
+        return True
+    # Bankruptcy info is rendered into the text field of every document.
+    return BankruptcyInformation.objects.filter(
+        docket=d, date_modified__gte=d.date_last_index
+    ).exists()
+
+
+def index_docket_delta(
+    writer: SolrBatchWriter, d: Docket, changes: Set[str]
+) -> bool:
+    """Index only what has changed on a docket since it was last indexed.
+
+    RECAPDocuments that were created or modified since then (or whose docket
+    entry was) are fully indexed. Every other document on the docket gets an
+    atomic update of just the Solr fields that correspond to the changed
+    docket fields.
+
+    :param writer: The writer to send documents through.
+    :param d: The docket to index.
+    :param changes: The docket fields that changed since it was last indexed.
+    This must not include any of Docket.SEARCH_TEXT_FIELDS.
+    :return: False if the delta couldn't be computed and the whole docket
+    needs to be re-indexed instead, else True.
+    """
+    since = d.date_last_index
+    rds = RECAPDocument.objects.filter(docket_entry__docket=d).order_by()
+    changed_rds = rds.filter(
+        Q(date_modified__gte=since) | Q(docket_entry__date_modified__gte=since)
+    ).select_related(
+        "docket_entry__docket__court",
+        "docket_entry__docket__assigned_to",
+        "docket_entry__docket__referred_to",
+        "docket_entry__docket__bankruptcy_information",
+    )
+    sample = rds.first()
+    if sample is None:
+        return True
+    metadata = normalize_search_dicts(sample.get_docket_metadata())
+
+    solr_fields = set()
+    for field in changes:
+        solr_fields.update(Docket.SEARCH_ATOMIC_FIELDS.get(field, []))
+    patch = {}
+    for field in solr_fields:
+        value = metadata.get(field)
+        if value is None:
+            # Scorched drops fields that are set to None, so there's no way
+            # to clear a single-valued field with an atomic update.
+            return False
+        patch[field] = {"set": value}
+
+    changed_pks = set()
+    for rd in changed_rds.iterator():
+        changed_pks.add(rd.pk)
+        writer.add(
+            settings.SOLR_RECAP_URL,
+            rd.as_search_dict(docket_metadata=dict(metadata)),
+        )
+    if patch:
+        for pk in rds.values_list("pk", flat=True).iterator():
+            if pk not in changed_pks:
+                writer.add(settings.SOLR_RECAP_URL, dict(patch, id=pk))
+    return True
 
 
 @app.task(ignore_resutls=True)
@@ -59,17 +150,24 @@ def add_or_update_recap_docket(
 ):
     """Add an entire docket to Solr or update it if it's already there.
 
-    This is an expensive operation because to add or update a RECAP docket in
-    Solr means updating every document that's a part of it. So if a docket has
-    10,000 documents, we'll have to pull them *all* from the database, and
-    re-index them all. It'd be nice to not have to do this, but because Solr is
-    de-normalized, every document in the RECAP Solr index has a copy of every
-    field in Solr. For example, if the name of the case changes, that has to get
-    reflected in every document in the docket in Solr.
+    Because Solr is de-normalized, every document in the RECAP Solr index has
+    a copy of the docket's fields. For example, if the name of the case
+    changes, that has to get reflected in every document in the docket in
+    Solr. That can mean re-indexing 10,000 documents on a big docket, so we
+    avoid it where we can:
+
+     - Docket.save and the party merger record which denormalized fields
+       changed since the docket was last indexed.
+
+     - If none of those fields are rendered into the text field of the
+       documents, we only send atomic updates of the changed fields, and fully
+       index just the documents that are new or changed.
+
+     - Otherwise, we re-index everything on the docket.
 
-    To deal with this mess, we have a field on the docket that says when we last
-    updated it in Solr. If that date is after a threshold, we just don't do the
-    update unless we know the docket has something new.
+    We also have a field on the docket that says when we last updated it in
+    Solr. If that date is after a threshold, we just don't do the update unless
+    we know the docket has something new.
 
     :param data: A dictionary containing the a key for 'docket_pk' and
     'content_updated'. 'docket_pk' will be used to find the docket to modify.
@@ -83,7 +181,6 @@ def add_or_update_recap_docket(
     if data is None:
         return
 
-    si = scorched.SolrInterface(settings.SOLR_RECAP_URL, mode="w")
     some_time_ago = now() - timedelta(seconds=update_threshold)
     d = Docket.objects.get(pk=data["docket_pk"])
     too_fresh = d.date_last_index is not None and (
@@ -92,17 +189,23 @@ def add_or_update_recap_docket(
     update_not_required = not data.get("content_updated", False)
     if all([too_fresh, update_not_required]):
         return
+
+    # Anything modified after this will be picked up by the next run.
+    start_time = now()
+    changes = get_docket_changes(d.pk)
+    try:
+        with SolrBatchWriter(commit=force_commit) as writer:
+            delta_ok = not needs_full_docket_reindex(
+                d, changes
+            ) and index_docket_delta(writer, d, changes)
+            if not delta_ok:
+                writer.add(settings.SOLR_RECAP_URL, d.iter_search_docs())
+    except SolrError as exc:
+        add_or_update_recap_docket.retry(exc=exc, countdown=30)
     else:
-        try:
-            si.add(d.as_search_list())
-            if force_commit:
-                si.commit()
-            si.conn.http_connection.close()
-        except SolrError as exc:
-            add_or_update_recap_docket.retry(exc=exc, countdown=30)
-        else:
-            d.date_last_index = now()
-            d.save()
+        clear_docket_changes(d.pk, changes)
+        d.date_last_index = start_time
+        d.save()
 
 
 @app.task
@@ -120,7 +223,7 @@ def add_docket_to_solr_by_rds(item_pks, force_commit=False):
     needed).
     :return: None
     """
-    si = scorched.SolrInterface(settings.SOLR_RECAP_URL, mode="w")
+    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode="w")
     rds = RECAPDocument.objects.filter(pk__in=item_pks).order_by()
     try:
         metadata = rds[0].get_docket_metadata()
@@ -131,18 +234,16 @@ def add_docket_to_solr_by_rds(item_pks, force_commit=False):
         si.add([item.as_search_dict(docket_metadata=metadata) for item in rds])
         if force_commit:
             si.commit()
-        si.conn.http_connection.close()
     except SolrError as exc:
         add_docket_to_solr_by_rds.retry(exc=exc, countdown=30)
 
 
 @app.task
 def delete_items(items, app_label, force_commit=False):
-    si = scorched.SolrInterface(settings.SOLR_URLS[app_label], mode="w")
+    si = ExtraSolrInterface(settings.SOLR_URLS[app_label], mode="w")
     try:
         si.delete_by_ids(list(items))
         if force_commit:
             si.commit()
-        si.conn.http_connection.close()
     except SolrError as exc:
         delete_items.retry(exc=exc, countdown=30)
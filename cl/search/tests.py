@@ -1,5 +1,7 @@
 import io
 import os
+import shutil
+import tempfile
 import time
 from datetime import date
 from pathlib import Path
@@ -9,16 +11,21 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.management import call_command
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, transaction
 from django.http import HttpRequest
 from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.timezone import now
 from lxml import etree, html
 from rest_framework.status import HTTP_200_OK
 from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.common.by import By
 from timeout_decorator import timeout_decorator
 
+from cl.audio.models import Audio
+from cl.lib.search_index_text import render_index_text
+from cl.lib.search_index_utils import clear_docket_changes, get_docket_changes
 from cl.lib.search_utils import cleanup_main_query
 from cl.lib.storage import clobbering_get_name
 from cl.lib.test_helpers import (
@@ -26,21 +33,28 @@ from cl.lib.test_helpers import (
     IndexedSolrTestCase,
     SolrTestCase,
 )
+from cl.people_db.models import Person
 from cl.search.feeds import JurisdictionFeed
 from cl.search.management.commands.cl_calculate_pagerank import Command
 from cl.search.models import (
     DOCUMENT_STATUSES,
     SEARCH_TYPES,
+    BankruptcyInformation,
     Citation,
     Court,
     Docket,
     DocketEntry,
     Opinion,
     OpinionCluster,
+    OpinionsCited,
     RECAPDocument,
     sort_cites,
 )
-from cl.search.tasks import add_docket_to_solr_by_rds
+from cl.search.pagerank import CitationGraph, write_solr_pagerank_file
+from cl.search.tasks import (
+    add_docket_to_solr_by_rds,
+    needs_full_docket_reindex,
+)
 from cl.search.views import do_search
 from cl.tests.base import SELENIUM_TIMEOUT, BaseSeleniumTest
 
@@ -243,6 +257,39 @@ class ModelTest(TestCase):
         self.assertEqual(cluster_count, expected_count)
 
 
+class SearchDictQueryCountTest(TestCase):
+    fixtures = ["test_objects_search.json", "judge_judy.json"]
+
+    def test_opinion_search_dicts_use_constant_queries(self) -> None:
+        """Does making search dicts for a chunk of opinions take the same
+        number of queries no matter how big the chunk is?
+        """
+        pks = list(Opinion.objects.values_list("pk", flat=True))
+        self.assertGreater(len(pks), 1)
+        with self.assertNumQueries(7):
+            one = list(Opinion.as_search_dicts(Opinion.objects.filter(pk=1)))
+        with self.assertNumQueries(7):
+            many = list(Opinion.as_search_dicts(Opinion.objects.all()))
+        self.assertEqual(len(one), 1)
+        self.assertEqual(len(many), len(pks))
+
+    def test_batch_search_dicts_match_single_ones(self) -> None:
+        """Do the batched search dicts match the ones made one at a time?"""
+        batched = {
+            d["id"]: d for d in Opinion.as_search_dicts(Opinion.objects.all())
+        }
+        for opinion in Opinion.objects.all():
+            self.assertEqual(batched[opinion.pk], opinion.as_search_dict())
+
+        clusters = OpinionCluster.objects.all()
+        batched = {
+            d["id"]: d for d in OpinionCluster.as_search_lists(clusters)
+        }
+        for cluster in clusters:
+            for d in cluster.as_search_list():
+                self.assertEqual(batched[d["id"]], d)
+
+
 class DocketValidationTest(TestCase):
     fixtures = ["test_court.json"]
 
@@ -272,6 +319,185 @@ class DocketValidationTest(TestCase):
                 )
 
 
+class DocketSearchChangesTest(TestCase):
+    fixtures = ["test_court.json"]
+
+    def setUp(self) -> None:
+        self.d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="asdf",
+            pacer_case_id="asdf",
+            court_id="test",
+            date_last_index=now(),
+        )
+        self.addCleanup(
+            clear_docket_changes, self.d.pk, ["cause", "case_name"]
+        )
+
+    def test_changes_are_recorded(self) -> None:
+        """Do we record which denormalized fields change on a docket?"""
+        d = Docket.objects.get(pk=self.d.pk)
+        self.assertEqual(d.changed_search_fields(), [])
+        d.cause = "28:1332 Diversity"
+        d.pacer_case_id = "1234"
+        self.assertEqual(d.changed_search_fields(), ["cause"])
+        d.save()
+        self.assertEqual(d.changed_search_fields(), [])
+        self.assertEqual(get_docket_changes(d.pk), {"cause"})
+        self.assertFalse(needs_full_docket_reindex(d, {"cause"}))
+
+    def test_text_changes_need_full_reindex(self) -> None:
+        """If a field in the text of each document changes, do we re-index
+        the whole docket?
+        """
+        d = Docket.objects.get(pk=self.d.pk)
+        d.case_name = "Lissner v. Saad"
+        d.save()
+        changes = get_docket_changes(d.pk)
+        self.assertIn("case_name", changes)
+        self.assertTrue(needs_full_docket_reindex(d, changes))
+
+
+class DocketSearchDocsTest(TestCase):
+    fixtures = ["test_court.json"]
+
+    def setUp(self) -> None:
+        self.d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="asdf",
+            pacer_case_id="asdf",
+            court_id="test",
+        )
+
+    def add_entries(self, count: int) -> None:
+        start = self.d.docket_entries.count() + 1
+        for entry_number in range(start, start + count):
+            de = DocketEntry.objects.create(
+                docket=self.d, entry_number=entry_number
+            )
+            for attachment_number in (None, 1):
+                RECAPDocument.objects.create(
+                    docket_entry=de,
+                    document_type=(
+                        RECAPDocument.ATTACHMENT
+                        if attachment_number
+                        else RECAPDocument.PACER_DOCUMENT
+                    ),
+                    document_number=str(entry_number),
+                    attachment_number=attachment_number,
+                    pacer_doc_id="%s-%s" % (entry_number, attachment_number),
+                )
+
+    def test_search_docs_match_search_list(self) -> None:
+        """Do we get the same docs whatever the chunk size?"""
+        self.add_entries(3)
+        d = Docket.objects.get(pk=self.d.pk)
+        search_list = d.as_search_list()
+        self.assertEqual(len(search_list), 6)
+        for chunk_size in (1, 2, 500):
+            d = Docket.objects.get(pk=self.d.pk)
+            self.assertEqual(
+                list(d.iter_search_docs(chunk_size=chunk_size)), search_list
+            )
+
+    def test_search_docs_use_constant_queries_per_chunk(self) -> None:
+        """Does a docket with more entries take more queries only if it
+        takes more chunks?
+        """
+        self.add_entries(2)
+        d = Docket.objects.get(pk=self.d.pk)
+        with CaptureQueriesContext(connection) as small:
+            list(d.iter_search_docs(chunk_size=10))
+        self.add_entries(6)
+        d = Docket.objects.get(pk=self.d.pk)
+        with self.assertNumQueries(len(small)):
+            list(d.iter_search_docs(chunk_size=10))
+
+
+class IndexTextTest(TestCase):
+    """Do the index text builders make the same text as the templates?"""
+
+    fixtures = [
+        "test_court.json",
+        "judge_judy.json",
+        "test_objects_search.json",
+        "test_objects_audio.json",
+    ]
+
+    def assertTextMatchesTemplate(self, template_name, context) -> None:
+        with self.settings(INDEX_TEXT_USE_TEMPLATES=True):
+            expected = render_index_text(template_name, context)
+        with self.settings(INDEX_TEXT_USE_TEMPLATES=False):
+            got = render_index_text(template_name, context)
+        self.assertEqual(got, expected)
+
+    def test_opinion_text(self) -> None:
+        for opinion in Opinion.objects.all():
+            context = {
+                "item": opinion,
+                "citation_string": opinion.cluster.citation_string,
+            }
+            self.assertTextMatchesTemplate("indexes/opinion_text.txt", context)
+            # Each kind of body, with things to strip and escape.
+            for field in ("html_columbia", "html_lawbox", "html"):
+                setattr(opinion, field, "<p>Lissner &amp; Saad's <i>v.</p>")
+                self.assertTextMatchesTemplate(
+                    "indexes/opinion_text.txt", context
+                )
+                setattr(opinion, field, "")
+
+    def test_recap_text(self) -> None:
+        d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="1:20-cv-00001",
+            case_name="Lissner & Saad v. <Foo>",
+            pacer_case_id="asdf",
+            court_id="test",
+            date_filed=date(2020, 3, 5),
+        )
+        de = DocketEntry.objects.create(
+            docket=d,
+            entry_number=1,
+            date_filed=date(2020, 3, 6),
+            description="<b>Complaint</b> & summons",
+        )
+        rd = RECAPDocument.objects.create(
+            docket_entry=de,
+            document_type=RECAPDocument.PACER_DOCUMENT,
+            document_number="1",
+            pacer_doc_id="1",
+            plain_text="Some 'text' \x00 & more",
+        )
+        self.assertTextMatchesTemplate(
+            "indexes/dockets_text.txt", {"item": rd}
+        )
+
+        BankruptcyInformation.objects.create(
+            docket=d, chapter="7", trustee_str="Trustee & Co"
+        )
+        rd = RECAPDocument.objects.get(pk=rd.pk)
+        self.assertTextMatchesTemplate(
+            "indexes/dockets_text.txt", {"item": rd}
+        )
+
+    def test_audio_text(self) -> None:
+        for audio_file in Audio.objects.all():
+            self.assertTextMatchesTemplate(
+                "indexes/audio_text.txt", {"item": audio_file}
+            )
+            audio_file.stt_status = Audio.STT_COMPLETE
+            audio_file.transcript = "Arguments & <rebuttals>"
+            self.assertTextMatchesTemplate(
+                "indexes/audio_text.txt", {"item": audio_file}
+            )
+
+    def test_person_text(self) -> None:
+        for person in Person.objects.all():
+            self.assertTextMatchesTemplate(
+                "indexes/person_text.txt", {"item": person}
+            )
+
+
 class IndexingTest(EmptySolrTestCase):
     """Are things indexed properly?"""
 
@@ -1078,6 +1304,32 @@ class PagerankTest(TestCase):
                 "%s" % (key, pr_results[key], answers[key]),
             )
 
+    def test_incremental_pagerank_matches_rebuild(self) -> None:
+        """Does adding citations to an existing snapshot give the same scores
+        as building the graph from scratch, and is the Solr file sorted?
+        """
+        snapshot_dir = os.path.join(tempfile.mkdtemp(), "pagerank")
+        self.addCleanup(shutil.rmtree, os.path.dirname(snapshot_dir))
+        Command.do_pagerank(snapshot_dir=snapshot_dir)
+
+        OpinionsCited.objects.create(citing_opinion_id=4, cited_opinion_id=2)
+        OpinionsCited.objects.create(citing_opinion_id=5, cited_opinion_id=4)
+        incremental = Command.do_pagerank(snapshot_dir=snapshot_dir)
+        self.assertEqual(CitationGraph.load(snapshot_dir).edge_count, 6)
+        rebuilt = Command.do_pagerank()
+        self.assertEqual(len(incremental), len(rebuilt))
+        for pk, score in enumerate(rebuilt):
+            self.assertAlmostEqual(incremental[pk], score, places=8)
+
+        result_path = os.path.join(os.path.dirname(snapshot_dir), "pr.txt")
+        write_solr_pagerank_file(incremental, result_path)
+        with open(result_path) as f:
+            pks = [int(line.split("=")[0]) for line in f]
+        self.assertEqual(
+            pks,
+            list(Opinion.objects.order_by("pk").values_list("pk", flat=True)),
+        )
+
 
 class OpinionSearchFunctionalTest(BaseSeleniumTest):
     """
@@ -178,6 +178,11 @@ SOLR_EXAMPLE_CORE_PATH = os.path.join(
 SOLR_TEMP_CORE_PATH_LOCAL = os.path.join(os.sep, "tmp", "solr")
 SOLR_TEMP_CORE_PATH_DOCKER = os.path.join(os.sep, "tmp", "solr")
 
+# The text field of each search document is built by the functions in
+# cl/lib/search_index_text.py, which copy the templates in
+# cl/search/templates/indexes. Set this to render the templates instead.
+INDEX_TEXT_USE_TEMPLATES = False
+
 
 #########
 # Redis #
@@ -253,6 +258,18 @@ CACHES = {
 # have pretty good persistency in Redis, so it's fairly well backed up.
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 
+# Where to remember which RSS items have already been merged, either "redis"
+# or "db", and for how long.
+RSS_ITEM_CACHE_BACKEND = "redis"
+RSS_ITEM_CACHE_TTL = 60 * 60 * 24 * 2
+# How long an RSS item stays claimed by a worker that's merging it. If the
+# worker dies, the item gets merged again once this runs out.
+RSS_ITEM_CLAIM_TTL = 60 * 30
+
+# How long to remember the last docket upload of each case, so that uploads
+# of a docket that hasn't changed since can be skipped.
+RECAP_UPLOAD_CACHE_TTL = 60 * 60 * 24 * 7
+
 #########
 # Email #
 #########
@@ -284,6 +301,33 @@ if not any([TESTING, DEBUG]):
 # Where should the bulk data be stored?
 BULK_DATA_DIR = os.path.join(INSTALL_ROOT, "cl/assets/media/bulk-data/")
 
+# Where should the citation graph snapshot for pagerank be kept between runs?
+PAGERANK_SNAPSHOT_DIR = os.path.join(INSTALL_ROOT, "cl/assets/media/pagerank/")
+
+# Where should the local index of reporter citations be kept? Citation matching
+# uses it when it exists and falls back to Solr otherwise.
+REPORTER_CITATION_INDEX_PATH = os.path.join(
+    INSTALL_ROOT, "cl/assets/media/citations/reporter_index.sqlite3"
+)
+
+# The graph of citations between Supreme Court cases that SCOTUSMaps are built
+# from. It's made by cl_build_scotus_graph. Until it exists, maps are built
+# from the database, which is much slower.
+SCOTUS_GRAPH_PATH = os.path.join(
+    INSTALL_ROOT, "cl/assets/media/visualizations/scotus_graph.pickle"
+)
+# The most cases a SCOTUSMap can have.
+SCOTUS_MAP_MAX_NODES = 70
+
+# How many pages of a scanned PDF should be OCRed at once? Each page gets its
+# own ghostscript and tesseract process, so keep this in line with the number
+# of cores per celery worker process.
+OCR_MAX_PARALLEL_PAGES = 4
+
+# How many alert queries cl_send_alerts should have in flight at once. Each
+# one holds a Solr connection while it runs.
+ALERTS_MAX_PARALLEL_QUERIES = 8
+
 #####################
 # Payments & Prices #
 #####################
@@ -370,7 +414,7 @@ REST_FRAMEWORK = {
         "rest_framework.filters.OrderingFilter",
     ),
     # Assorted & Sundry
-    "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
+    "DEFAULT_PAGINATION_CLASS": "cl.api.utils.KeysetPagination",
     "PAGE_SIZE": 20,
     "URL_FIELD_NAME": "resource_uri",
     "DEFAULT_METADATA_CLASS": "cl.api.utils.SimpleMetadataWithFilters",
@@ -651,3 +695,15 @@ BTE_URLS = {
         "timeout": 60 * 60 * 5,
     },
 }
+
+# Big financial disclosures can be extracted this many pages at a time, with
+# this many ranges at once. It's off (0, extract them whole) until the
+# extractors are shown to handle ranges that start mid-section, by comparing
+# the rows extracted by range and whole on a sample of disclosures.
+DISCLOSURE_PAGES_PER_RANGE = 0
+DISCLOSURE_EXTRACTION_WORKERS = 4
+# How long the page ranges that have been extracted are kept, so a failed
+# import can pick up where it left off.
+DISCLOSURE_EXTRACTION_CHECKPOINT_TTL = 60 * 60 * 24 * 7
+# How many rows of a disclosure to insert in each transaction.
+DISCLOSURE_SAVE_BATCH_SIZE = 1000
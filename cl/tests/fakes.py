@@ -1,6 +1,9 @@
 from datetime import date
+from io import BytesIO
 from unittest.mock import MagicMock
 
+from PyPDF2 import PdfFileReader
+
 DOCKET_NUMBER = "5:18-cr-00227"
 CASE_NAME = "United States v. Maldonado-Passage"
 
@@ -66,3 +69,57 @@ class FakeFreeOpinionReport:
 
     def download_pdf(self, *args, **kwargs):
         return MagicMock(content=b"")
+
+
+class FakeDisclosureExtractor:
+    """A stand-in for the disclosure extractor that runs locally.
+
+    Each page gets one investment, described by its page number, so tests
+    can check that every page ends up in the right place. The page counts
+    of the PDFs it's given are kept in calls.
+    """
+
+    fields = ["A", "B1", "B2", "C1", "C2", "D1", "D2", "D3", "D4", "D5"]
+    sections = [
+        "Positions",
+        "Agreements",
+        "Non-Investment Income",
+        "Non Investment Income Spouse",
+        "Reimbursements",
+        "Gifts",
+        "Liabilities",
+    ]
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, pdf_bytes, disclosure_type):
+        page_count = PdfFileReader(
+            BytesIO(pdf_bytes), strict=False
+        ).getNumPages()
+        self.calls.append(page_count)
+        investments = [
+            {
+                field: {
+                    "text": f"Page {page}" if field == "A" else "",
+                    "is_redacted": False,
+                    "page_number": page,
+                    "inferred_value": False,
+                }
+                for field in self.fields
+            }
+            for page in range(1, page_count + 1)
+        ]
+        sections = {name: {"rows": []} for name in self.sections}
+        sections["Investments and Trusts"] = {"rows": investments}
+        return {
+            "page_count": page_count,
+            "sections": sections,
+            "Additional Information or Explanations": {
+                "text": "",
+                "is_redacted": False,
+            },
+            "annual": True,
+            "amended": False,
+            "success": True,
+        }
@@ -0,0 +1,47 @@
+from django.conf import settings
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.visualizations.scotus_graph import build_scotus_graph
+
+
+class Command(VerboseCommand):
+    help = (
+        "Build or refresh the graph of citations between Supreme Court cases "
+        "that SCOTUSMaps are made from. By default this only picks up the "
+        "cases that changed since the last run, so run it after the citation "
+        "finder."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=settings.SCOTUS_GRAPH_PATH,
+            help="Where the graph should be kept.",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            default=False,
+            help="Build the graph from scratch instead of refreshing it. Do "
+            "this occasionally to drop deleted cases.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="The number of changed cases to refresh at a time.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        graph = build_scotus_graph(
+            options["path"],
+            rebuild=options["rebuild"],
+            chunk_size=options["chunk_size"],
+        )
+        logger.info(
+            "Saved a graph of %s cases and %s citations to %s.",
+            len(graph),
+            graph.edge_count,
+            options["path"],
+        )
@@ -268,6 +268,39 @@ class SCOTUSMap(AbstractDateTimeModel):
 
         return g
 
+    def build_graph(self, max_hops, max_nodes=70):
+        """Build a networkx graph of the citation paths from the end of the
+        map back to its start.
+
+        The cached SCOTUS citation graph is used when it has been built and
+        has both ends of the map in it. Otherwise, the graph is built by
+        walking the authorities in the database with build_nx_digraph.
+
+        :param max_hops: The maximum degree of separation for the network.
+        :param max_nodes: The maximum number of nodes a network can contain.
+        """
+        from cl.visualizations.scotus_graph import get_scotus_graph
+
+        graph = get_scotus_graph()
+        if (
+            graph is not None
+            and self.cluster_start_id in graph
+            and self.cluster_end_id in graph
+        ):
+            return graph.find_paths(
+                self.cluster_start_id,
+                self.cluster_end_id,
+                max_hops=max_hops,
+                max_nodes=max_nodes,
+            )
+        return self.build_nx_digraph(
+            parent_authority=self.cluster_end,
+            visited_nodes={},
+            good_nodes={},
+            max_hops=max_hops,
+            max_nodes=max_nodes,
+        )
+
     def add_clusters(self, g):
         """Add clusters to the model using an existing nx graph."""
         self.clusters.add(*g.nodes())
@@ -0,0 +1,302 @@
+"""An in-memory graph of the citations between Supreme Court cases.
+
+SCOTUSMaps only ever link Supreme Court cases, so rather than walking the
+authorities of each case in the database, maps are built from a precomputed
+graph of every SCOTUS cluster and the SCOTUS clusters it cites.
+
+The graph is kept in compact arrays: the cluster IDs in order, the ordinal of
+each cluster's filing date, and the edges in both directions as offsets into
+a flat array of node indexes, so that the neighbours of node i are
+edges[offsets[i]:offsets[i + 1]]. It's built and refreshed by
+cl_build_scotus_graph and saved to disk, and each worker loads it once and
+picks up new versions as they're saved.
+
+Refreshing picks up clusters that were modified and clusters with opinions
+that were modified since the last refresh, which includes every opinion the
+citation finder has run on. Clusters that are deleted stay in the graph until
+it is rebuilt.
+"""
+import os
+import pickle
+from array import array
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import networkx
+from django.conf import settings
+from django.utils.timezone import now
+
+from cl.search.models import Opinion, OpinionCluster, OpinionsCited
+from cl.visualizations.exceptions import TooManyNodes
+
+_graph: Optional["SCOTUSGraph"] = None
+_graph_mtime: Optional[float] = None
+
+
+def make_csr(
+    ids: array, adjacency: Dict[int, Iterable[int]]
+) -> Tuple[array, array]:
+    """Pack an adjacency dict of cluster IDs into offsets and edges."""
+    index = {pk: i for i, pk in enumerate(ids)}
+    offsets = array("q", [0])
+    edges = array("l")
+    for pk in ids:
+        edges.extend(
+            sorted(index[t] for t in adjacency.get(pk, ()) if t in index)
+        )
+        offsets.append(len(edges))
+    return offsets, edges
+
+
+class SCOTUSGraph(object):
+    """The SCOTUS citation graph, in adjacency arrays."""
+
+    def __init__(
+        self,
+        ids: array,
+        dates: array,
+        cites: Tuple[array, array],
+        cited_by: Tuple[array, array],
+        last_refresh: Optional[str] = None,
+    ) -> None:
+        self.ids = ids
+        self.dates = dates
+        self.cites_offsets, self.cites = cites
+        self.cited_by_offsets, self.cited_by = cited_by
+        self.last_refresh = last_refresh
+        self.index = {pk: i for i, pk in enumerate(ids)}
+
+    @classmethod
+    def from_adjacency(
+        cls,
+        dates: Dict[int, int],
+        cites: Dict[int, Set[int]],
+        last_refresh: Optional[str] = None,
+    ) -> "SCOTUSGraph":
+        """Make a graph from cluster dates and the clusters each one cites.
+
+        :param dates: A dict of cluster IDs to the ordinals of their filing
+        dates
+        :param cites: A dict of cluster IDs to the IDs of the clusters they
+        cite
+        """
+        ids = array("l", sorted(dates))
+        cited_by: Dict[int, Set[int]] = {}
+        for citing, cited in cites.items():
+            for pk in cited:
+                cited_by.setdefault(pk, set()).add(citing)
+        return cls(
+            ids,
+            array("l", (dates[pk] for pk in ids)),
+            make_csr(ids, cites),
+            make_csr(ids, cited_by),
+            last_refresh,
+        )
+
+    def to_adjacency(self) -> Tuple[Dict[int, int], Dict[int, Set[int]]]:
+        """Unpack the graph into the arguments of from_adjacency."""
+        dates = dict(zip(self.ids, self.dates))
+        cites = {
+            pk: {self.ids[j] for j in self._neighbours(i, forward=True)}
+            for i, pk in enumerate(self.ids)
+        }
+        return dates, cites
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, pk: int) -> bool:
+        return pk in self.index
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.cites)
+
+    def _neighbours(self, i: int, forward: bool) -> array:
+        if forward:
+            return self.cites[
+                self.cites_offsets[i] : self.cites_offsets[i + 1]
+            ]
+        return self.cited_by[
+            self.cited_by_offsets[i] : self.cited_by_offsets[i + 1]
+        ]
+
+    def _distances(
+        self,
+        source: int,
+        stop: int,
+        forward: bool,
+        min_date: int,
+        max_hops: int,
+    ) -> Dict[int, int]:
+        """Find how many hops each node is from a source, up to max_hops.
+
+        Nodes filed before min_date are skipped, and the search doesn't go on
+        past the stop node, since paths end there.
+        """
+        distances = {source: 0}
+        queue = deque([source])
+        while queue:
+            i = queue.popleft()
+            hops = distances[i] + 1
+            if hops > max_hops or i == stop:
+                continue
+            for j in self._neighbours(i, forward):
+                if j not in distances and self.dates[j] >= min_date:
+                    distances[j] = hops
+                    queue.append(j)
+        return distances
+
+    def find_paths(
+        self, start_pk: int, end_pk: int, max_hops: int, max_nodes: int
+    ) -> networkx.DiGraph:
+        """Find every citation path from a later case back to an earlier one.
+
+        This searches out from both ends: forwards through the authorities
+        of the end, and backwards through the cases that cite the start. A
+        citation is part of the map if the hops to it from the end, plus the
+        hops from it to the start, fit in max_hops.
+
+        :param start_pk: The ID of the earlier cluster
+        :param end_pk: The ID of the later cluster
+        :param max_hops: The maximum degree of separation for the network
+        :param max_nodes: The maximum number of nodes a network can contain
+        :return: A networkx graph of the clusters on the paths, with an edge
+        from each citing cluster to each cited one. It has no edges if there
+        are no paths.
+        """
+        start, end = self.index[start_pk], self.index[end_pk]
+        min_date = self.dates[start]
+        from_end = self._distances(end, start, True, min_date, max_hops)
+        if start not in from_end:
+            return networkx.DiGraph()
+        to_start = self._distances(start, end, False, min_date, max_hops)
+
+        g = networkx.DiGraph()
+        for i, hops in from_end.items():
+            if i == start or hops + to_start.get(i, max_hops + 1) > max_hops:
+                continue
+            for j in self._neighbours(i, forward=True):
+                if j in to_start and hops + 1 + to_start[j] <= max_hops:
+                    g.add_edge(self.ids[i], self.ids[j])
+                    if len(g) > max_nodes:
+                        raise TooManyNodes()
+        return g
+
+    def save(self, path: str) -> None:
+        """Save the graph, replacing any old version atomically."""
+        dest_dir = os.path.dirname(path)
+        if dest_dir:
+            os.makedirs(dest_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {
+                    "ids": self.ids,
+                    "dates": self.dates,
+                    "cites": (self.cites_offsets, self.cites),
+                    "cited_by": (self.cited_by_offsets, self.cited_by),
+                    "last_refresh": self.last_refresh,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SCOTUSGraph":
+        with open(path, "rb") as f:
+            return cls(**pickle.load(f))
+
+
+def get_cluster_dates(cluster_ids: Optional[List[int]] = None):
+    """Get the filing date ordinals of SCOTUS clusters."""
+    qs = OpinionCluster.objects.filter(docket__court_id="scotus")
+    if cluster_ids is not None:
+        qs = qs.filter(pk__in=cluster_ids)
+    return {
+        pk: date_filed.toordinal()
+        for pk, date_filed in qs.values_list("pk", "date_filed").iterator()
+        if date_filed is not None
+    }
+
+
+def get_scotus_citations(cluster_ids: Optional[List[int]] = None):
+    """Get the SCOTUS clusters cited by SCOTUS clusters.
+
+    :return: A dict of citing cluster IDs to sets of cited cluster IDs.
+    """
+    qs = OpinionsCited.objects.filter(
+        citing_opinion__cluster__docket__court_id="scotus",
+        cited_opinion__cluster__docket__court_id="scotus",
+    )
+    if cluster_ids is not None:
+        qs = qs.filter(citing_opinion__cluster_id__in=cluster_ids)
+    cites: Dict[int, Set[int]] = {}
+    for citing, cited in qs.values_list(
+        "citing_opinion__cluster_id", "cited_opinion__cluster_id"
+    ).iterator():
+        if citing != cited:
+            cites.setdefault(citing, set()).add(cited)
+    return cites
+
+
+def build_scotus_graph(
+    path: str, rebuild: bool = False, chunk_size: int = 10000
+) -> SCOTUSGraph:
+    """Create or refresh the SCOTUS citation graph at path.
+
+    :param path: Where the graph is saved
+    :param rebuild: Whether to build the graph from scratch, even if there's
+    one to refresh.
+    :param chunk_size: How many changed clusters to refresh at once.
+    :return: The new graph
+    """
+    started = now().isoformat()
+    if rebuild or not os.path.exists(path):
+        graph = SCOTUSGraph.from_adjacency(
+            get_cluster_dates(), get_scotus_citations(), started
+        )
+        graph.save(path)
+        return graph
+
+    graph = SCOTUSGraph.load(path)
+    dates, cites = graph.to_adjacency()
+    changed = set(
+        OpinionCluster.objects.filter(
+            docket__court_id="scotus", date_modified__gte=graph.last_refresh
+        ).values_list("pk", flat=True)
+    )
+    changed.update(
+        Opinion.objects.filter(
+            cluster__docket__court_id="scotus",
+            date_modified__gte=graph.last_refresh,
+        ).values_list("cluster_id", flat=True)
+    )
+    changed_ids = sorted(changed)
+    for i in range(0, len(changed_ids), chunk_size):
+        chunk = changed_ids[i : i + chunk_size]
+        dates.update(get_cluster_dates(chunk))
+        new_cites = get_scotus_citations(chunk)
+        for pk in chunk:
+            cites[pk] = new_cites.get(pk, set())
+    graph = SCOTUSGraph.from_adjacency(dates, cites, started)
+    graph.save(path)
+    return graph
+
+
+def get_scotus_graph(path: Optional[str] = None) -> Optional[SCOTUSGraph]:
+    """Get the SCOTUS citation graph, loading it if it's new or has changed.
+
+    :return: The graph, or None if it hasn't been built.
+    """
+    global _graph, _graph_mtime
+    path = path or settings.SCOTUS_GRAPH_PATH
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if _graph is None or mtime != _graph_mtime:
+        _graph = SCOTUSGraph.load(path)
+        _graph_mtime = mtime
+    return _graph
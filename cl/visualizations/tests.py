@@ -1,6 +1,8 @@
 """
 Unit tests for Visualizations
 """
+import os
+from tempfile import TemporaryDirectory
 from typing import Any, Callable, Dict
 
 from django.contrib.auth.models import User
@@ -24,6 +26,7 @@ from cl.visualizations import views
 from cl.visualizations.forms import VizForm
 from cl.visualizations.models import JSONVersion, SCOTUSMap
 from cl.visualizations.network_utils import reverse_endpoints_if_needed
+from cl.visualizations.scotus_graph import build_scotus_graph
 
 
 class TestVizUtils(TestCase):
@@ -92,6 +95,40 @@ class TestVizModels(TestCase):
         g = viz.build_nx_digraph(**build_kwargs)
         self.assertTrue(len(g.edges()) > 0)
 
+    def test_SCOTUSMap_builds_graph_from_scotus_graph(self) -> None:
+        """Does the cached SCOTUS graph give a map that links the start to
+        the end, and does refreshing it keep the same citations?
+        """
+        viz = SCOTUSMap(
+            user=self.user,
+            cluster_start=self.start,
+            cluster_end=self.end,
+            title="Test SCOTUSMap",
+            notes="Test Notes",
+        )
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "scotus_graph.pickle")
+            graph = build_scotus_graph(path, rebuild=True)
+            self.assertIn(self.start.pk, graph)
+            self.assertIn(self.end.pk, graph)
+
+            g = graph.find_paths(
+                self.start.pk, self.end.pk, max_hops=3, max_nodes=70
+            )
+            self.assertTrue(len(g.edges()) > 0)
+            self.assertIn(self.start.pk, g)
+            self.assertIn(self.end.pk, g)
+            self.assertEqual(g.in_degree(self.end.pk), 0)
+            self.assertEqual(g.out_degree(self.start.pk), 0)
+
+            with self.settings(SCOTUS_GRAPH_PATH=path):
+                self.assertEqual(
+                    set(viz.build_graph(max_hops=3).edges()), set(g.edges())
+                )
+
+            refreshed = build_scotus_graph(path)
+            self.assertEqual(refreshed.to_adjacency(), graph.to_adjacency())
+
     def test_SCOTUSMap_deletes_cascade(self) -> None:
         """
         Make sure we delete JSONVersion instances when deleted SCOTUSMaps
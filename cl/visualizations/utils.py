@@ -17,19 +17,17 @@ def build_visualization(viz):
     :return: A tuple of (status<str>, viz)
     """
     build_kwargs = {
-        "parent_authority": viz.cluster_end,
-        "visited_nodes": {},
-        "good_nodes": {},
         "max_hops": 3,
+        "max_nodes": settings.SCOTUS_MAP_MAX_NODES,
     }
     t1 = time.time()
     try:
-        g = viz.build_nx_digraph(**build_kwargs)
+        g = viz.build_graph(**build_kwargs)
     except TooManyNodes:
         try:
             # Try with fewer hops.
             build_kwargs["max_hops"] = 2
-            g = viz.build_nx_digraph(**build_kwargs)
+            g = viz.build_graph(**build_kwargs)
         except TooManyNodes:
             # Still too many hops. Abort.
             tally_stat("visualization.too_many_nodes_failure")